@@ -0,0 +1,92 @@
+import hmac
+import io
+import json
+import logging
+import tempfile
+from fastapi import APIRouter, Header, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Optional
+from app.api.router_socket import manager
+from app.bulk import FORMATS, KINDS, export_chunks, run_import
+from app.config import settings
+
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/admin")
+
+
+def _denied(authorization: Optional[str]) -> Optional[JSONResponse]:
+    # Пока CHAT_ADMIN_TOKEN не задан, административные маршруты выключены
+    if not settings.admin_token:
+        return JSONResponse({"success": False, "error": "Admin API requires CHAT_ADMIN_TOKEN"}, status_code=403)
+    if authorization is None or not hmac.compare_digest(authorization, f"Bearer {settings.admin_token}"):
+        return JSONResponse({"success": False, "error": "Unauthorized"}, status_code=401)
+    return None
+
+
+@router.post("/import/{kind}")
+async def import_records(
+    kind: str,
+    request: Request,
+    format: str = "csv",
+    authorization: Optional[str] = Header(None)
+):
+    # Тело запроса — файл целиком (curl --data-binary @users.csv); ответ — строки JSON с прогрессом после каждой пачки
+    denied = _denied(authorization)
+    if denied is not None:
+        return denied
+    if kind not in KINDS or format not in FORMATS:
+        return JSONResponse({"success": False, "error": "Unknown kind or format"}, status_code=400)
+
+    # Загрузка пишется во временный файл, а не в память: импорт читает его пачками
+    upload = tempfile.TemporaryFile()
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+
+    async def progress():
+        stream = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+        stats = None
+        try:
+            async for stats, rooms in run_import(kind, stream, format):
+                # Кэши доступа и списков комнат в остальных воркерах
+                for room_id in rooms:
+                    await manager.access_changed(room_id)
+                yield json.dumps(stats.as_dict(), ensure_ascii=False) + "\n"
+            yield json.dumps({"success": True, "done": True, **stats.as_dict()}, ensure_ascii=False) + "\n"
+        except Exception as exc:
+            # Статус 200 уже отправлен: об ошибке сообщает последняя строка, пачки до неё записаны
+            logger.exception("bulk import of %s failed", kind)
+            yield json.dumps({"success": False, "done": True, "error": str(exc)}, ensure_ascii=False) + "\n"
+        finally:
+            stream.close()
+
+    return StreamingResponse(progress(), media_type=MEDIA_TYPES["jsonl"])
+
+
+@router.get("/export/{kind}")
+async def export_records(kind: str, format: str = "jsonl", authorization: Optional[str] = Header(None)):
+    denied = _denied(authorization)
+    if denied is not None:
+        return denied
+    if kind not in KINDS or format not in FORMATS:
+        return JSONResponse({"success": False, "error": "Unknown kind or format"}, status_code=400)
+    return StreamingResponse(
+        export_chunks(kind, format), media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'}
+    )
+
+
+@router.get("/rooms/{room_id}/history")
+async def export_history(room_id: int, format: str = "jsonl", authorization: Optional[str] = Header(None)):
+    # Вся история комнаты, включая архив, по странице за раз (Transfer-Encoding: chunked)
+    denied = _denied(authorization)
+    if denied is not None:
+        return denied
+    if format not in FORMATS:
+        return JSONResponse({"success": False, "error": "Unknown format"}, status_code=400)
+    return StreamingResponse(
+        export_chunks("history", format, room_id), media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="room_{room_id}_history.{format}"'}
+    )
@@ -0,0 +1,112 @@
+import hmac
+from fastapi import APIRouter, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
+from typing import Optional
+from app.api.router_socket import manager
+from app.config import settings
+from app.history import history_buffer
+from app.lifecycle import current_rss_mb
+from app.metrics import REGISTRY, Collected
+from app.passwords import password_hasher
+from app.persistence import message_writer
+from app.profiler import profiler
+from app.retention import retention_job
+from app.sessions import user_cache
+from app.user_repo import room_access_cache, user_rooms_cache
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+router = APIRouter()
+
+
+def _queue_depths():
+    return [connection.queue_depth for connection in manager._all_connections()]
+
+
+# Счётчики, которые компоненты ведут сами, — читаются только при выгрузке /metrics
+Collected("chat_connections", "Open WebSocket connections in this worker", "gauge",
+          lambda: manager.lifecycle.total)
+Collected("chat_room_connections", "Open WebSocket connections per room", "gauge",
+          lambda: [((room_id,), size) for room_id, size in manager.rooms.sizes()],
+          labels=["room_id"])
+Collected("chat_connections_rejected", "Connections refused by admission control", "counter",
+          lambda: manager.lifecycle.rejected)
+Collected("chat_connections_reaped", "Idle connections closed by the heartbeat pass", "counter",
+          lambda: manager.lifecycle.reaped)
+Collected("chat_send_queue_frames", "Frames waiting in all connection send queues", "gauge",
+          lambda: sum(_queue_depths()))
+Collected("chat_send_queue_max_depth", "Deepest connection send queue", "gauge",
+          lambda: max(_queue_depths(), default=0))
+Collected("chat_frames_enqueued", "Frames put into connection send queues", "counter",
+          lambda: manager.frames_sent)
+Collected("chat_frame_batches_enqueued", "Coalesced array frames put into connection send queues", "counter",
+          lambda: manager.batches_sent)
+Collected("chat_persist_queue_depth", "Messages waiting for the write-behind writer", "gauge",
+          lambda: message_writer.queue_depth)
+Collected("chat_persist_batches", "Message batches written to the database", "counter",
+          lambda: message_writer.batches)
+Collected("chat_persist_rows_written", "Messages written to the database", "counter",
+          lambda: message_writer.rows_written)
+Collected("chat_persist_rows_failed", "Messages that failed to persist", "counter",
+          lambda: message_writer.rows_failed)
+Collected("chat_history_buffer_rooms", "Rooms held in the history ring buffer", "gauge",
+          lambda: len(history_buffer.rooms))
+Collected("chat_history_buffer_hits", "History requests served from the ring buffer", "counter",
+          lambda: history_buffer.hits)
+Collected("chat_history_buffer_misses", "History requests that had to warm the ring buffer", "counter",
+          lambda: history_buffer.misses)
+CACHES = {"room_access": room_access_cache, "user": user_cache, "user_rooms": user_rooms_cache}
+Collected("chat_cache_hits", "In-memory cache hits", "counter",
+          lambda: [((name,), cache.hits) for name, cache in CACHES.items()], labels=["cache"])
+Collected("chat_cache_misses", "In-memory cache misses", "counter",
+          lambda: [((name,), cache.misses) for name, cache in CACHES.items()], labels=["cache"])
+Collected("chat_password_hash_rejected", "Logins refused because the password hasher was saturated", "counter",
+          lambda: password_hasher.rejected)
+Collected("chat_retention_runs", "Completed retention passes", "counter",
+          lambda: retention_job.runs)
+Collected("chat_retention_rows_archived", "Messages moved to the archive by retention", "counter",
+          lambda: retention_job.rows_archived)
+Collected("chat_retention_segments_written", "Archive segments written by retention", "counter",
+          lambda: retention_job.segments_written)
+Collected("chat_process_resident_memory_bytes", "Resident memory of this worker", "gauge",
+          lambda: (current_rss_mb() or 0.0) * 2 ** 20)
+
+
+def _authorized(authorization: Optional[str]) -> bool:
+    return authorization is not None and hmac.compare_digest(authorization, f"Bearer {settings.metrics_token}")
+
+
+@router.get("/metrics")
+async def metrics(authorization: Optional[str] = Header(None)):
+    # Метрики этого воркера; при нескольких воркерах каждый собирается отдельно
+    if settings.metrics_token and not _authorized(authorization):
+        return PlainTextResponse("Unauthorized\n", status_code=401)
+    return PlainTextResponse(REGISTRY.expose(), media_type=CONTENT_TYPE)
+
+
+@router.post("/metrics/profiler")
+async def control_profiler(
+    enabled: bool,
+    interval: Optional[float] = None,
+    reset: bool = False,
+    authorization: Optional[str] = Header(None)
+):
+    if not settings.metrics_token:
+        return JSONResponse({"success": False, "error": "Profiler control requires CHAT_METRICS_TOKEN"}, status_code=403)
+    if not _authorized(authorization):
+        return JSONResponse({"success": False, "error": "Unauthorized"}, status_code=401)
+    if reset:
+        profiler.reset()
+    if enabled:
+        profiler.start(interval)
+    else:
+        profiler.stop()
+    return JSONResponse({"success": True, **profiler.status()})
+
+
+@router.get("/metrics/profile")
+async def profile(authorization: Optional[str] = Header(None)):
+    # Накопленные стеки в формате folded (flamegraph.pl, speedscope)
+    if not settings.metrics_token or not _authorized(authorization):
+        return PlainTextResponse("Unauthorized\n", status_code=401)
+    return PlainTextResponse(profiler.folded())
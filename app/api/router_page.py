@@ -1,40 +1,86 @@
+import os
 from fastapi import APIRouter, Request, Form, Cookie, Response, Depends
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from app.config import settings
 from app.database import get_session
+from app.history import get_history_page, search_history
+from app.passwords import PasswordHasherBusy
+from app.protocol import LEGACY, SUPPORTED
+from app.sessions import SESSION_COOKIE, get_session_user, issue_token
+from app.api.router_socket import manager
 from app.user_repo import (
-    create_user, authenticate_user, get_user_by_id, create_room,
+    create_user, authenticate_user, create_room,
     invite_user_to_room, remove_user_from_room, get_room_members,
-    check_user_access_to_room, get_user_rooms
+    check_user_access_to_room, get_user_rooms, get_user_room_list, get_room_members_page, set_room_retention
 )
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 
 templates = Jinja2Templates(directory='app/templates')
+# Скомпилированные шаблоны кэшируются окружением Jinja; без auto_reload не проверяется mtime файла на каждом рендере
+templates.env.auto_reload = settings.templates_auto_reload
+# Входит в ETag главной страницы, чтобы после обновления шаблона браузеры не получали 304 на старую версию
+HOME_TEMPLATE_VERSION = int(os.path.getmtime('app/templates/home.html'))
 router = APIRouter()
 
 
-async def get_current_user(user_id: Optional[str] = Cookie(None), session: AsyncSession = Depends(get_session)):
-    if not user_id:
-        return None
-    try:
-        return await get_user_by_id(int(user_id), session)
-    except:
-        return None
+async def get_current_user(session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE), session: AsyncSession = Depends(get_session)):
+    # Подпись проверяется без БД, пользователь берётся из кэша
+    return await get_session_user(session_token, session)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Слабое сравнение (RFC 9110): W/"x" совпадает с "x"; заголовок может содержать список или "*"
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    weak = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == weak for tag in if_none_match.split(","))
+
+
+def set_session_cookie(response: Response, user):
+    response.set_cookie(key=SESSION_COOKIE, value=issue_token(user.id, user.username),
+                        max_age=settings.session_ttl, httponly=True, samesite="lax")
 
 
 @router.get("/", response_class=HTMLResponse)
-async def home_page(request: Request, user_id: Optional[str] = Cookie(None), session: AsyncSession = Depends(get_session)):
-    user = await get_current_user(user_id, session)
+async def home_page(request: Request, session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE), session: AsyncSession = Depends(get_session)):
+    user = await get_current_user(session_token, session)
     if not user:
         return RedirectResponse(url="/login", status_code=302)
     
-    rooms = await get_user_rooms(user.id)
+    # Страница зависит только от пользователя и его списка комнат — при повторном заходе отдаём 304 без рендера
+    room_list = await get_user_room_list(user.id)
+    etag = f'W/"{HOME_TEMPLATE_VERSION}-{user.id}-{room_list["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
     return templates.TemplateResponse("home.html", {
         "request": request,
         "user": user,
-        "rooms": rooms
-    })
+        "rooms": room_list["rooms"],
+        "rooms_etag": room_list["etag"]
+    }, headers=headers)
+
+
+@router.get("/rooms")
+async def rooms_list(
+    request: Request,
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
+    session: AsyncSession = Depends(get_session)
+):
+    # Лёгкий JSON со списками комнат для обновления главной страницы без перерисовки
+    user = await get_current_user(session_token, session)
+    if not user:
+        return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
+
+    room_list = await get_user_room_list(user.id)
+    headers = {"ETag": room_list["etag"], "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), room_list["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(room_list["body"], media_type="application/json", headers=headers)
 
 
 @router.get("/register", response_class=HTMLResponse)
@@ -59,7 +105,13 @@ async def register(
             "error": "Пароли не совпадают"
         })
     
-    user = await create_user(first_name, last_name, username, password, session)
+    try:
+        user = await create_user(first_name, last_name, username, password, session)
+    except PasswordHasherBusy:
+        return templates.TemplateResponse("register.html", {
+            "request": request,
+            "error": "Сервер перегружен, попробуйте позже"
+        }, status_code=503)
     if not user:
         return templates.TemplateResponse("register.html", {
             "request": request,
@@ -67,7 +119,7 @@ async def register(
         })
     
     response = RedirectResponse(url="/", status_code=302)
-    response.set_cookie(key="user_id", value=str(user.id), httponly=True)
+    set_session_cookie(response, user)
     return response
 
 
@@ -83,7 +135,13 @@ async def login(
     password: str = Form(...),
     session: AsyncSession = Depends(get_session)
 ):
-    user = await authenticate_user(username, password, session)
+    try:
+        user = await authenticate_user(username, password, session)
+    except PasswordHasherBusy:
+        return templates.TemplateResponse("login.html", {
+            "request": request,
+            "error": "Сервер перегружен, попробуйте позже"
+        }, status_code=503)
     if not user:
         return templates.TemplateResponse("login.html", {
             "request": request,
@@ -91,28 +149,30 @@ async def login(
         })
     
     response = RedirectResponse(url="/", status_code=302)
-    response.set_cookie(key="user_id", value=str(user.id), httponly=True)
+    set_session_cookie(response, user)
     return response
 
 
 @router.get("/logout")
 async def logout():
     response = RedirectResponse(url="/login", status_code=302)
-    response.delete_cookie(key="user_id")
+    response.delete_cookie(key=SESSION_COOKIE)
     return response
 
 
 @router.post("/create_room")
 async def create_room_endpoint(
     room_name: str = Form(...),
-    user_id: Optional[str] = Cookie(None),
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
     session: AsyncSession = Depends(get_session)
 ):
-    user = await get_current_user(user_id, session)
+    user = await get_current_user(session_token, session)
     if not user:
         return RedirectResponse(url="/login", status_code=302)
     
-    await create_room(room_name, user.id, session)
+    room = await create_room(room_name, user.id, session)
+    if room:
+        await manager.access_changed(room.id, user.id)
     return RedirectResponse(url="/", status_code=302)
 
 
@@ -120,10 +180,10 @@ async def create_room_endpoint(
 async def join_room(
     request: Request,
     room_id: int = Form(...),
-    user_id: Optional[str] = Cookie(None),
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
     session: AsyncSession = Depends(get_session)
 ):
-    user = await get_current_user(user_id, session)
+    user = await get_current_user(session_token, session)
     if not user:
         return RedirectResponse(url="/login", status_code=302)
     
@@ -149,14 +209,16 @@ async def join_room(
 async def invite_user(
     room_id: int = Form(...),
     username: str = Form(...),
-    user_id: Optional[str] = Cookie(None),
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
     session: AsyncSession = Depends(get_session)
 ):
-    user = await get_current_user(user_id, session)
+    user = await get_current_user(session_token, session)
     if not user:
         return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
     
     result = await invite_user_to_room(room_id, username, user.id, session)
+    if result["success"]:
+        await manager.access_changed(room_id, result["user_id"])
     return JSONResponse(result)
 
 
@@ -164,24 +226,46 @@ async def invite_user(
 async def remove_member(
     room_id: int = Form(...),
     member_id: int = Form(...),
-    user_id: Optional[str] = Cookie(None),
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
     session: AsyncSession = Depends(get_session)
 ):
-    user = await get_current_user(user_id, session)
+    user = await get_current_user(session_token, session)
     if not user:
         return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
     
     result = await remove_user_from_room(room_id, member_id, user.id, session)
+    if result["success"]:
+        # Отзыв доступа действует сразу: выкидываем уже подключённый сокет (в любом воркере)
+        await manager.access_changed(room_id, member_id, revoked=True)
+    return JSONResponse(result)
+
+
+@router.post("/room_retention")
+async def room_retention(
+    room_id: int = Form(...),
+    max_age_days: Optional[int] = Form(None),
+    max_messages: Optional[int] = Form(None),
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
+    session: AsyncSession = Depends(get_session)
+):
+    user = await get_current_user(session_token, session)
+    if not user:
+        return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
+
+    # Применяется при следующем проходе фоновой задачи хранения (retention_interval)
+    result = await set_room_retention(room_id, user.id, max_age_days, max_messages, session)
     return JSONResponse(result)
 
 
 @router.get("/room/{room_id}/members")
 async def get_members(
     room_id: int,
-    user_id: Optional[str] = Cookie(None),
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None,
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
     session: AsyncSession = Depends(get_session)
 ):
-    user = await get_current_user(user_id, session)
+    user = await get_current_user(session_token, session)
     if not user:
         return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
     
@@ -189,5 +273,79 @@ async def get_members(
     if not has_access:
         return JSONResponse({"success": False, "error": "Нет доступа"}, status_code=403)
     
+    if limit is not None:
+        # Постраничный вариант для больших комнат
+        page = await get_room_members_page(room_id, session, after_id=after_id, limit=max(1, min(limit, settings.members_max_page_size)))
+        return JSONResponse({"success": True, **page})
+    
     members = await get_room_members(room_id, session)
     return JSONResponse({"success": True, "members": members})
+
+
+@router.get("/room/{room_id}/online")
+async def get_online(
+    room_id: int,
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
+    session: AsyncSession = Depends(get_session)
+):
+    user = await get_current_user(session_token, session)
+    if not user:
+        return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
+    
+    has_access = await check_user_access_to_room(room_id, user.id, session)
+    if not has_access:
+        return JSONResponse({"success": False, "error": "Нет доступа"}, status_code=403)
+    
+    # Из памяти трекера присутствия, без запросов к БД
+    return JSONResponse({"success": True, "online": manager.presence.online_users(room_id)})
+
+
+@router.get("/room/{room_id}/history")
+async def get_history(
+    room_id: int,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    protocol: str = LEGACY.name,
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
+    session: AsyncSession = Depends(get_session)
+):
+    user = await get_current_user(session_token, session)
+    if not user:
+        return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
+    
+    # Формат сообщений — как в кадрах WebSocket выбранной версии протокола (ответ всегда JSON)
+    if protocol not in SUPPORTED:
+        return JSONResponse({"success": False, "error": "Неизвестный протокол"}, status_code=400)
+    
+    has_access = await check_user_access_to_room(room_id, user.id, session)
+    if not has_access:
+        return JSONResponse({"success": False, "error": "Нет доступа"}, status_code=403)
+    
+    page = await get_history_page(room_id, user.id, before_id=before_id, limit=limit, protocol=SUPPORTED[protocol])
+    return JSONResponse({"success": True, **page})
+
+
+@router.get("/room/{room_id}/search")
+async def search_room(
+    room_id: int,
+    q: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    protocol: str = LEGACY.name,
+    session_token: Optional[str] = Cookie(None, alias=SESSION_COOKIE),
+    session: AsyncSession = Depends(get_session)
+):
+    user = await get_current_user(session_token, session)
+    if not user:
+        return JSONResponse({"success": False, "error": "Не авторизован"}, status_code=401)
+    
+    if protocol not in SUPPORTED:
+        return JSONResponse({"success": False, "error": "Неизвестный протокол"}, status_code=400)
+    
+    has_access = await check_user_access_to_room(room_id, user.id, session)
+    if not has_access:
+        return JSONResponse({"success": False, "error": "Нет доступа"}, status_code=403)
+    
+    # Результаты по релевантности (bm25 в SQLite, ts_rank в PostgreSQL)
+    page = await search_history(room_id, user.id, q, offset=offset, limit=limit, protocol=SUPPORTED[protocol])
+    return JSONResponse({"success": True, **page})
@@ -1,76 +1,485 @@
+import asyncio
+import itertools
+import time
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import Dict
-from datetime import datetime
-from app.database import save_message, get_room_history, get_session
-from app.user_repo import check_user_access_to_room
+from typing import Dict, List, Optional, Set, Tuple
+from app.broker import Broker, create_broker
+from app.connection import ClientConnection
+from app.config import settings
+from app.database import get_session
+from app.history import HistoryEntry, get_history_frame, get_resync_page, history_buffer
+from app.lifecycle import ConnectionLifecycle
+from app.metrics import REGISTRY, Counter, Histogram
+from app.persistence import message_writer
+from app.presence import PresenceTracker
+from app.protocol import LEGACY, Protocol, clock_time, negotiate, now_ms
+from app.ratelimit import DISCONNECT, RateLimiter
+from app.rooms import RoomConnections, RoomRegistry
+from app.sessions import SESSION_COOKIE, read_token
+from app.user_repo import check_user_access_to_room, invalidate_room_access, invalidate_user_rooms
+
+
+# Время постановки одного события (или пачки) в очереди всех соединений комнаты и число получателей
+FANOUT_SECONDS = Histogram(
+    "chat_broadcast_fanout_seconds", "Time to encode and enqueue a room event for all local connections", ["kind"]
+)
+FANOUT_RECIPIENTS = Histogram(
+    "chat_broadcast_fanout_recipients", "Local connections per delivered room event",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+)
+MESSAGES_RECEIVED = Counter("chat_messages_received", "Chat messages received from WebSocket clients").labels()
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, Dict[int, WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, room_id: int, user_id: int):
-        await websocket.accept()
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = {}
-        self.active_connections[room_id][user_id] = websocket
-
-    def disconnect(self, room_id: int, user_id: int):
-        if room_id in self.active_connections and user_id in self.active_connections[room_id]:
-            del self.active_connections[room_id][user_id]
-            if not self.active_connections[room_id]:
-                # Удаляем комнату, если она пустая
-                del self.active_connections[room_id]
-
-    async def broadcast(self, message: str, room_id: int, sender_id: int, username: str, save_to_db: bool = True):
-        if room_id in self.active_connections:
-            timestamp = datetime.now().strftime("%H:%M")
-            
-            if save_to_db:
-                await save_message(room_id, sender_id, username, message, timestamp)
-            
-            for user_id, connection in self.active_connections[room_id].items():
-                message_with_class = {
-                    "text": message,
-                    "is_self": user_id == sender_id,
-                    "timestamp": timestamp
-                }
-                await connection.send_json(message_with_class)
-    
-    async def send_history(self, websocket: WebSocket, room_id: int, user_id: int):
-        history = await get_room_history(room_id)
-        for msg in history:
-            message_with_class = {
-                "text": msg["message"],
-                "is_self": msg["user_id"] == user_id,
-                "timestamp": msg["timestamp"]
-            }
-            await websocket.send_json(message_with_class)
+    def __init__(self, broker: Optional[Broker] = None):
+        # У пользователя может быть несколько соединений с комнатой (вкладки)
+        self.rooms = RoomRegistry()
+        # События комнат идут через брокер, чтобы их получили соединения во всех воркерах
+        self.broker = broker or create_broker()
+        self.broker.handler = self._on_event
+        self.presence = PresenceTracker()
+        self.presence.node_id = self.broker.node_id
+        self.presence.publish = self.broker.publish
+        self.presence.on_change = self._on_presence_change
+        self.lifecycle = ConnectionLifecycle(self._all_connections)
+        self.rate_limiter = RateLimiter()
+        # Склейка кадров; её состояние хранится в RoomConnections каждой комнаты
+        self.coalesce_window = settings.coalesce_window
+        self.coalesce_max_batch = settings.coalesce_max_batch
+        # Задачи публикации из колбэков писателя БД и подтверждения записи (ref -> id) по комнатам,
+        # которые уйдут одним событием на пакет
+        self._publishing: Set[asyncio.Task] = set()
+        self._confirmations: Dict[int, Dict[str, int]] = {}
+        self._refs = itertools.count(1)
+        self.frames_sent = 0
+        self.batches_sent = 0
+
+    async def start(self):
+        await self.broker.start()
+        await self.presence.sync()
+        self.lifecycle.start()
+
+    async def stop(self):
+        await self.lifecycle.stop()
+        await self.presence.stop()
+        await self.broker.stop()
+        for room in self.rooms.rooms():
+            self._flush_room(room)
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        room_id: int,
+        user_id: int,
+        username: str,
+        protocol: Protocol = LEGACY
+    ) -> ClientConnection:
+        # Подпротокол подтверждаем, только если клиент его запрашивал
+        if websocket.scope.get("subprotocols"):
+            await websocket.accept(subprotocol=protocol.name)
+        else:
+            await websocket.accept()
+        connection = ClientConnection(websocket, room_id, user_id, protocol, on_close=self._on_connection_closed)
+        self.rooms.join(connection)
+        self.lifecycle.opened(connection)
+        await self.presence.connection_opened(room_id, user_id, username)
+        return connection
+
+    def disconnect(self, connection: ClientConnection):
+        # Рассылки, уже идущие по снимку комнаты, закрытое соединение пропустит само (enqueue вернёт False)
+        room = self.rooms.leave(connection)
+        if room is None:
+            return
+        connection.close()
+        self.lifecycle.closed(connection)
+        self.presence.connection_closed(connection.room_id, connection.user_id)
+        if not room:
+            # Комната опустела и удалена из реестра вместе с её состоянием
+            self.rate_limiter.forget_room(connection.room_id)
+
+    def _all_connections(self):
+        return self.rooms.connections()
+
+    def kick(self, room_id: int, user_id: int, reason: str = "Access revoked"):
+        # Закрываем все сокеты пользователя, у которого отозвали доступ к комнате
+        for connection in self.rooms.snapshot(room_id):
+            if connection.user_id == user_id:
+                connection.close(code=1008, reason=reason)
+
+    async def access_changed(self, room_id: int, user_id: Optional[int] = None, revoked: bool = False):
+        # Сбрасываем кэши доступа и списка комнат во всех воркерах; при отзыве — отключаем пользователя
+        await self.broker.publish({"type": "access", "room_id": room_id, "user_id": user_id, "revoked": revoked})
+
+    def _on_connection_closed(self, connection: ClientConnection):
+        self.disconnect(connection)
+
+    async def broadcast(
+        self,
+        body: str,
+        room_id: int,
+        sender_id: int,
+        username: str,
+        save_to_db: bool = True,
+        system: bool = False
+    ):
+        ts = now_ms()
+        event = {
+            "type": "message",
+            "room_id": room_id,
+            "id": None,
+            "sender_id": sender_id,
+            "sender": username,
+            "body": body,
+            "system": system,
+            "timestamp": clock_time(ts),
+            "ts": ts,
+            "saved": save_to_db
+        }
+        if not save_to_db:
+            await self.broker.publish(event)
+            return
+
+        entry = self._history_entry(event)
+
+        if settings.persist_mode == "durable":
+            # Отправитель ждёт записи пакета, комната и буфер истории получают сообщение уже с id из БД
+            # (и не получают, если запись не удалась). Пакеты пишутся по порядку, поэтому и публикуются
+            # сообщения в порядке id
+            def on_durable(message_id: Optional[int]):
+                if message_id is not None:
+                    entry.set_id(message_id)
+                    history_buffer.append(room_id, entry)
+                    event["id"] = message_id
+                    self._publish_later(event)
+
+            await message_writer.save(room_id, sender_id, username, body, ts, wait=True, on_saved=on_durable)
+            return
+
+        # write_behind: рассылаем сразу, не дожидаясь пакета (задержка доставки не зависит от записи в БД).
+        # id приходит следом кадром saved, который связывает его с сообщением по ref
+        ref = event["ref"] = f"{self.broker.node_id}.{next(self._refs)}"
+        history_buffer.append(room_id, entry)
+        await self.broker.publish(event)
+
+        def on_saved(message_id: Optional[int]):
+            history_buffer.saved(room_id, entry, message_id)
+            self._confirm(room_id, ref, message_id)
+
+        await message_writer.save(room_id, sender_id, username, body, ts, on_saved=on_saved)
+
+    @staticmethod
+    def _history_entry(event: Dict) -> HistoryEntry:
+        # Сообщение для буфера истории; по ref другие воркеры находят его, когда придёт подтверждение записи
+        return HistoryEntry({
+            "id": event["id"],
+            "sender_id": event["sender_id"],
+            "sender": event["sender"],
+            "body": event["body"],
+            "timestamp": event["timestamp"],
+            "ts": event["ts"],
+            "ref": event.get("ref")
+        })
+
+    def _publish_later(self, event: Dict):
+        # Публикация из синхронного колбэка писателя
+        task = asyncio.create_task(self.broker.publish(event))
+        self._publishing.add(task)
+        task.add_done_callback(self._publishing.discard)
+
+    def _confirm(self, room_id: int, ref: str, message_id: Optional[int]):
+        # Писатель вызывает on_saved подряд для всех строк пакета: подтверждения собираются по комнатам
+        # и публикуются одним событием сразу после пакета, а не кадром на каждое сообщение.
+        # Незаписанные (None) тоже публикуются: другие воркеры уберут их из своих буферов истории
+        if not self._confirmations:
+            asyncio.get_running_loop().call_soon(self._publish_confirmations)
+        self._confirmations.setdefault(room_id, {})[ref] = message_id
+
+    def _publish_confirmations(self):
+        confirmations, self._confirmations = self._confirmations, {}
+        for room_id, results in confirmations.items():
+            self._publish_later({
+                "type": "saved",
+                "room_id": room_id,
+                "ids": {ref: message_id for ref, message_id in results.items() if message_id is not None},
+                "failed": [ref for ref, message_id in results.items() if message_id is None]
+            })
+
+    def _on_event(self, event: Dict):
+        if event["type"] == "presence_sync":
+            if not self.broker.is_local(event):
+                self.presence.announce()
+            return
+        room_id = event["room_id"]
+        if event["type"] == "presence":
+            self.presence.apply(event)
+        elif event["type"] == "access":
+            if not self.broker.is_local(event):
+                invalidate_room_access(room_id, event["user_id"])
+                invalidate_user_rooms(event["user_id"])
+            if event["revoked"]:
+                self.kick(room_id, event["user_id"])
+        elif event["type"] == "message":
+            if event["saved"] and not self.broker.is_local(event):
+                # Сообщение другого воркера — в локальный буфер истории. В write_behind оно разослано до записи:
+                # id (или отказ) придёт событием saved, а до тех пор буфер не отдаёт его подключившимся
+                history_buffer.append(room_id, self._history_entry(event))
+            self.deliver(event)
+        elif event["type"] == "saved":
+            if not self.broker.is_local(event):
+                history_buffer.confirm(room_id, event["ids"], event["failed"])
+            self.deliver_saved(event)
+
+    def deliver(self, event: Dict):
+        room = self.rooms.get(event["room_id"])
+        if room is None:
+            return
+        if self.coalesce_window <= 0:
+            self._send_event(room, event)
+            return
+
+        if room.pending is not None:
+            room.pending.append(event)
+            if len(room.pending) >= self.coalesce_max_batch:
+                self._flush_room(room)
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if room.last_delivery is not None and now - room.last_delivery < self.coalesce_window:
+            # Комната оживлённая: копим события до конца окна, задержка не больше coalesce_window
+            room.pending = [event]
+            room.flush_handle = loop.call_later(self.coalesce_window, self._flush_room, room)
+            return
+        # Первое сообщение после паузы уходит сразу
+        room.last_delivery = now
+        self._send_event(room, event)
+
+    def _flush_room(self, room: RoomConnections):
+        events = room.cancel_flush()
+        if not events:
+            return
+        room.last_delivery = asyncio.get_running_loop().time()
+        if len(events) == 1:
+            self._send_event(room, events[0])
+        else:
+            self._send_batch(room, events)
+
+    def _send_event(self, room: RoomConnections, event: Dict):
+        connections = room.snapshot
+        if not connections:
+            return
+        started = time.perf_counter() if REGISTRY.enabled else None
+        # Кадр кодируется один раз на вариант (протокол и, для chat.v1, свой / чужой), а не для каждого получателя
+        frames = {}
+        # Только ставим кадры в очереди: отправкой занимаются задачи-писатели соединений
+        for connection in connections:
+            protocol = connection.protocol
+            key = protocol.variant(event, connection.user_id)
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = protocol.encode_message(event, connection.user_id)
+            connection.enqueue(frame, message=True)
+        self.frames_sent += len(connections)
+        if started is not None:
+            FANOUT_SECONDS.labels("event").observe(time.perf_counter() - started)
+            FANOUT_RECIPIENTS.observe(len(connections))
+
+    def _send_batch(self, room: RoomConnections, events: List[Dict]):
+        connections = room.snapshot
+        if not connections:
+            return
+        started = time.perf_counter() if REGISTRY.enabled else None
+        senders = {event["sender_id"] for event in events}
+        # Пачка кодируется один раз на вариант; массив склеивает писатель соединения
+        batches = {}
+        for connection in connections:
+            protocol = connection.protocol
+            key = protocol.batch_variant(senders, connection.user_id)
+            batch = batches.get(key)
+            if batch is None:
+                batch = batches[key] = [protocol.encode_message(event, connection.user_id) for event in events]
+            connection.enqueue(batch, message=True)
+        self.frames_sent += len(connections)
+        self.batches_sent += len(connections)
+        if started is not None:
+            FANOUT_SECONDS.labels("batch").observe(time.perf_counter() - started)
+            FANOUT_RECIPIENTS.observe(len(connections))
+
+    def deliver_saved(self, event: Dict):
+        room = self.rooms.get(event["room_id"])
+        if room is None or not event["ids"]:
+            return
+        if room.pending is not None:
+            # Подтверждение не должно обогнать сообщения, ждущие конца окна склейки
+            self._flush_room(room)
+        frames = {}
+        for connection in room.snapshot:
+            protocol = connection.protocol
+            if protocol.name not in frames:
+                frames[protocol.name] = protocol.saved(event["ids"])
+            frame = frames[protocol.name]
+            if frame is not None:
+                connection.enqueue(frame)
+
+    def _on_presence_change(self, room_id: int, joined: Dict[int, str], left: Dict[int, str]):
+        connections = self.rooms.snapshot(room_id)
+        if not connections:
+            return
+        ts = now_ms()
+        event = {"timestamp": clock_time(ts), "ts": ts}
+        # Все входы и выходы за окно — один кадр на версию протокола
+        frames = {}
+        for connection in connections:
+            protocol = connection.protocol
+            frame = frames.get(protocol.name)
+            if frame is None:
+                frame = frames[protocol.name] = protocol.presence(joined, left, event)
+            connection.enqueue(frame)
+
+    def send_online(self, connection: ClientConnection):
+        # Список онлайн для нового соединения (до запуска писателя кадр просто ждёт в очереди)
+        frame = connection.protocol.online(self.presence.online_users(connection.room_id))
+        if frame is not None:
+            connection.enqueue(frame)
+
+    async def send_history(self, connection: ClientConnection, after_id: Optional[int] = None):
+        # Последняя страница истории уходит одним кадром; более старые — через /room/{id}/history.
+        # Переподключившийся клиент (after_id — последний увиденный id) получает только пропущенное,
+        # если разрыв не больше resync_max_messages
+        frame = None
+        if after_id is not None:
+            page = await get_resync_page(connection.room_id, connection.user_id, after_id, protocol=connection.protocol)
+            if not page["has_more"]:
+                frame = connection.protocol.encode(page)
+        if frame is None:
+            frame = await get_history_frame(connection.room_id, connection.user_id, connection.protocol)
+        if isinstance(frame, bytes):
+            await connection.websocket.send_bytes(frame)
+        else:
+            await connection.websocket.send_text(frame)
 
 
 manager = ConnectionManager()
 router = APIRouter(prefix="/ws/chat")
 
 
-@router.websocket("/{room_id}/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, room_id: int, user_id: int, username: str):
+def _read_frame(protocol: Protocol, data) -> Tuple[Optional[Dict], bool, bool]:
+    # (запрос, это сообщение чата, слишком длинный). Лимит max_message_size — длина текста сообщения после
+    # разбора, одинаковая для chat.v1 и chat.v2 (конверт {"type":"message","body":...} в неё не входит).
+    # Кадр больше ws_max_size не разбирается вовсе: его не пропустил бы и сам uvicorn
+    if len(data) > settings.ws_max_size:
+        return None, False, True
+    request = protocol.decode(data)
+    is_message = request["type"] == "message" and isinstance(request.get("body"), str)
+    return request, is_message, is_message and len(request["body"]) > settings.max_message_size
+
+
+async def _admit(connection: ClientConnection, protocol: Protocol, wait: Optional[float], notify: bool = True) -> bool:
+    # Решение RateLimiter.admit: придержать чтение из сокета (клиент упирается в TCP-окно),
+    # отбросить кадр (с уведомлением, если это сообщение) или закрыть соединение
+    if wait is None:
+        if manager.rate_limiter.action == DISCONNECT:
+            connection.close(code=1008, reason="Rate limit exceeded")
+        elif notify:
+            connection.enqueue(protocol.error("rate_limited", "Слишком много сообщений, сообщение не отправлено"))
+        return False
+    if wait > 0:
+        await asyncio.sleep(wait)
+    return not connection.closed
+
+
+@router.websocket("/{room_id}")
+async def websocket_endpoint(
+    websocket: WebSocket,
+    room_id: int,
+    token: Optional[str] = None,
+    after_id: Optional[int] = None
+):
+    # Личность берётся из подписанного токена сессии (cookie или ?token=), а не из URL
+    identity = read_token(token or websocket.cookies.get(SESSION_COOKIE))
+    if identity is None:
+        await websocket.close(code=1008, reason="Not authenticated")
+        return
+    user_id, username = identity["uid"], identity["name"]
+    
     async for session in get_session():
         has_access = await check_user_access_to_room(room_id, user_id, session)
         if not has_access:
             await websocket.close(code=1008, reason="Access denied")
             return
     
-    await manager.connect(websocket, room_id, user_id)
+    protocol = negotiate(websocket.scope.get("subprotocols", []))
+    if protocol is None:
+        # Клиент не поддерживает ни одну из наших версий протокола
+        await websocket.close(code=1002, reason="Unsupported subprotocol")
+        return
     
-    # Отправляем историю сообщений при подключении
-    await manager.send_history(websocket, room_id, user_id)
+    # Лимиты соединений и нехватка памяти: отказываем до accept, не тратя ресурсы на сокет
+    rejection = manager.lifecycle.admit(user_id)
+    if rejection is not None:
+        await websocket.close(code=rejection[0], reason=rejection[1])
+        return
+    
+    # О входе и выходе комната узнаёт от трекера присутствия (с задержкой и пачками)
+    connection = await manager.connect(websocket, room_id, user_id, username, protocol)
+    
+    # Отправляем историю сообщений при подключении, а уже затем запускаем писателя:
+    # сообщения, пришедшие за это время, дождутся своей очереди
+    try:
+        await manager.send_history(connection, after_id)
+    except Exception:
+        manager.disconnect(connection)
+        return
+    manager.send_online(connection)
+    connection.start()
+    limiter = manager.rate_limiter
+    bucket = limiter.connection_bucket()
     
-    # Уведомляем о присоединении (без сохранения системных сообщений)
-    await manager.broadcast(f"{username} (ID: {user_id}) присоединился к чату.", room_id, user_id, username, save_to_db=False)
     try:
-        while True:
-            data = await websocket.receive_text()
-            await manager.broadcast(f"{username} (ID: {user_id}): {data}", room_id, user_id, username)
-    except WebSocketDisconnect:
-        manager.disconnect(room_id, user_id)
-        await manager.broadcast(f"{username} (ID: {user_id}) покинул чат.", room_id, user_id, username, save_to_db=False)
+        # Соединение может закрыть и сервер (медленный клиент, молчание, отзыв доступа, флуд)
+        while not connection.closed:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect" or connection.closed:
+                break
+            connection.touch()
+            data = message.get("text")
+            if data is None:
+                data = message.get("bytes", b"")
+            request, is_message, oversized = _read_frame(protocol, data)
+            if is_message:
+                MESSAGES_RECEIVED.inc()
+            # Лимит соединения расходует любой кадр (ping, resync, неизвестные типы, слишком длинные),
+            # лимит комнаты — только рассылаемые сообщения; о пропуске служебных кадров клиент не уведомляется
+            wait = limiter.admit(room_id if is_message and not oversized else None, bucket)
+            if not await _admit(connection, protocol, wait, notify=is_message):
+                continue
+            if oversized:
+                limiter.refuse_size()
+                if limiter.action == DISCONNECT:
+                    connection.close(code=1009, reason="Message too big")
+                    break
+                connection.enqueue(protocol.error(
+                    "message_too_big", f"Сообщение длиннее {settings.max_message_size} символов не отправлено",
+                    max_size=settings.max_message_size
+                ))
+                continue
+            if is_message:
+                try:
+                    await manager.broadcast(request["body"], room_id, user_id, username)
+                except Exception:
+                    # durable: пакет с сообщением не записан в БД (ошибку пишет в журнал писатель);
+                    # соединение остаётся, клиент узнаёт, что сообщение не отправлено
+                    connection.enqueue(protocol.error("not_saved", "Сообщение не сохранено, попробуйте ещё раз"))
+            elif request["type"] == "ping":
+                connection.enqueue(protocol.encode({"type": "pong"}))
+            elif request["type"] == "resync" and isinstance(request.get("after_id"), int):
+                limit = request.get("limit")
+                page = await get_resync_page(
+                    room_id, user_id, request["after_id"],
+                    limit=limit if isinstance(limit, int) else None, protocol=protocol
+                )
+                connection.enqueue(protocol.encode(page))
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        manager.disconnect(connection)
@@ -0,0 +1,92 @@
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.config import settings
+
+
+# Архив сообщений, вынесенных из БД политикой хранения: для каждой комнаты каталог
+# room_<id> с сегментами <first_id>-<last_id>.jsonl.gz (одна строка JSON на сообщение).
+# Повтор после сбоя (сегмент записан, строки ещё не удалены) заменяет сегмент с тем же first_id.
+class MessageArchive:
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or settings.archive_dir
+
+    def _room_dir(self, room_id: int) -> str:
+        return os.path.join(self.root, f"room_{room_id}")
+
+    def segments(self, room_id: int) -> List[Tuple[int, int, str]]:
+        # (first_id, last_id, путь) по возрастанию id
+        room_dir = self._room_dir(room_id)
+        try:
+            names = os.listdir(room_dir)
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in names:
+            if not name.endswith(".jsonl.gz"):
+                continue
+            first, _, last = name[:-len(".jsonl.gz")].partition("-")
+            result.append((int(first), int(last), os.path.join(room_dir, name)))
+        result.sort()
+        return result
+
+    def write_segment(self, room_id: int, rows: List[Dict]) -> str:
+        room_dir = self._room_dir(room_id)
+        os.makedirs(room_dir, exist_ok=True)
+        path = os.path.join(room_dir, f"{rows[0]['id']:012d}-{rows[-1]['id']:012d}.jsonl.gz")
+        tmp_path = path + ".tmp"
+        lines = "".join(
+            json.dumps({
+                **row,
+                "created_at": row["created_at"].isoformat() if row["created_at"] else None
+            }, ensure_ascii=False) + "\n"
+            for row in rows
+        )
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as segment:
+                segment.write(lines.encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+        # Строки удаляются из БД только после того, как сегмент целиком на диске
+        os.replace(tmp_path, path)
+        for first_id, _, other in self.segments(room_id):
+            if first_id == rows[0]["id"] and other != path:
+                os.unlink(other)
+        return path
+
+    def _read_segment(self, path: str) -> List[Dict]:
+        with gzip.open(path, "rt", encoding="utf-8") as segment:
+            rows = [json.loads(line) for line in segment]
+        for row in rows:
+            if row["created_at"]:
+                row["created_at"] = datetime.fromisoformat(row["created_at"])
+            if "ts" not in row:
+                # Сегменты, записанные до миграции 0005, хранят только "ЧЧ:ММ"
+                row.pop("timestamp", None)
+                row["ts"] = int(row["created_at"].replace(tzinfo=timezone.utc).timestamp() * 1000) if row["created_at"] else 0
+        return rows
+
+    def iter_segments(self, room_id: int) -> Iterator[List[Dict]]:
+        # Весь архив комнаты по сегменту за раз, по возрастанию id (выгрузка истории)
+        for _, _, path in self.segments(room_id):
+            yield self._read_segment(path)
+
+    def has_older(self, room_id: int, before_id: Optional[int]) -> bool:
+        return any(before_id is None or first_id < before_id for first_id, _, _ in self.segments(room_id))
+
+    def read_before(self, room_id: int, before_id: Optional[int], limit: int) -> List[Dict]:
+        # Последние limit архивных сообщений комнаты старше before_id, в хронологическом порядке
+        collected: List[Dict] = []
+        for first_id, _, path in reversed(self.segments(room_id)):
+            if before_id is not None and first_id >= before_id:
+                continue
+            rows = [row for row in self._read_segment(path) if before_id is None or row["id"] < before_id]
+            collected = rows + collected
+            if len(collected) >= limit:
+                break
+        return collected[-limit:] if limit else []
+
+
+message_archive = MessageArchive()
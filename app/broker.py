@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+from app.config import settings
+from app.encoding import encode_json
+from app.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[Dict], None]
+
+DROPPED_EVENTS = Counter(
+    "chat_broker_dropped_events", "Events dropped from full queues to other workers (unix broker)"
+).labels()
+
+
+# Брокер рассылает события комнат (сообщения, отзыв доступа) всем процессам приложения.
+# Каждый процесс доставляет событие своим локальным соединениям через handler.
+class Broker:
+    def __init__(self):
+        # Идентификатор процесса: по полю origin обработчик отличает свои события от чужих
+        self.node_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.handler: Optional[EventHandler] = None
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: Dict):
+        raise NotImplementedError
+
+    def is_local(self, event: Dict) -> bool:
+        return event.get("origin") == self.node_id
+
+    def _deliver(self, event: Dict):
+        if self.handler is None:
+            return
+        try:
+            self.handler(event)
+        except Exception:
+            logger.exception("Failed to handle broker event %s", event.get("type"))
+
+
+# Один процесс (uvicorn без --workers): событие сразу доставляется обработчику
+class MemoryBroker(Broker):
+    async def publish(self, event: Dict):
+        event["origin"] = self.node_id
+        self._deliver(event)
+
+
+# Соединение с другим воркером: ограниченная очередь строк и задача-писатель, как у ClientConnection.
+# Публикация только кладёт строку в очередь, поэтому зависший воркер не задерживает отправителя
+# и доставку остальным; если он не успевает читать, теряются самые старые события.
+class _PeerWriter:
+    def __init__(self, path: str, queue_size: int, on_close: Callable[["_PeerWriter"], None]):
+        self.path = path
+        self.queue_size = queue_size
+        self.on_close = on_close
+        self.closed = False
+        self._queue: Deque[bytes] = deque()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, line: bytes):
+        if self.closed:
+            return
+        if len(self._queue) >= self.queue_size:
+            self._queue.popleft()
+            DROPPED_EVENTS.inc()
+        self._queue.append(line)
+        self._wakeup.set()
+
+    async def _run(self):
+        try:
+            _, writer = await asyncio.open_unix_connection(self.path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Сокет остался от завершившегося процесса
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.close()
+            return
+        except OSError:
+            logger.warning("Failed to connect to broker peer %s", self.path, exc_info=True)
+            self.close()
+            return
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                # Всё накопленное — одной записью; пока drain ждёт воркер, новые события копятся в очереди
+                lines = list(self._queue)
+                self._queue.clear()
+                writer.write(b"".join(lines))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        self.on_close(self)
+
+
+# Несколько воркеров на одной машине без внешних сервисов: каждый процесс слушает свой
+# Unix-сокет в общем каталоге и рассылает события остальным строками JSON.
+# Список воркеров кэшируется: каталог перечитывается раз в broker_refresh_interval
+# и сразу, когда к нам подключается новый воркер.
+class UnixSocketBroker(Broker):
+    def __init__(self, socket_dir: Optional[str] = None):
+        super().__init__()
+        self.socket_dir = socket_dir or settings.broker_socket_dir
+        self.socket_path = os.path.join(self.socket_dir, f"{self.node_id}.sock")
+        self.queue_size = settings.broker_peer_queue_size
+        self.refresh_interval = settings.broker_refresh_interval
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[str, _PeerWriter] = {}
+        self._readers = set()
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self._server = await asyncio.start_unix_server(self._handle_peer, path=self.socket_path, limit=2 ** 20)
+        self.refresh()
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for task in list(self._readers):
+            task.cancel()
+        for peer in list(self._peers.values()):
+            peer.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def refresh(self):
+        # Сверяем кэш с каталогом: новые сокеты — новые воркеры, пропавшие — завершившиеся
+        try:
+            names = os.listdir(self.socket_dir)
+        except FileNotFoundError:
+            names = []
+        paths = {os.path.join(self.socket_dir, name) for name in names if name.endswith(".sock")}
+        paths.discard(self.socket_path)
+        for path in paths - self._peers.keys():
+            self._peers[path] = _PeerWriter(path, self.queue_size, self._peer_closed)
+        for path in self._peers.keys() - paths:
+            self._peers[path].close()
+
+    def _peer_closed(self, peer: _PeerWriter):
+        if self._peers.get(peer.path) is peer:
+            del self._peers[peer.path]
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            self.refresh()
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._readers.add(task)
+        # Подключился воркер, которого может ещё не быть в кэше
+        self.refresh()
+        try:
+            while line := await reader.readline():
+                self._deliver(json.loads(line))
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._readers.discard(task)
+            writer.close()
+
+    async def publish(self, event: Dict):
+        event["origin"] = self.node_id
+        self._deliver(event)
+        if self._server is None:
+            return
+
+        line = (encode_json(event) + "\n").encode()
+        for peer in list(self._peers.values()):
+            peer.enqueue(line)
+
+
+# Несколько машин: адаптер к Redis pub/sub (нужен пакет redis)
+class RedisBroker(Broker):
+    channel = "chat:events"
+
+    def __init__(self, url: Optional[str] = None):
+        super().__init__()
+        self.url = url or settings.broker_redis_url
+        self._redis = None
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            import redis.asyncio as redis
+        except ImportError as exc:
+            raise RuntimeError("CHAT_BROKER=redis requires the 'redis' package") from exc
+        self._redis = redis.from_url(self.url)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    async def _listen(self):
+        async for message in self._pubsub.listen():
+            if message["type"] == "message":
+                self._deliver(json.loads(message["data"]))
+
+    async def publish(self, event: Dict):
+        event["origin"] = self.node_id
+        if self._redis is None:
+            self._deliver(event)
+            return
+        # Своё событие тоже приходит через подписку — порядок доставки одинаков для всех процессов
+        await self._redis.publish(self.channel, encode_json(event))
+
+
+BROKERS = {
+    "memory": MemoryBroker,
+    "unix": UnixSocketBroker,
+    "redis": RedisBroker,
+}
+
+
+def create_broker(name: Optional[str] = None) -> Broker:
+    return BROKERS[name or settings.broker]()
@@ -0,0 +1,468 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import re
+import sys
+import time
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import aliased
+from app.archive import message_archive
+from app.config import settings
+from app.database import AsyncSessionLocal, ReadSessionLocal, engine, get_messages_after, init_db
+from app.models import Room, RoomMember, User
+from app.passwords import SCHEME, PasswordHasher
+from app.user_repo import invalidate_room_access, invalidate_user_rooms
+
+KINDS = ("users", "rooms", "memberships")
+FORMATS = ("csv", "jsonl")
+# Сколько ошибок разбора попадает в отчёт (остальные только считаются)
+MAX_ERROR_SAMPLES = 20
+# Несолёный SHA-256 старых аккаунтов (см. app/passwords.py)
+LEGACY_HASH = re.compile(r"[0-9a-f]{64}")
+
+EXPORT_FIELDS = {
+    "users": ["id", "username", "first_name", "last_name", "password_hash", "created_at"],
+    "rooms": ["id", "name", "owner", "created_at", "retention_days", "retention_messages"],
+    "memberships": ["room_id", "room", "owner", "username", "created_at"],
+    "history": ["id", "room_id", "user_id", "username", "message", "ts", "created_at"],
+}
+
+
+# Массовый импорт пользователей, комнат и участников из CSV / JSONL и потоковая выгрузка.
+# Файл читается пачками по bulk_batch_size строк: на пачку — один запрос для поиска связанных
+# пользователей и комнат и один многострочный INSERT ... ON CONFLICT DO NOTHING в своей транзакции,
+# так что память не зависит от размера файла, а повторный импорт того же файла ничего не дублирует.
+class ImportStats:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.rows = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.errors = 0
+        self.error_samples: List[str] = []
+        self.started = time.monotonic()
+
+    def error(self, line: int, message: str):
+        self.errors += 1
+        if len(self.error_samples) < MAX_ERROR_SAMPLES:
+            self.error_samples.append(f"line {line}: {message}")
+
+    def as_dict(self) -> Dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "kind": self.kind,
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "rows_per_s": round(self.rows / elapsed, 1) if elapsed else 0.0,
+            "error_samples": self.error_samples,
+        }
+
+    def __str__(self) -> str:
+        data = self.as_dict()
+        return (f"{self.kind}: {self.rows} rows, {self.inserted} inserted, {self.skipped} skipped, "
+                f"{self.errors} errors ({data['rows_per_s']:.0f} rows/s)")
+
+
+def detect_format(path: str, fmt: Optional[str] = None) -> str:
+    if fmt:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def read_records(stream: TextIO, fmt: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    # (номер строки, запись, ошибка разбора)
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield number, None, f"invalid JSON: {exc}"
+            continue
+        if not isinstance(record, dict):
+            yield number, None, "expected a JSON object"
+            continue
+        yield number, record, None
+
+
+def _field(record: Dict, name: str) -> Optional[str]:
+    # Пустая ячейка CSV и отсутствующий ключ JSON — одно и то же
+    value = record.get(name)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _int_field(record: Dict, name: str) -> Optional[int]:
+    value = _field(record, name)
+    return int(value) if value is not None else None
+
+
+def _insert(model):
+    # INSERT ... ON CONFLICT DO NOTHING есть только в диалектных конструкциях
+    dialect = postgresql if engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
+
+
+async def _user_ids(session, usernames: Set[str]) -> Dict[str, int]:
+    if not usernames:
+        return {}
+    result = await session.execute(select(User.username, User.id).where(User.username.in_(usernames)))
+    return dict(result.all())
+
+
+async def _import_users(batch: List[Tuple[int, Dict]], stats: ImportStats, hasher: PasswordHasher) -> Set[int]:
+    rows = []
+    to_hash = []
+    for line, record in batch:
+        username, first_name, last_name = (_field(record, name) for name in ("username", "first_name", "last_name"))
+        if not (username and first_name and last_name):
+            stats.error(line, "username, first_name and last_name are required")
+            continue
+        password_hash, password = _field(record, "password_hash"), _field(record, "password")
+        if password_hash is not None:
+            # Хэши переносятся как есть, поэтому принимаются только форматы, которые понимает вход
+            if not (password_hash.startswith(SCHEME + "$") or LEGACY_HASH.fullmatch(password_hash)):
+                stats.error(line, "unsupported password_hash format")
+                continue
+        elif password is None:
+            stats.error(line, "password or password_hash is required")
+            continue
+        row = {"username": username, "first_name": first_name, "last_name": last_name, "password_hash": password_hash}
+        if password_hash is None:
+            to_hash.append((row, password))
+        rows.append(row)
+    if to_hash:
+        # scrypt на каждую строку — самая медленная часть импорта с открытыми паролями
+        hashes = await asyncio.gather(*(hasher.hash(password) for _, password in to_hash))
+        for (row, _), password_hash in zip(to_hash, hashes):
+            row["password_hash"] = password_hash
+    if not rows:
+        return set()
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            _insert(User).on_conflict_do_nothing(index_elements=["username"]).returning(User.id), rows
+        )
+        inserted = len(result.all())
+        await session.commit()
+    stats.inserted += inserted
+    stats.skipped += len(rows) - inserted
+    return set()
+
+
+async def _import_rooms(batch: List[Tuple[int, Dict]], stats: ImportStats, hasher: PasswordHasher) -> Set[int]:
+    parsed = []
+    for line, record in batch:
+        name, owner = _field(record, "name"), _field(record, "owner")
+        if not (name and owner):
+            stats.error(line, "name and owner are required")
+            continue
+        try:
+            retention = (_int_field(record, "retention_days"), _int_field(record, "retention_messages"))
+        except ValueError:
+            stats.error(line, "retention_days and retention_messages must be integers")
+            continue
+        parsed.append((line, name, owner, retention))
+
+    async with AsyncSessionLocal() as session:
+        owners = await _user_ids(session, {owner for _, _, owner, _ in parsed})
+        # Названия комнат уникальны, как в create_room (уникального ключа в схеме нет): повтором считается
+        # название, которое уже есть в БД или встретилось выше в файле, чей бы ни была комната
+        existing = set()
+        if parsed:
+            result = await session.execute(select(Room.name).where(Room.name.in_({name for _, name, _, _ in parsed})))
+            existing = set(result.scalars().all())
+        rows = []
+        for line, name, owner, (retention_days, retention_messages) in parsed:
+            owner_id = owners.get(owner)
+            if owner_id is None:
+                stats.error(line, f"owner {owner!r} not found")
+            elif name in existing:
+                stats.skipped += 1
+            else:
+                existing.add(name)
+                rows.append({"name": name, "owner_id": owner_id,
+                             "retention_days": retention_days, "retention_messages": retention_messages})
+        if rows:
+            result = await session.execute(_insert(Room).returning(Room.id), rows)
+            room_ids = set(result.scalars().all())
+            await session.commit()
+        else:
+            room_ids = set()
+    stats.inserted += len(rows)
+    for owner_id in {row["owner_id"] for row in rows}:
+        invalidate_user_rooms(owner_id)
+    return room_ids
+
+
+async def _import_memberships(batch: List[Tuple[int, Dict]], stats: ImportStats, hasher: PasswordHasher) -> Set[int]:
+    # Комната задаётся парой room + owner (как в выгрузке) или room_id
+    parsed = []
+    for line, record in batch:
+        username, room, owner = _field(record, "username"), _field(record, "room"), _field(record, "owner")
+        try:
+            room_id = _int_field(record, "room_id")
+        except ValueError:
+            stats.error(line, "room_id must be an integer")
+            continue
+        if not (room and owner):
+            room = owner = None
+        if not username or (room is None and room_id is None):
+            stats.error(line, "username and either room + owner or room_id are required")
+            continue
+        parsed.append((line, username, room, owner, room_id))
+
+    async with AsyncSessionLocal() as session:
+        users = await _user_ids(session, {username for _, username, _, _, _ in parsed} |
+                                {owner for _, _, _, owner, _ in parsed if owner is not None})
+        # room_id -> владелец и (владелец, название) -> room_id
+        owners_by_room: Dict[int, int] = {}
+        rooms_by_name: Dict[Tuple[int, str], int] = {}
+        room_ids = {room_id for _, _, room, _, room_id in parsed if room is None}
+        if room_ids:
+            result = await session.execute(select(Room.id, Room.owner_id).where(Room.id.in_(room_ids)))
+            owners_by_room.update(result.all())
+        named = {(users[owner], room) for _, _, room, owner, _ in parsed if owner in users}
+        if named:
+            result = await session.execute(
+                select(Room.id, Room.owner_id, Room.name).where(
+                    Room.owner_id.in_({owner_id for owner_id, _ in named}), Room.name.in_({name for _, name in named})
+                ).order_by(Room.id)
+            )
+            for room_id, owner_id, name in result:
+                # Одноимённые комнаты одного владельца: берём самую раннюю
+                rooms_by_name.setdefault((owner_id, name), room_id)
+                owners_by_room[room_id] = owner_id
+
+        rows = []
+        for line, username, room, owner, room_id in parsed:
+            user_id = users.get(username)
+            if room is not None:
+                room_id = rooms_by_name.get((users.get(owner), room))
+            owner_id = owners_by_room.get(room_id)
+            if user_id is None:
+                stats.error(line, f"user {username!r} not found")
+            elif owner_id is None:
+                stats.error(line, "room not found")
+            elif owner_id == user_id:
+                # Владелец и так имеет доступ
+                stats.skipped += 1
+            else:
+                rows.append({"room_id": room_id, "user_id": user_id})
+        inserted = []
+        if rows:
+            result = await session.execute(
+                _insert(RoomMember).on_conflict_do_nothing(index_elements=["room_id", "user_id"])
+                .returning(RoomMember.room_id, RoomMember.user_id),
+                rows
+            )
+            inserted = result.all()
+            await session.commit()
+    stats.inserted += len(inserted)
+    stats.skipped += len(rows) - len(inserted)
+    for room_id, user_id in inserted:
+        invalidate_room_access(room_id, user_id)
+        invalidate_user_rooms(user_id)
+    return {room_id for room_id, _ in inserted}
+
+
+IMPORTERS = {"users": _import_users, "rooms": _import_rooms, "memberships": _import_memberships}
+
+
+async def run_import(
+    kind: str,
+    stream: TextIO,
+    fmt: str,
+    batch_size: Optional[int] = None
+) -> AsyncIterator[Tuple[ImportStats, Set[int]]]:
+    # После каждой пачки — накопленная статистика и комнаты, в которых изменился доступ
+    importer = IMPORTERS[kind]
+    batch_size = batch_size or settings.bulk_batch_size
+    stats = ImportStats(kind)
+    # Свой пул для scrypt: импорт не отнимает очередь у логинов
+    hasher = PasswordHasher(max_pending=batch_size)
+    batch: List[Tuple[int, Dict]] = []
+    try:
+        for line, record, error in read_records(stream, fmt):
+            stats.rows += 1
+            if error is not None:
+                stats.error(line, error)
+            else:
+                batch.append((line, record))
+            if len(batch) >= batch_size:
+                yield stats, await importer(batch, stats, hasher)
+                batch = []
+        yield stats, (await importer(batch, stats, hasher)) if batch else set()
+    finally:
+        hasher.shutdown()
+
+
+def _plain(row: Dict, fields: List[str]) -> Dict:
+    return {name: row[name].isoformat() if isinstance(row[name], datetime) else row[name] for name in fields}
+
+
+def encode_rows(rows: List[Dict], kind: str, fmt: str) -> str:
+    fields = EXPORT_FIELDS[kind]
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([[value.isoformat() if isinstance(value, datetime) else value
+                           for value in (row[name] for name in fields)] for row in rows])
+        return buffer.getvalue()
+    return "".join(json.dumps(_plain(row, fields), ensure_ascii=False) + "\n" for row in rows)
+
+
+def _export_query(kind: str):
+    if kind == "users":
+        return select(User.id, User.username, User.first_name, User.last_name, User.password_hash,
+                      User.created_at), User.id
+    if kind == "rooms":
+        return select(Room.id, Room.name, User.username.label("owner"), Room.created_at,
+                      Room.retention_days, Room.retention_messages).join(User, Room.owner_id == User.id), Room.id
+    owner, member = aliased(User), aliased(User)
+    return (
+        select(RoomMember.id, RoomMember.room_id, Room.name.label("room"), owner.username.label("owner"),
+               member.username.label("username"), RoomMember.created_at)
+        .join(Room, RoomMember.room_id == Room.id)
+        .join(owner, Room.owner_id == owner.id)
+        .join(member, RoomMember.user_id == member.id)
+    ), RoomMember.id
+
+
+async def _export_history(room_id: int) -> AsyncIterator[List[Dict]]:
+    # Сначала вынесенное политикой хранения в архив (по сегменту), затем то, что осталось в БД
+    after_id = 0
+    segments = message_archive.iter_segments(room_id)
+    while True:
+        # Сегмент читается и распаковывается целиком — в потоке, как и в app/history.py, чтобы большой архив
+        # не останавливал цикл событий (и WebSocket-соединения воркера) на время выгрузки
+        rows = await asyncio.to_thread(next, segments, None)
+        if rows is None:
+            break
+        if rows:
+            after_id = max(after_id, rows[-1]["id"])
+        # Отдаём страницами по bulk_batch_size, как и из БД: кодирование страницы идёт в цикле событий
+        for start in range(0, len(rows), settings.bulk_batch_size):
+            yield [{**row, "room_id": room_id} for row in rows[start:start + settings.bulk_batch_size]]
+    while True:
+        rows = await get_messages_after(room_id, after_id, settings.bulk_batch_size)
+        if not rows:
+            return
+        after_id = rows[-1]["id"]
+        yield [{**row, "room_id": room_id} for row in rows]
+
+
+async def export_pages(kind: str, room_id: Optional[int] = None) -> AsyncIterator[List[Dict]]:
+    # Постранично по первичному ключу (id > последний ORDER BY id LIMIT n): без OFFSET и без всей таблицы в памяти
+    if kind == "history":
+        async for rows in _export_history(room_id):
+            yield rows
+        return
+    query, key = _export_query(kind)
+    after_id = 0
+    while True:
+        async with ReadSessionLocal() as session:
+            result = await session.execute(query.where(key > after_id).order_by(key).limit(settings.bulk_batch_size))
+            rows = [row._asdict() for row in result]
+        if not rows:
+            return
+        after_id = rows[-1]["id"]
+        yield rows
+
+
+def csv_header(kind: str) -> str:
+    return ",".join(EXPORT_FIELDS[kind]) + "\r\n"
+
+
+async def export_chunks(kind: str, fmt: str, room_id: Optional[int] = None) -> AsyncIterator[str]:
+    # Текст выгрузки страница за страницей — для StreamingResponse
+    if fmt == "csv":
+        yield csv_header(kind)
+    async for rows in export_pages(kind, room_id):
+        yield encode_rows(rows, kind, fmt)
+
+
+async def _import_file(args) -> ImportStats:
+    await init_db()
+    fmt = detect_format(args.path, args.format)
+    reported = time.monotonic()
+    stats = None
+    # utf-8-sig: CSV из Excel начинается с BOM
+    with open(args.path, encoding="utf-8-sig", newline="") as stream:
+        async for stats, _ in run_import(args.kind, stream, fmt, args.batch_size):
+            if time.monotonic() - reported >= args.progress:
+                reported = time.monotonic()
+                print(stats, file=sys.stderr)
+    await engine.dispose()
+    return stats
+
+
+async def _export_file(args):
+    fmt = detect_format(args.output or "", args.format)
+    output = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    rows = 0
+    started = reported = time.monotonic()
+    try:
+        if fmt == "csv":
+            output.write(csv_header(args.kind))
+        async for page in export_pages(args.kind, args.room):
+            output.write(encode_rows(page, args.kind, fmt))
+            rows += len(page)
+            if time.monotonic() - reported >= args.progress:
+                reported = time.monotonic()
+                print(f"{args.kind}: {rows} rows exported", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    await engine.dispose()
+    elapsed = time.monotonic() - started
+    print(f"{args.kind}: {rows} rows exported ({rows / elapsed if elapsed else 0:.0f} rows/s)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовый импорт и выгрузка пользователей, комнат и участников")
+    parser.add_argument("--format", choices=FORMATS, help="по умолчанию — по расширению файла (.csv или JSONL)")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--progress", type=float, default=1.0, help="секунд между строками прогресса")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser(
+        "import", help="users: username, first_name, last_name, password или password_hash; "
+                       "rooms: name, owner[, retention_days, retention_messages]; "
+                       "memberships: username и room + owner или room_id. "
+                       "Работающие воркеры увидят изменения после истечения кэшей доступа и списков комнат"
+    )
+    import_parser.add_argument("kind", choices=KINDS)
+    import_parser.add_argument("path")
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("kind", choices=KINDS + ("history",))
+    export_parser.add_argument("--room", type=int, help="комната для history")
+    export_parser.add_argument("--output", help="файл (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        stats = asyncio.run(_import_file(args))
+        print(stats)
+        for sample in stats.error_samples:
+            print(f"  {sample}")
+        sys.exit(1 if stats.errors else 0)
+    if args.kind == "history" and args.room is None:
+        parser.error("export history requires --room")
+    asyncio.run(_export_file(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple, Union
+from fastapi import WebSocket
+from app.config import settings
+from app.metrics import Counter
+from app.protocol import LEGACY, Frame, Protocol
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+DROPPED_FRAMES = Counter(
+    "chat_send_queue_dropped_frames", "Frames dropped from full send queues (drop_oldest policy)"
+).labels()
+
+
+# WebSocket с собственной ограниченной очередью уже закодированных кадров и задачей-писателем:
+# broadcast только кладёт кадры в очередь, поэтому медленный клиент
+# не задерживает доставку остальным участникам комнаты.
+class ClientConnection:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        room_id: int,
+        user_id: int,
+        protocol: Protocol = LEGACY,
+        queue_size: Optional[int] = None,
+        policy: Optional[str] = None,
+        on_close: Optional[Callable[["ClientConnection"], None]] = None,
+    ):
+        self.websocket = websocket
+        self.room_id = room_id
+        self.user_id = user_id
+        self.protocol = protocol
+        self.queue_size = queue_size or settings.send_queue_size
+        self.policy = policy or settings.slow_consumer_policy
+        self.on_close = on_close
+        self.dropped = 0
+        self.closed = False
+        # (кадр или пачка кадров, это сообщения чата)
+        self._queue: Deque[Tuple[Union[Frame, List[Frame]], bool]] = deque()
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        # Время последнего кадра от клиента (по часам цикла событий) — для закрытия молчащих соединений
+        self.last_seen = asyncio.get_running_loop().time()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def touch(self):
+        self.last_seen = asyncio.get_running_loop().time()
+
+    def start(self):
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._run())
+
+    def enqueue(self, frame: Union[Frame, List[Frame]], message: bool = False) -> bool:
+        # Список кадров отправляется одним кадром-массивом. message=True — сообщения чата: только их
+        # политика coalesce склеивает в массив; служебные кадры (ping, presence, saved, error, resync) — нет
+        if self.closed:
+            return False
+        if len(self._queue) >= self.queue_size and not self._overflow():
+            return False
+        self._queue.append((frame, message))
+        self._wakeup.set()
+        return True
+
+    def _overflow(self) -> bool:
+        if self.policy == DROP_OLDEST:
+            self._queue.popleft()
+            self.dropped += 1
+            DROPPED_FRAMES.inc()
+            return True
+        if self.policy == COALESCE:
+            # Склеиваем накопившиеся сообщения в один кадр-массив на месте первого из них. Служебные кадры
+            # клиент не должен получить внутри массива сообщений, они остаются отдельными и в прежнем порядке
+            # (могут только оказаться после сообщений, пришедших позже них)
+            batch = []
+            queue = deque()
+            for frame, message in self._queue:
+                if not message:
+                    queue.append((frame, message))
+                    continue
+                if not batch:
+                    queue.append((batch, True))
+                if isinstance(frame, list):
+                    batch.extend(frame)
+                else:
+                    batch.append(frame)
+            self._queue = queue
+            # Массив тоже ограничен queue_size сообщений: пока писатель стоит на отправке зависшему клиенту,
+            # он рос бы с каждой рассылкой. Очередь забита служебными кадрами или массив полон — клиент
+            # не читает совсем; переподключившись, он получит пропущенное через resync
+            if len(queue) < self.queue_size and len(batch) <= self.queue_size:
+                return True
+        self.close(code=1013, reason="Slow consumer")
+        return False
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._queue:
+                    frame, _ = self._queue.popleft()
+                    if isinstance(frame, list):
+                        frame = self.protocol.encode_batch(frame)
+                    if isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.close()
+
+    def close(self, code: Optional[int] = None, reason: Optional[str] = None):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code, reason))
+        if self.on_close is not None:
+            self.on_close(self)
+
+    async def _close_socket(self, code: int, reason: Optional[str]):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), timeout=5)
+        except Exception:
+            pass
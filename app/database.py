@@ -1,17 +1,163 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from app.models import Base, Message
-from typing import AsyncGenerator, List, Dict
-from sqlalchemy import select
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, async_sessionmaker
+from app.config import settings
+from app.metrics import Histogram, timed
+from app.models import Base, Message, Room
+from typing import AsyncGenerator, List, Dict, Optional
+from sqlalchemy import DateTime, delete, event, insert, inspect, select, text
+from sqlalchemy.engine import make_url
+from alembic import command
+from alembic.config import Config as AlembicConfig
+from pathlib import Path
 
-DATABASE_URL = 'sqlite+aiosqlite:///chat_history.db'
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+DATABASE_URL = settings.database_url
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / "migrations"
+# Ключ pg_advisory_xact_lock, под которым воркеры по очереди применяют миграции
+MIGRATION_LOCK_ID = 0x63686174
+
+# Время запросов к БД по операциям (database.py и user_repo.py), включая ожидание соединения из пула
+DB_QUERY_SECONDS = Histogram("chat_db_query_seconds", "Database operation latency", ["query"])
+
+# Профили PRAGMA для SQLite: performance — WAL, чтобы читатели не блокировали писателя и наоборот
+SQLITE_PROFILES = {
+    "default": {},
+    "performance": {
+        # Действует для новых файлов БД; существующий переводится в этот режим одним VACUUM
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+        "mmap_size": settings.sqlite_mmap_size,
+        "cache_size": settings.sqlite_cache_size,
+        "busy_timeout": settings.sqlite_busy_timeout,
+    },
+}
+
+
+def _sqlite_pragmas(read_only: bool) -> Dict:
+    pragmas = dict(SQLITE_PROFILES[settings.db_profile])
+    if read_only:
+        # journal_mode хранится в файле БД и выставляется пишущими соединениями
+        pragmas.pop("journal_mode", None)
+        pragmas.pop("auto_vacuum", None)
+        pragmas["query_only"] = "ON"
+    return pragmas
+
+
+def _install_sqlite_pragmas(async_engine: AsyncEngine, pragmas: Dict):
+    if not pragmas:
+        return
+
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def _create_engines():
+    url = make_url(DATABASE_URL)
+    if url.get_backend_name() == "postgresql":
+        # asyncpg: проверка соединений из пула и пересоздание долгоживущих;
+        # пакеты save_messages уходят многострочными INSERT ... VALUES ... RETURNING
+        write_engine = create_async_engine(
+            url, echo=False, future=True,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=True,
+            insertmanyvalues_page_size=settings.db_insert_page_size
+        )
+        return write_engine, write_engine
+
+    sqlite_db = url.get_backend_name() == "sqlite"
+    if sqlite_db and (not url.database or url.database == ":memory:"):
+        # БД в памяти: SQLAlchemy берёт StaticPool с одним соединением, у которого нет параметров пула.
+        # Отдельный пул чтения увидел бы другую, пустую БД — читаем через тот же движок
+        write_engine = create_async_engine(url, echo=False, future=True)
+        _install_sqlite_pragmas(write_engine, _sqlite_pragmas(read_only=False))
+        return write_engine, write_engine
+
+    write_engine = create_async_engine(
+        url, echo=False, future=True,
+        pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow
+    )
+    if not sqlite_db:
+        return write_engine, write_engine
+
+    _install_sqlite_pragmas(write_engine, _sqlite_pragmas(read_only=False))
+
+    # Отдельный пул read-only соединений для истории: в WAL чтения идут параллельно с записью
+    read_url = url.set(database=f"file:{url.database}", query={**url.query, "mode": "ro", "uri": "true"})
+    read_engine = create_async_engine(
+        read_url, echo=False, future=True,
+        pool_size=settings.db_read_pool_size, max_overflow=settings.db_max_overflow
+    )
+    _install_sqlite_pragmas(read_engine, _sqlite_pragmas(read_only=True))
+    return write_engine, read_engine
+
+
+engine, read_engine = _create_engines()
 AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
+ReadSessionLocal = async_sessionmaker(bind=read_engine, expire_on_commit=False, class_=AsyncSession)
+
+
+def _create_missing_indexes(conn):
+    # create_all не добавляет новые индексы в уже существующие таблицы
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _run_migrations(conn):
+    if conn.dialect.name == "postgresql":
+        # Блокировка держится до конца транзакции миграций; следующий воркер увидит схему уже на head
+        conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({MIGRATION_LOCK_ID})")
+    config = AlembicConfig()
+    config.set_main_option("script_location", str(MIGRATIONS_DIR))
+    config.attributes["connection"] = conn
+    tables = inspect(conn).get_table_names()
+    if "alembic_version" not in tables and "messages" in tables:
+        # База создана до появления миграций (create_all): досоздаём индексы и отмечаем исходную схему
+        _create_missing_indexes(conn)
+        command.stamp(config, "0001")
+    command.upgrade(config, "head")
+
+
+@asynccontextmanager
+async def _migration_lock():
+    # Для SQLite — файловая блокировка рядом с файлом БД: все воркеры, открывающие этот файл, на одной машине.
+    # PostgreSQL ждёт на advisory lock внутри самой транзакции (см. _run_migrations)
+    url = make_url(DATABASE_URL)
+    if fcntl is None or url.get_backend_name() != "sqlite" or not url.database or url.database == ":memory:":
+        yield
+        return
+    with open(f"{url.database}.migrate.lock", "a") as lock_file:
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Схема ведётся миграциями Alembic; при CHAT_DB_AUTO_CREATE=false их запускают вручную (alembic upgrade head).
+    # Воркеры uvicorn --workers N стартуют одновременно: миграции применяет тот, кто первым взял блокировку,
+    # остальные дожидаются его и находят схему уже на head
+    if not settings.db_auto_create:
+        return
+    async with _migration_lock():
+        async with engine.begin() as conn:
+            await conn.run_sync(_run_migrations)
 
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
@@ -19,31 +165,181 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
-async def save_message(room_id: int, user_id: int, username: str, message: str, timestamp: str):
+@timed(DB_QUERY_SECONDS, "save_message")
+async def save_message(room_id: int, user_id: int, username: str, message: str, ts: int):
     async with AsyncSessionLocal() as session:
         new_message = Message(
             room_id=room_id,
             user_id=user_id,
             username=username,
             message=message,
-            timestamp=timestamp
+            ts=ts
         )
         session.add(new_message)
         await session.commit()
 
 
-async def get_room_history(room_id: int) -> List[Dict]:
+@timed(DB_QUERY_SECONDS, "save_messages")
+async def save_messages(rows: List[Dict]) -> List[int]:
+    # Пакетная вставка одной транзакцией (используется фоновым писателем); возвращает id в порядке rows.
+    # SQLAlchemy отправляет её как многострочный INSERT ... RETURNING (insertmanyvalues).
+    # В SQLite порядок строк RETURNING не гарантирован, и с sort_by_parameter_order SQLAlchemy вставляет
+    # по строке за запрос. Но rowid выдаются по порядку VALUES, а пишет транзакция одна (блокировка записи
+    # на весь пакет), поэтому id строк rows — это возвращённые id по возрастанию
+    if not rows:
+        return []
     async with AsyncSessionLocal() as session:
-        stmt = select(Message).where(Message.room_id == room_id).order_by(Message.id.asc())
+        ordered = session.bind.dialect.name != "sqlite"
+        result = await session.execute(
+            insert(Message).returning(Message.id, sort_by_parameter_order=ordered),
+            rows
+        )
+        ids = list(result.scalars().all())
+        await session.commit()
+        return ids if ordered else sorted(ids)
+
+
+def _message_dict(msg: Message) -> Dict:
+    return {
+        "id": msg.id,
+        "user_id": msg.user_id,
+        "username": msg.username,
+        "message": msg.message,
+        "ts": msg.ts,
+        "created_at": msg.created_at
+    }
+
+
+@timed(DB_QUERY_SECONDS, "get_room_history")
+async def get_room_history(room_id: int, limit: Optional[int] = None, before_id: Optional[int] = None) -> List[Dict]:
+    # Последние limit сообщений комнаты (старше before_id), в хронологическом порядке
+    async with ReadSessionLocal() as session:
+        stmt = select(Message).where(Message.room_id == room_id)
+        if before_id is not None:
+            stmt = stmt.where(Message.id < before_id)
+        stmt = stmt.order_by(Message.id.desc())
+        if limit is not None:
+            stmt = stmt.limit(limit)
         result = await session.execute(stmt)
         messages = result.scalars().all()
-        
+        return [_message_dict(msg) for msg in reversed(messages)]
+
+
+@timed(DB_QUERY_SECONDS, "get_messages_after")
+async def get_messages_after(room_id: int, after_id: int, limit: int) -> List[Dict]:
+    # Первые limit сообщений комнаты новее after_id, в хронологическом порядке (resync после переподключения)
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Message).where(Message.room_id == room_id, Message.id > after_id)
+            .order_by(Message.id).limit(limit)
+        )
+        return [_message_dict(msg) for msg in result.scalars()]
+
+
+async def get_retention_policies() -> List[Dict]:
+    # Политики всех комнат (None — взять значение по умолчанию из настроек)
+    async with ReadSessionLocal() as session:
+        result = await session.execute(select(Room.id, Room.retention_days, Room.retention_messages))
+        return [{"room_id": row.id, "max_age_days": row.retention_days, "max_messages": row.retention_messages}
+                for row in result]
+
+
+async def get_message_id_from_end(room_id: int, position: int) -> Optional[int]:
+    # id сообщения, position-го с конца комнаты (1 — самое новое); обратный скан по idx_room_message
+    async with ReadSessionLocal() as session:
+        result = await session.execute(
+            select(Message.id).where(Message.room_id == room_id)
+            .order_by(Message.id.desc()).offset(position - 1).limit(1)
+        )
+        return result.scalar_one_or_none()
+
+
+async def get_oldest_messages(room_id: int, limit: int, before_id: Optional[int] = None) -> List[Dict]:
+    async with ReadSessionLocal() as session:
+        stmt = select(Message).where(Message.room_id == room_id)
+        if before_id is not None:
+            stmt = stmt.where(Message.id < before_id)
+        result = await session.execute(stmt.order_by(Message.id).limit(limit))
+        return [_message_dict(msg) for msg in result.scalars()]
+
+
+@timed(DB_QUERY_SECONDS, "delete_messages")
+async def delete_messages(room_id: int, first_id: int, last_id: int) -> int:
+    # Одна короткая транзакция на пачку, чтобы не задерживать запись живых сообщений
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            delete(Message).where(Message.room_id == room_id, Message.id >= first_id, Message.id <= last_id)
+        )
+        await session.commit()
+        return result.rowcount
+
+
+async def incremental_vacuum(pages: int) -> Optional[int]:
+    # Возвращает число оставшихся свободных страниц; None — БД не SQLite или не в режиме INCREMENTAL
+    if engine.dialect.name != "sqlite":
+        return None
+    async with engine.connect() as conn:
+        if (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar() != 2:
+            return None
+        await conn.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})")
+        await conn.commit()
+        return (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+
+# Поиск по тексту сообщений (индексы — в миграции 0003). Запрос пользователя не передаётся
+# в синтаксис FTS как есть: берём слова (все обязательны), "слово*" — поиск по префиксу.
+# По релевантности сортируются только search_rank_window последних совпадений в комнате:
+# иначе частое слово заставило бы считать ранг для каждой подходящей строки таблицы
+_SEARCH_SQLITE = text(
+    "SELECT m.id, m.user_id, m.username, m.message, m.ts, m.created_at, f.rank FROM ("
+    "SELECT messages_fts.rowid AS id, bm25(messages_fts) AS rank "
+    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+    "WHERE messages_fts MATCH :query AND m.room_id = :room_id "
+    "ORDER BY messages_fts.rowid DESC LIMIT :window"
+    ") f JOIN messages m ON m.id = f.id "
+    "ORDER BY f.rank, m.id DESC LIMIT :limit OFFSET :offset"
+).columns(created_at=DateTime)
+_SEARCH_POSTGRES = text(
+    "SELECT id, user_id, username, message, ts, created_at, "
+    "-ts_rank(to_tsvector('simple', message), to_tsquery('simple', :query)) AS rank FROM ("
+    "SELECT * FROM messages "
+    "WHERE room_id = :room_id AND to_tsvector('simple', message) @@ to_tsquery('simple', :query) "
+    "ORDER BY id DESC LIMIT :window"
+    ") recent "
+    "ORDER BY rank, id DESC LIMIT :limit OFFSET :offset"
+).columns(created_at=DateTime)
+
+
+def _search_terms(query: str) -> List[str]:
+    return re.findall(r"\w+\*?", query.lower())[:16]
+
+
+@timed(DB_QUERY_SECONDS, "search_messages")
+async def search_messages(room_id: int, query: str, limit: int, offset: int = 0) -> List[Dict]:
+    # Сообщения комнаты, подходящие под запрос, от самых релевантных; rank — чем меньше, тем лучше
+    terms = _search_terms(query)
+    if not terms:
+        return []
+    async with ReadSessionLocal() as session:
+        if session.bind.dialect.name == "postgresql":
+            stmt = _SEARCH_POSTGRES
+            match = " & ".join(term[:-1] + ":*" if term.endswith("*") else term for term in terms)
+        else:
+            stmt = _SEARCH_SQLITE
+            match = " ".join(f'"{term[:-1]}"*' if term.endswith("*") else f'"{term}"' for term in terms)
+        params = {
+            "query": match, "room_id": room_id, "limit": limit, "offset": offset,
+            "window": max(settings.search_rank_window, offset + limit)
+        }
+        result = await session.execute(stmt, params)
         return [
             {
-                "user_id": msg.user_id,
-                "username": msg.username,
-                "message": msg.message,
-                "timestamp": msg.timestamp
+                "id": row.id,
+                "user_id": row.user_id,
+                "username": row.username,
+                "message": row.message,
+                "ts": row.ts,
+                "created_at": row.created_at,
+                "rank": row.rank
             }
-            for msg in messages
+            for row in result
         ]
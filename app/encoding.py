@@ -0,0 +1,20 @@
+import json
+from typing import Any
+from app.config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Кодирует кадр в JSON-текст один раз, чтобы разослать одну и ту же строку всем получателям.
+# Формат совпадает с WebSocket.send_json из Starlette.
+def encode_json(data: Any) -> str:
+    if orjson is not None and settings.fast_json:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode_batch(frames: list) -> str:
+    return "[" + ",".join(frames) + "]"
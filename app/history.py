@@ -0,0 +1,338 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+from app.archive import message_archive
+from app.config import settings
+from app.database import get_messages_after, get_room_history, search_messages
+from app.protocol import LEGACY, Frame, Protocol, clock_time
+
+
+def _page_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return settings.history_page_size
+    return max(1, min(limit, settings.history_max_page_size))
+
+
+def message_event(row: Dict) -> Dict:
+    # Строка из get_room_history в формате события сообщения (см. app.protocol)
+    return {
+        "id": row["id"],
+        "sender_id": row["user_id"],
+        "sender": row["username"],
+        "body": row["message"],
+        "timestamp": clock_time(row["ts"]),
+        "ts": row["ts"]
+    }
+
+
+# Сообщение в кольцевом буфере. id появляется, когда фоновый писатель сохранит строку;
+# закодированные кадры (по протоколу и варианту свой / чужой) кэшируются только после этого.
+class HistoryEntry:
+    __slots__ = ("event", "failed", "_encoded", "_waiter")
+
+    def __init__(self, event: Dict):
+        self.event = event
+        self.failed = False
+        self._encoded: Dict = {}
+        self._waiter: Optional[asyncio.Future] = None
+
+    @property
+    def id(self) -> Optional[int]:
+        return self.event["id"]
+
+    @property
+    def pending(self) -> bool:
+        # Сообщение ещё в очереди писателя (write_behind)
+        return self.id is None and not self.failed
+
+    def set_id(self, message_id: Optional[int]):
+        # None — запись не удалась
+        if message_id is None:
+            self.failed = True
+        else:
+            self.event["id"] = message_id
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def wait_saved(self):
+        if self.pending:
+            if self._waiter is None:
+                self._waiter = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self._waiter)
+
+    def to_dict(self, protocol: Protocol, user_id: int) -> Dict:
+        return protocol.message(self.event, user_id)
+
+    def encoded(self, protocol: Protocol, user_id: int) -> Frame:
+        key = protocol.variant(self.event, user_id)
+        frame = self._encoded.get(key)
+        if frame is None:
+            frame = protocol.encode_message(self.event, user_id)
+            if self.id is not None:
+                self._encoded[key] = frame
+        return frame
+
+
+class _RoomHistory:
+    __slots__ = ("entries", "has_more", "warm")
+
+    def __init__(self, size: int):
+        self.entries: Deque[HistoryEntry] = deque(maxlen=size)
+        self.has_more = False
+        # warm = буфер содержит все последние сообщения комнаты (был прогрет из БД)
+        self.warm = False
+
+
+# Последние сообщения каждой комнаты в памяти, чтобы подключение не ходило в БД.
+# Число комнат ограничено, давно не использованные вытесняются (LRU).
+class HistoryBuffer:
+    def __init__(self, size: Optional[int] = None, max_rooms: Optional[int] = None):
+        self.size = max(size if size is not None else settings.history_buffer_size, settings.history_page_size)
+        self.max_rooms = max_rooms if max_rooms is not None else settings.history_buffer_rooms
+        self.rooms: "OrderedDict[int, _RoomHistory]" = OrderedDict()
+        self._warming: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rooms > 0
+
+    def _room(self, room_id: int) -> _RoomHistory:
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = _RoomHistory(self.size)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room_id)
+        return room
+
+    def append(self, room_id: int, entry: HistoryEntry):
+        if not self.enabled:
+            return
+        room = self._room(room_id)
+        if len(room.entries) == room.entries.maxlen:
+            room.has_more = True
+        room.entries.append(entry)
+
+    def warm(self, room_id: int, history: List[Dict], has_more: bool):
+        room = self._room(room_id)
+        last_id = history[-1]["id"] if history else 0
+        # Сообщения, пришедшие во время запроса к БД или ещё не записанные писателем
+        pending = [entry for entry in room.entries if entry.id is None or entry.id > last_id]
+        room.entries.clear()
+        room.has_more = has_more
+        for msg in history:
+            room.entries.append(HistoryEntry(message_event(msg)))
+        for entry in pending:
+            self.append(room_id, entry)
+        room.warm = True
+
+    def saved(self, room_id: int, entry: HistoryEntry, message_id: Optional[int]):
+        # Итог записи сообщения из буфера: id из БД или None — тогда сообщение убирается из истории
+        entry.set_id(message_id)
+        room = self.rooms.get(room_id)
+        if message_id is None and room is not None:
+            try:
+                room.entries.remove(entry)
+            except ValueError:
+                pass
+
+    def confirm(self, room_id: int, ids: Dict[str, int], failed: List[str]):
+        # Итог записи сообщений другого воркера, разосланных до записи (write_behind): id по ref
+        # или ref, запись которых не удалась
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        failed = set(failed)
+        for entry in list(room.entries):
+            ref = entry.event.get("ref")
+            if not entry.pending or ref is None:
+                continue
+            if ref in ids:
+                entry.set_id(ids[ref])
+            elif ref in failed:
+                self.saved(room_id, entry, None)
+
+    async def _load(self, room_id: int):
+        try:
+            history = await get_room_history(room_id, limit=self.size + 1)
+            has_more = len(history) > self.size or await asyncio.to_thread(
+                message_archive.has_older, room_id, history[0]["id"] if history else None
+            )
+            self.warm(room_id, history[-self.size:], has_more)
+        finally:
+            self._warming.pop(room_id, None)
+
+    async def _warm_room(self, room_id: int) -> Optional[_RoomHistory]:
+        room = self.rooms.get(room_id)
+        if room is None or not room.warm:
+            self.misses += 1
+            # При шторме переподключений к холодной комнате в БД идёт один запрос
+            task = self._warming.get(room_id)
+            if task is None:
+                task = self._warming[room_id] = asyncio.create_task(self._load(room_id))
+            await asyncio.shield(task)
+            room = self.rooms.get(room_id)
+            if room is None or not room.warm:
+                return None
+        else:
+            self.hits += 1
+            self.rooms.move_to_end(room_id)
+        return room
+
+    async def recent(self, room_id: int, limit: int) -> Optional[List[HistoryEntry]]:
+        # Последние limit сообщений комнаты; None — ответить из буфера нельзя
+        if not self.enabled or limit > self.size:
+            return None
+        room = await self._warm_room(room_id)
+        if room is None:
+            return None
+        entries = list(room.entries)[-limit:]
+        pending = [entry for entry in entries if entry.pending]
+        if pending:
+            # Часть страницы ещё в очереди писателя: ждём его пакет, чтобы не отдать сообщение без id
+            # (или такое, запись которого не удастся); незаписанные в историю не попадают
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(entry.wait_saved() for entry in pending)), settings.history_pending_timeout
+                )
+            except asyncio.TimeoutError:
+                return None
+            entries = [entry for entry in entries if entry.id is not None]
+        return entries
+
+    async def after(self, room_id: int, after_id: int, limit: int) -> Optional[List[HistoryEntry]]:
+        # Первые limit сохранённых сообщений новее after_id; None — разрыв начинается раньше буфера.
+        # Ещё не записанные сообщения клиент получит обычными кадрами, когда они будут разосланы
+        if not self.enabled:
+            return None
+        room = await self._warm_room(room_id)
+        if room is None:
+            return None
+        # Сообщения других воркеров попадают в буфер в порядке доставки, а не записи
+        entries = sorted((entry for entry in room.entries if entry.id is not None), key=lambda entry: entry.id)
+        if room.has_more and (not entries or entries[0].id > after_id):
+            return None
+        return [entry for entry in entries if entry.id > after_id][:limit]
+
+    def has_more_than(self, room_id: int, count: int) -> bool:
+        # Комнату могли вытеснить, пока recent ждал писателя: тогда более старые сообщения считаем возможными
+        room = self.rooms.get(room_id)
+        return room is None or room.has_more or len(room.entries) > count
+
+
+history_buffer = HistoryBuffer()
+
+
+# Страница истории комнаты для пользователя: курсор — id самого старого сообщения страницы
+async def get_history_page(
+    room_id: int,
+    user_id: int,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    protocol: Protocol = LEGACY
+) -> Dict:
+    limit = _page_limit(limit)
+    if before_id is None:
+        entries = await history_buffer.recent(room_id, limit)
+        if entries is not None:
+            return {
+                "type": "history",
+                "messages": [entry.to_dict(protocol, user_id) for entry in entries],
+                "has_more": history_buffer.has_more_than(room_id, len(entries)),
+                "before_id": entries[0].id if entries else None
+            }
+
+    # Берём на одно сообщение больше, чтобы узнать, есть ли ещё более старые
+    history = await get_room_history(room_id, limit=limit + 1, before_id=before_id)
+    if len(history) <= limit:
+        # В БД сообщения кончились — дальше листаем архив, вынесенный политикой хранения
+        archived = await asyncio.to_thread(
+            message_archive.read_before, room_id, history[0]["id"] if history else before_id, limit + 1 - len(history)
+        )
+        history = archived + history
+    has_more = len(history) > limit
+    if has_more:
+        history = history[1:]
+
+    return {
+        "type": "history",
+        "messages": [protocol.message(message_event(msg), user_id) for msg in history],
+        "has_more": has_more,
+        "before_id": history[0]["id"] if history else before_id
+    }
+
+
+# Кадр истории для подключения к комнате, собранный из уже закодированных сообщений буфера
+async def get_history_frame(room_id: int, user_id: int, protocol: Protocol = LEGACY) -> Frame:
+    limit = _page_limit(None)
+    entries = await history_buffer.recent(room_id, limit)
+    if entries is None:
+        return protocol.encode(await get_history_page(room_id, user_id, protocol=protocol))
+    
+    has_more = history_buffer.has_more_than(room_id, len(entries))
+    before_id = entries[0].id if entries else None
+    if protocol.binary:
+        return protocol.encode({
+            "type": "history",
+            "messages": [entry.to_dict(protocol, user_id) for entry in entries],
+            "has_more": has_more,
+            "before_id": before_id
+        })
+    return (
+        '{"type":"history","messages":['
+        + ",".join(entry.encoded(protocol, user_id) for entry in entries)
+        + '],"has_more":' + ("true" if has_more else "false")
+        + ',"before_id":' + (str(before_id) if before_id is not None else "null")
+        + "}"
+    )
+
+
+# Сообщения, пропущенные клиентом после last seen id (переподключение); следующая часть — с after_id = last_id
+async def get_resync_page(
+    room_id: int,
+    user_id: int,
+    after_id: int,
+    limit: Optional[int] = None,
+    protocol: Protocol = LEGACY
+) -> Dict:
+    limit = settings.resync_max_messages if limit is None else max(1, min(limit, settings.resync_max_messages))
+    entries = await history_buffer.after(room_id, after_id, limit + 1)
+    if entries is not None:
+        messages = [entry.to_dict(protocol, user_id) for entry in entries]
+    else:
+        rows = await get_messages_after(room_id, after_id, limit + 1)
+        messages = [protocol.message(message_event(row), user_id) for row in rows]
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    return {
+        "type": "resync",
+        "messages": messages,
+        "has_more": has_more,
+        "last_id": messages[-1]["id"] if messages else after_id
+    }
+
+
+# Страница результатов поиска по комнате; следующая страница — с offset = next_offset
+async def search_history(
+    room_id: int,
+    user_id: int,
+    query: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    protocol: Protocol = LEGACY
+) -> Dict:
+    limit = settings.search_page_size if limit is None else max(1, min(limit, settings.search_max_page_size))
+    offset = max(0, offset)
+    rows = await search_messages(room_id, query, limit=limit + 1, offset=offset)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "type": "search",
+        "query": query,
+        "messages": [protocol.message(message_event(row), user_id) for row in rows],
+        "has_more": has_more,
+        "next_offset": offset + len(rows) if has_more else None
+    }
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional
+from app.config import settings
+from app.connection import ClientConnection
+
+logger = logging.getLogger(__name__)
+
+IDLE_CLOSE_CODE = 1001
+OVERLOADED_CLOSE_CODE = 1013
+POLICY_CLOSE_CODE = 1008
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss_mb() -> Optional[float]:
+    # Текущий RSS процесса (Linux); None — узнать нельзя
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Жизненный цикл соединений воркера: допуск новых (лимиты и нехватка памяти),
+# heartbeat для клиентов, которые умеют на него отвечать, и закрытие молчащих.
+# Мёртвых клиентов chat.v1 находит ping/pong уровня протокола WebSocket (ws_ping_interval в uvicorn),
+# а ошибка отправки закрывает соединение в его задаче-писателе.
+class ConnectionLifecycle:
+    def __init__(
+        self,
+        connections: Callable[[], Iterable[ClientConnection]],
+        heartbeat_interval: Optional[float] = None,
+        idle_timeout: Optional[float] = None,
+        max_connections: Optional[int] = None,
+        max_connections_per_user: Optional[int] = None,
+        max_rss_mb: Optional[int] = None,
+    ):
+        self.connections = connections
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else settings.heartbeat_interval
+        self.idle_timeout = idle_timeout if idle_timeout is not None else settings.idle_timeout
+        self.max_connections = max_connections if max_connections is not None else settings.max_connections
+        self.max_connections_per_user = (
+            max_connections_per_user if max_connections_per_user is not None else settings.max_connections_per_user
+        )
+        self.max_rss_mb = max_rss_mb if max_rss_mb is not None else settings.admission_max_rss_mb
+        self.total = 0
+        self._per_user: Dict[int, int] = {}
+        self._rss_checked_at = 0.0
+        self._rss_mb: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.rejected = 0
+        self.reaped = 0
+
+    def admit(self, user_id: int):
+        # None — соединение можно принять, иначе (код закрытия, причина)
+        if self.max_connections and self.total >= self.max_connections:
+            self.rejected += 1
+            return OVERLOADED_CLOSE_CODE, "Too many connections"
+        if self.max_connections_per_user and self._per_user.get(user_id, 0) >= self.max_connections_per_user:
+            self.rejected += 1
+            return POLICY_CLOSE_CODE, "Too many connections for user"
+        if self.max_rss_mb and self._memory_pressure():
+            self.rejected += 1
+            return OVERLOADED_CLOSE_CODE, "Server is low on memory"
+        return None
+
+    def _memory_pressure(self) -> bool:
+        # При шторме подключений читаем /proc не чаще раза в секунду
+        now = time.monotonic()
+        if now - self._rss_checked_at >= 1.0:
+            self._rss_checked_at = now
+            self._rss_mb = current_rss_mb()
+        return self._rss_mb is not None and self._rss_mb >= self.max_rss_mb
+
+    def opened(self, connection: ClientConnection):
+        self.total += 1
+        self._per_user[connection.user_id] = self._per_user.get(connection.user_id, 0) + 1
+
+    def closed(self, connection: ClientConnection):
+        self.total -= 1
+        count = self._per_user.get(connection.user_id, 0) - 1
+        if count > 0:
+            self._per_user[connection.user_id] = count
+        else:
+            self._per_user.pop(connection.user_id, None)
+
+    def start(self):
+        if self.heartbeat_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("Heartbeat pass failed")
+
+    def tick(self):
+        now = asyncio.get_running_loop().time()
+        frames = {}
+        for connection in list(self.connections()):
+            protocol = connection.protocol
+            if connection.closed or not protocol.heartbeat:
+                continue
+            if self.idle_timeout and now - connection.last_seen > self.idle_timeout:
+                # Клиент не ответил ни на один heartbeat за idle_timeout — соединение полуоткрыто
+                self.reaped += 1
+                connection.close(code=IDLE_CLOSE_CODE, reason="Idle timeout")
+                continue
+            frame = frames.get(protocol.name)
+            if frame is None:
+                frame = frames[protocol.name] = protocol.encode({"type": "ping"})
+            connection.enqueue(frame)
@@ -1,8 +1,16 @@
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
+from app.api.router_admin import router as router_admin
+from app.api.router_metrics import router as router_metrics
 from app.api.router_page import router as router_page
-from app.api.router_socket import router as router_socket
+from app.api.router_socket import router as router_socket, manager
+from app.config import settings
 from app.database import init_db
+from app.metrics import MetricsMiddleware
+from app.persistence import message_writer
+from app.passwords import password_hasher
+from app.profiler import profiler
+from app.retention import retention_job
 from contextlib import asynccontextmanager
 import uvicorn
 
@@ -11,21 +19,44 @@ import uvicorn
 async def lifespan(app: FastAPI):
     # Инициализируем базу данных при запуске
     await init_db()
+    message_writer.start()
+    await manager.start()
+    retention_job.start()
     yield
+    await retention_job.stop()
+    await manager.stop()
+    # Дописываем накопленные сообщения перед остановкой
+    await message_writer.stop()
+    password_hasher.shutdown()
+    profiler.stop()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 app.mount('/static', StaticFiles(directory='app/static'), 'static')
 app.include_router(router_socket)
 app.include_router(router_page)
+app.include_router(router_metrics)
+app.include_router(router_admin)
 
-if __name__ == "__main__":
+def run():
+    # Запуск с настройками из окружения: python -m app.main (CHAT_WORKERS=4, CHAT_PORT=...).
+    # Под "uvicorn app.main:app" параметры ws_* отсюда не действуют — их задают ключами uvicorn (см. app/config.py)
     uvicorn.run(
         "app.main:app",
-        host="127.0.0.1",
-        port=8000,
-        reload=True,
+        host=settings.host,
+        port=settings.port,
+        workers=settings.workers,
+        reload=settings.reload,
         ws="websockets",
-        log_level="debug"
-    )
\ No newline at end of file
+        ws_max_size=settings.ws_max_size,
+        ws_per_message_deflate=settings.ws_per_message_deflate,
+        ws_ping_interval=settings.ws_ping_interval,
+        ws_ping_timeout=settings.ws_ping_timeout,
+        log_level=settings.log_level
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,243 @@
+import bisect
+import functools
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from app.config import settings
+
+# Границы гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# Счётчики и гистограммы в памяти процесса в текстовом формате Prometheus (без prometheus_client).
+# Горячие пути обновляют заранее полученный дочерний объект (labels(...)) — это одно сложение
+# или bisect по границам; enabled=false отключает обновление целиком.
+class Registry:
+    def __init__(self):
+        self.enabled = settings.metrics_enabled
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric") -> "Metric":
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional[Registry] = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_pairs(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.label_names, key))
+
+    def samples(self) -> Iterable[Tuple[str, List[Tuple[str, str]], float]]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        if REGISTRY.enabled:
+            self.value += amount
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield "_total", self._label_pairs(key), child.value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        if REGISTRY.enabled:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("child", "started")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Optional[Registry] = None
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            pairs = self._label_pairs(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", pairs + [("le", _format_value(bound))], cumulative
+            yield "_sum", pairs, child.sum
+            yield "_count", pairs, child.count
+
+
+# Значения, которые и так считают компоненты (очередь писателя, буфер истории, соединения):
+# читаются функцией в момент выгрузки, на горячем пути ничего не стоят.
+# collect возвращает число или пары (значения меток, число)
+class Collected(Metric):
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        kind: str,
+        collect: Callable[[], object],
+        labels: Sequence[str] = (),
+        registry: Optional[Registry] = None
+    ):
+        self.kind = kind
+        self.collect = collect
+        super().__init__(name, help, labels, registry)
+
+    def samples(self):
+        suffix = "_total" if self.kind == "counter" else ""
+        values = self.collect()
+        if not self.label_names:
+            yield suffix, [], values
+            return
+        for key, value in values:
+            yield suffix, self._label_pairs(tuple(str(part) for part in key)), value
+
+
+def timed(histogram: Histogram, *labels):
+    # Время выполнения корутины в гистограмму (с заданными значениями меток)
+    child = histogram.labels(*labels)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return await func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "chat_http_request_seconds", "HTTP request latency by route template", ["method", "route", "status"]
+)
+
+
+# ASGI-middleware для времени HTTP-запросов по шаблону маршрута (/room/{room_id}/history, а не по пути)
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not REGISTRY.enabled:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], route.path if route is not None else "other", status[0]
+            ).observe(time.perf_counter() - started)
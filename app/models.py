@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Index, ForeignKey, UniqueConstraint
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime, Index, ForeignKey, UniqueConstraint
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 
@@ -26,9 +26,17 @@ class Room(Base):
     name = Column(String, nullable=False)
     owner_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Политика хранения сообщений комнаты; NULL — значения по умолчанию из настроек, 0 — без ограничения
+    retention_days = Column(Integer, nullable=True)
+    retention_messages = Column(Integer, nullable=True)
     
     owner = relationship("User", back_populates="rooms")
     members = relationship("RoomMember", back_populates="room", cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        # Комнаты пользователя на главной: WHERE owner_id = ? ORDER BY created_at DESC
+        Index('idx_room_owner', 'owner_id', 'created_at'),
+    )
 
 
 class RoomMember(Base):
@@ -45,6 +53,8 @@ class RoomMember(Base):
     __table_args__ = (
         UniqueConstraint('room_id', 'user_id', name='unique_room_member'),
         Index('idx_room_member', 'room_id', 'user_id'),
+        # Комнаты, куда пригласили пользователя: WHERE user_id = ?
+        Index('idx_room_member_user', 'user_id', 'room_id'),
     )
 
 
@@ -52,14 +62,16 @@ class Message(Base):
     __tablename__ = "messages"
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    room_id = Column(Integer, nullable=False, index=True)
+    room_id = Column(Integer, nullable=False)
     user_id = Column(Integer, nullable=False)
     username = Column(String, nullable=False)
     message = Column(String, nullable=False)
-    timestamp = Column(String, nullable=False)
+    # Время отправки в миллисекундах Unix-эпохи (UTC); порядок сообщений задаёт id
+    ts = Column(BigInteger, nullable=False, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
     
     __table_args__ = (
-        Index('idx_room_id', 'room_id'),
+        # Постраничная история: WHERE room_id = ? AND id < ? ORDER BY id DESC — диапазонный скан по индексу
+        Index('idx_room_message', 'room_id', 'id'),
     )
 
@@ -0,0 +1,86 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from app.config import settings
+
+SCHEME = "scrypt"
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # hashlib.scrypt отпускает GIL, поэтому пул потоков действительно разгружает event loop
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+
+def _hash_sync(password: str, n: int, r: int, p: int) -> str:
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"{SCHEME}${n}${r}${p}${_b64(salt)}${_b64(digest)}"
+
+
+def _verify_sync(password: str, stored: str) -> Tuple[bool, bool]:
+    # (пароль верный, хэш нужно пересчитать с текущими параметрами)
+    if not stored.startswith(SCHEME + "$"):
+        # Старый формат: несолёный SHA-256
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+
+    _, n, r, p, salt, digest = stored.split("$")
+    n, r, p = int(n), int(r), int(p)
+    ok = hmac.compare_digest(_scrypt(password, base64.b64decode(salt), n, r, p), base64.b64decode(digest))
+    outdated = (n, r, p) != (settings.password_scrypt_n, settings.password_scrypt_r, settings.password_scrypt_p)
+    return ok, outdated
+
+
+# Хэширование паролей в ограниченном пуле потоков: scrypt не блокирует event loop,
+# а при наплыве логинов лишние запросы отклоняются, а не копятся в очереди.
+class PasswordHasher:
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.workers = workers or settings.password_hash_workers
+        self.max_pending = max_pending if max_pending is not None else settings.password_hash_max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self.rejected = 0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    async def _run(self, func, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool(), func, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(
+            _hash_sync, password,
+            settings.password_scrypt_n, settings.password_scrypt_r, settings.password_scrypt_p
+        )
+
+    async def verify(self, password: str, stored: str) -> Tuple[bool, bool]:
+        return await self._run(_verify_sync, password, stored)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, Optional, Tuple
+from app.config import settings
+from app.database import save_messages
+from app.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Время записи одного пакета сообщений в БД (успешной)
+FLUSH_SECONDS = Histogram("chat_persist_flush_seconds", "Time to write one message batch to the database").labels()
+
+
+# Write-behind очередь сообщений: строки копятся в памяти и вставляются в БД
+# пакетами — по достижении persist_batch_size или не чаще раза в persist_flush_interval секунд.
+# После паузы пакет пишется без задержки: id сообщения (кадр saved, а в режиме durable — сама рассылка) не ждёт окна.
+class MessageWriter:
+    def __init__(
+        self,
+        batch_size: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        max_queue_size: Optional[int] = None,
+    ):
+        self.batch_size = batch_size or settings.persist_batch_size
+        self.flush_interval = flush_interval if flush_interval is not None else settings.persist_flush_interval
+        self.max_queue_size = max_queue_size or settings.persist_queue_size
+        self._pending: Deque[Tuple[Dict, Optional[asyncio.Future], Optional[Callable[[Optional[int]], None]]]] = deque()
+        self._wakeup = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+        self._last_flush_at = 0.0
+
+        self.batches = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._running = True
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Дописываем всё, что осталось в очереди, и останавливаем фоновую задачу
+        self._running = False
+        self._wakeup.set()
+        self._batch_ready.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def save(
+        self,
+        room_id: int,
+        user_id: int,
+        username: str,
+        message: str,
+        ts: int,
+        wait: bool = False,
+        on_saved: Optional[Callable[[Optional[int]], None]] = None,
+    ):
+        # on_saved получает id строки, когда пакет записан в БД (None — запись не удалась)
+        row = {
+            "room_id": room_id,
+            "user_id": user_id,
+            "username": username,
+            "message": message,
+            "ts": ts,
+            "created_at": datetime.utcfromtimestamp(ts / 1000),
+        }
+        if self._task is None:
+            # Писатель не запущен (скрипты, тесты) — пишем сразу
+            ids = await save_messages([row])
+            if on_saved is not None:
+                on_saved(ids[0])
+            return
+
+        while len(self._pending) >= self.max_queue_size:
+            self._space.clear()
+            await self._space.wait()
+
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._pending.append((row, future, on_saved))
+        self._wakeup.set()
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+        if future is not None:
+            await future
+
+    async def _run(self):
+        while self._running or self._pending:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # После паузы пакет пишется сразу; под нагрузкой — не чаще раза в flush_interval,
+            # сообщения за это время копятся в следующий пакет
+            delay = self._last_flush_at + self.flush_interval - asyncio.get_running_loop().time()
+            if self._running and len(self._pending) < self.batch_size and delay > 0:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            self._space.set()
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            ids = await save_messages([row for row, _, _ in batch])
+        except Exception as exc:
+            logger.exception("Failed to persist %d messages", len(batch))
+            self.rows_failed += len(batch)
+            self._last_flush_at = asyncio.get_running_loop().time()
+            for _, future, on_saved in batch:
+                if on_saved is not None:
+                    on_saved(None)
+                if future is not None and not future.done():
+                    future.set_exception(exc)
+            return
+
+        FLUSH_SECONDS.observe(time.perf_counter() - started)
+        self._last_flush_at = asyncio.get_running_loop().time()
+        self.batches += 1
+        self.rows_written += len(batch)
+        for (_, future, on_saved), message_id in zip(batch, ids):
+            if on_saved is not None:
+                on_saved(message_id)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+
+message_writer = MessageWriter()
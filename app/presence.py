@@ -0,0 +1,149 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from app.config import settings
+
+PresenceChange = Callable[[int, Dict[int, str], Dict[int, str]], None]
+
+
+# Кто онлайн в комнатах. Пользователь онлайн, пока у него есть хотя бы одно соединение
+# (вкладка) хотя бы в одном воркере. Воркеры обмениваются только переходами
+# «первое соединение / последнее соединение» через брокер, а не каждым подключением:
+# - уход фиксируется через presence_grace секунд после закрытия последнего соединения,
+#   так что переподключение (обновление страницы, обрыв сети) не порождает событий;
+# - уведомления комнате копятся presence_window секунд и уходят одним кадром,
+#   поэтому шторм из тысяч подключений даёт O(N) кадров, а не O(N²).
+class PresenceTracker:
+    def __init__(self, grace: Optional[float] = None, window: Optional[float] = None):
+        self.grace = grace if grace is not None else settings.presence_grace
+        self.window = window if window is not None else settings.presence_window
+        self.node_id = ""
+        self.publish: Optional[Callable[[Dict], Awaitable[None]]] = None
+        self.on_change: Optional[PresenceChange] = None
+        # Соединения этого воркера: (room_id, user_id) -> число
+        self._local: Dict[Tuple[int, int], int] = {}
+        self._local_names: Dict[Tuple[int, int], str] = {}
+        self._leaving: Dict[Tuple[int, int], asyncio.Task] = {}
+        # Общая картина: room_id -> user_id -> воркеры, где у пользователя есть соединения
+        self._online: Dict[int, Dict[int, Set[str]]] = {}
+        self._names: Dict[int, str] = {}
+        # Ещё не разосланные изменения по комнатам
+        self._joined: Dict[int, Dict[int, str]] = {}
+        self._left: Dict[int, Dict[int, str]] = {}
+        self._flush_handles: Dict[int, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def online_users(self, room_id: int) -> List[Dict]:
+        return [{"id": user_id, "name": self._names.get(user_id, "")} for user_id in self._online.get(room_id, {})]
+
+    def online_count(self, room_id: int) -> int:
+        return len(self._online.get(room_id, {}))
+
+    def connections(self, room_id: int, user_id: int) -> int:
+        return self._local.get((room_id, user_id), 0)
+
+    async def connection_opened(self, room_id: int, user_id: int, username: str):
+        key = (room_id, user_id)
+        self._local[key] = self._local.get(key, 0) + 1
+        self._local_names[key] = username
+        if self._local[key] > 1:
+            return
+        leaving = self._leaving.pop(key, None)
+        if leaving is not None:
+            # Переподключение в пределах presence_grace: для комнаты пользователь и не уходил
+            leaving.cancel()
+            return
+        await self._publish(room_id, user_id, username, True)
+
+    def connection_closed(self, room_id: int, user_id: int):
+        key = (room_id, user_id)
+        count = self._local.get(key, 0) - 1
+        if count > 0:
+            self._local[key] = count
+            return
+        self._local.pop(key, None)
+        if key not in self._leaving:
+            self._leaving[key] = asyncio.create_task(self._leave_later(room_id, user_id))
+
+    async def _leave_later(self, room_id: int, user_id: int):
+        key = (room_id, user_id)
+        try:
+            await asyncio.sleep(self.grace)
+        except asyncio.CancelledError:
+            return
+        self._leaving.pop(key, None)
+        await self._publish(room_id, user_id, self._local_names.pop(key, ""), False)
+
+    async def _publish(self, room_id: int, user_id: int, username: str, online: bool):
+        event = {"type": "presence", "room_id": room_id, "user_id": user_id, "name": username, "online": online}
+        if self.publish is None:
+            event["origin"] = self.node_id
+            self.apply(event)
+        else:
+            await self.publish(event)
+
+    async def sync(self):
+        # Новый воркер просит остальных заново объявить своих пользователей
+        if self.publish is not None:
+            await self.publish({"type": "presence_sync"})
+
+    def announce(self):
+        # Ответ на presence_sync: повторно объявляем пользователей с соединениями в этом воркере
+        task = asyncio.create_task(self._announce())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _announce(self):
+        for (room_id, user_id), username in list(self._local_names.items()):
+            if (room_id, user_id) in self._local:
+                await self._publish(room_id, user_id, username, True)
+
+    async def stop(self):
+        for task in list(self._leaving.values()) + list(self._tasks):
+            task.cancel()
+        self._leaving.clear()
+        for handle in self._flush_handles.values():
+            handle.cancel()
+        self._flush_handles.clear()
+
+    def apply(self, event: Dict):
+        room_id, user_id, node = event["room_id"], event["user_id"], event.get("origin", "")
+        room = self._online.get(room_id, {})
+        nodes = room.get(user_id)
+        if event["online"]:
+            room = self._online.setdefault(room_id, room)
+            if event["name"]:
+                self._names[user_id] = event["name"]
+            if nodes is not None:
+                # Пользователь уже онлайн через другой воркер
+                nodes.add(node)
+                return
+            room[user_id] = {node}
+            if self._left.get(room_id, {}).pop(user_id, None) is None:
+                self._joined.setdefault(room_id, {})[user_id] = self._names.get(user_id, "")
+        else:
+            if nodes is None:
+                return
+            nodes.discard(node)
+            if nodes:
+                return
+            del room[user_id]
+            if not room:
+                del self._online[room_id]
+            if self._joined.get(room_id, {}).pop(user_id, None) is None:
+                self._left.setdefault(room_id, {})[user_id] = self._names.get(user_id, "")
+        self._schedule(room_id)
+
+    def _schedule(self, room_id: int):
+        if room_id in self._flush_handles:
+            return
+        if self.window <= 0:
+            self._flush(room_id)
+            return
+        self._flush_handles[room_id] = asyncio.get_running_loop().call_later(self.window, self._flush, room_id)
+
+    def _flush(self, room_id: int):
+        self._flush_handles.pop(room_id, None)
+        joined = self._joined.pop(room_id, {})
+        left = self._left.pop(room_id, {})
+        if (joined or left) and self.on_change is not None:
+            self.on_change(room_id, joined, left)
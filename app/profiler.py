@@ -0,0 +1,87 @@
+import sys
+import threading
+from collections import Counter
+from typing import Dict, Optional
+from app.config import settings
+
+OTHER_STACK = "[other]"
+MAX_DEPTH = 64
+
+
+def _frame_name(frame) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)}"
+
+
+def _fold(frame) -> str:
+    # Стек от корня к листу через ";" — формат folded stacks для flamegraph.pl / speedscope
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Семплирующий профилировщик потока цикла событий: отдельный поток раз в interval секунд
+# снимает его текущий стек (sys._current_frames) и считает одинаковые стеки.
+# Пока выключен, ничего не стоит; включается и выключается на ходу (POST /metrics/profiler).
+class SamplingProfiler:
+    def __init__(self, interval: Optional[float] = None, max_stacks: Optional[int] = None):
+        self.interval = interval or settings.profiler_interval
+        self.max_stacks = max_stacks or settings.profiler_max_stacks
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._target: Optional[int] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: Optional[float] = None):
+        # Вызывается из потока цикла событий — его и профилируем
+        if interval:
+            self.interval = interval
+        if self.running:
+            return
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        self.stacks.clear()
+        self.samples = 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = _fold(frame)
+            del frame
+            if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                stack = OTHER_STACK
+            self.stacks[stack] += 1
+            self.samples += 1
+
+    def status(self) -> Dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+        }
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,211 @@
+import json
+import struct
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Union
+from app.encoding import encode_batch, encode_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+def now_ms() -> int:
+    # Время события в миллисекундах Unix-эпохи (UTC) — так оно хранится в messages.ts и уходит в кадрах
+    return int(time.time() * 1000)
+
+
+def clock_time(ts: int) -> str:
+    # "ЧЧ:ММ" по местному времени сервера для кадров chat.v1
+    return datetime.fromtimestamp(ts / 1000).strftime("%H:%M")
+
+
+# Сколько имён chat.v1 перечисляет в уведомлении о входе / выходе, дальше — только число
+PRESENCE_V1_NAMES = 5
+
+
+# Версия протокола выбирается при рукопожатии через Sec-WebSocket-Protocol.
+# chat.v1 — прежний формат: готовая строка "{username} (ID: {id}): {текст}", флаг is_self и время "ЧЧ:ММ";
+# кадр разный для отправителя и остальных.
+# chat.v2.* — структурированные поля (id, sender_id, sender, ts в мс, body); один кадр на всех получателей,
+# is_self клиент вычисляет сам. chat.v2.msgpack — то же в бинарных кадрах MessagePack.
+class Protocol:
+    name = ""
+    binary = False
+    per_recipient = False
+    # Клиент отвечает на {"type": "ping"} кадром {"type": "pong"}
+    heartbeat = False
+
+    def decode(self, data: Frame) -> Dict:
+        # Кадр от клиента в виде запроса {"type": ...}; chat.v1 присылает просто текст сообщения
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", errors="replace")
+        return {"type": "message", "body": data}
+
+    def message(self, event: Dict, user_id: int) -> Dict:
+        raise NotImplementedError
+
+    def encode(self, data) -> Frame:
+        return encode_json(data)
+
+    def encode_batch(self, frames: List[Frame]) -> Frame:
+        return encode_batch(frames)
+
+    def encode_message(self, event: Dict, user_id: int) -> Frame:
+        return self.encode(self.message(event, user_id))
+
+    def variant(self, event: Dict, user_id: int):
+        # Ключ, по которому закодированный кадр переиспользуется между получателями
+        return (self.name, event["sender_id"] == user_id) if self.per_recipient else self.name
+
+    def presence(self, joined: Dict[int, str], left: Dict[int, str], event: Dict) -> Union[Frame, List[Frame]]:
+        # Кадр одинаков для всех получателей: иначе пачка из N входов стоила бы N² кодирований
+        raise NotImplementedError
+
+    def online(self, users: List[Dict]) -> Optional[Frame]:
+        # Список онлайн при подключении; None — версия протокола его не передаёт
+        return None
+
+    def saved(self, ids: Dict[str, int]) -> Optional[Frame]:
+        # id из БД для уже разосланных сообщений (ref -> id); None — версия протокола их не передаёт
+        return None
+
+    def error(self, code: str, text: str, **fields) -> Frame:
+        # Уведомление только этому клиенту (например, сообщение отброшено ограничением частоты)
+        return self.encode({"type": "error", "code": code, "text": text, **fields})
+
+    def batch_variant(self, senders: Set[int], user_id: int):
+        # То же для пачки событий: в chat.v1 свой кадр только у тех, кто сам писал в пачку
+        if not self.per_recipient:
+            return self.name
+        return (self.name, user_id if user_id in senders else None)
+
+
+class ProtocolV1(Protocol):
+    name = "chat.v1"
+    per_recipient = True
+
+    def message(self, event: Dict, user_id: int) -> Dict:
+        if event.get("system"):
+            text = event["body"]
+        else:
+            text = f"{event['sender']} (ID: {event['sender_id']}): {event['body']}"
+        frame = {"text": text, "is_self": event["sender_id"] == user_id, "timestamp": event["timestamp"]}
+        if event.get("id") is not None:
+            # id сообщения в БД: курсор для более старых страниц истории и для resync после переподключения
+            frame["id"] = event["id"]
+        return frame
+
+    def presence(self, joined: Dict[int, str], left: Dict[int, str], event: Dict) -> Union[Frame, List[Frame]]:
+        # Старые клиенты видят вход и выход как системные строки; при массовом входе — одну сводную
+        texts = []
+        for users, action, summary in (
+            (joined, "присоединился к чату.", "присоединились к чату"),
+            (left, "покинул чат.", "покинули чат")
+        ):
+            if len(users) > PRESENCE_V1_NAMES:
+                texts.append(f"{len(users)} участников {summary}.")
+            else:
+                texts.extend(f"{name} (ID: {uid}) {action}" for uid, name in users.items())
+        frames = [self.encode({"text": text, "is_self": False, "timestamp": event["timestamp"]}) for text in texts]
+        return frames[0] if len(frames) == 1 else frames
+
+    def error(self, code: str, text: str, **fields) -> Frame:
+        # Старые клиенты показывают его как системную строку
+        return self.encode({"text": text, "is_self": False, "timestamp": clock_time(now_ms())})
+
+
+class ProtocolV2(Protocol):
+    name = "chat.v2.json"
+    heartbeat = True
+
+    def decode(self, data: Frame) -> Dict:
+        # Запросы — JSON-объекты с полем type ({"type": "message", "body": ...}, {"type": "pong"},
+        # {"type": "resync", "after_id": ...}); любой другой текст считается сообщением
+        if isinstance(data, str) and data.startswith("{"):
+            try:
+                request = json.loads(data)
+            except ValueError:
+                request = None
+            if isinstance(request, dict) and isinstance(request.get("type"), str):
+                return request
+        return super().decode(data)
+
+    def message(self, event: Dict, user_id: int) -> Dict:
+        frame = {
+            "type": "system" if event.get("system") else "message",
+            "id": event.get("id"),
+            "sender_id": event["sender_id"],
+            "sender": event["sender"],
+            "ts": event["ts"],
+            "body": event["body"]
+        }
+        if frame["id"] is None and event.get("ref"):
+            # Сообщение разослано до записи в БД: его id придёт кадром saved с этим ref
+            frame["ref"] = event["ref"]
+        return frame
+
+    def presence(self, joined: Dict[int, str], left: Dict[int, str], event: Dict) -> Union[Frame, List[Frame]]:
+        return self.encode({
+            "type": "presence",
+            "joined": [{"id": uid, "name": name} for uid, name in joined.items()],
+            "left": [{"id": uid, "name": name} for uid, name in left.items()],
+            "ts": event["ts"]
+        })
+
+    def online(self, users: List[Dict]) -> Optional[Frame]:
+        return self.encode({"type": "presence", "online": users})
+
+    def saved(self, ids: Dict[str, int]) -> Optional[Frame]:
+        return self.encode({"type": "saved", "ids": ids})
+
+
+def _msgpack_array_header(size: int) -> bytes:
+    if size < 16:
+        return bytes([0x90 | size])
+    if size < 2 ** 16:
+        return b"\xdc" + struct.pack(">H", size)
+    return b"\xdd" + struct.pack(">I", size)
+
+
+class ProtocolV2MessagePack(ProtocolV2):
+    name = "chat.v2.msgpack"
+    binary = True
+
+    def encode(self, data) -> Frame:
+        return msgpack.packb(data)
+
+    def decode(self, data: Frame) -> Dict:
+        if isinstance(data, bytes):
+            try:
+                request = msgpack.unpackb(data)
+            except Exception:
+                request = None
+            if isinstance(request, dict) and isinstance(request.get("type"), str):
+                return request
+        return super().decode(data)
+
+    def encode_batch(self, frames: List[Frame]) -> Frame:
+        # Массив MessagePack — заголовок и подряд уже упакованные элементы
+        return _msgpack_array_header(len(frames)) + b"".join(frames)
+
+
+LEGACY = ProtocolV1()
+
+# Порядок — предпочтение сервера
+PROTOCOLS = [ProtocolV2MessagePack(), ProtocolV2(), LEGACY]
+if msgpack is None:
+    PROTOCOLS = PROTOCOLS[1:]
+SUPPORTED = {protocol.name: protocol for protocol in PROTOCOLS}
+
+
+def negotiate(requested: List[str]) -> Optional[Protocol]:
+    # Без заголовка Sec-WebSocket-Protocol работаем по chat.v1, как старые клиенты
+    if not requested:
+        return LEGACY
+    for protocol in PROTOCOLS:
+        if protocol.name in requested:
+            return protocol
+    return None
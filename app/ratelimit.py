@@ -0,0 +1,86 @@
+import time
+from typing import Dict, Optional
+from app.config import settings
+from app.metrics import Counter
+
+THROTTLE = "throttle"
+DROP = "drop"
+DISCONNECT = "disconnect"
+
+LIMITED_MESSAGES = Counter(
+    "chat_messages_limited", "Client frames throttled, dropped or refused by flood control", ["reason", "action"]
+)
+
+
+# Token bucket: rate токенов в секунду, не больше burst. Пополняется лениво при обращении —
+# без таймеров, O(1) на сообщение
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float, cost: float = 1.0) -> float:
+        # Сколько секунд ждать, пока наберётся cost токенов (0 — уже есть)
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float = 1.0):
+        # Списывает токены, в режиме throttle — в долг: следующие ждут, пока долг не покроется
+        self.tokens -= cost
+
+
+# Лимиты сообщений от клиентов: у каждого соединения свой bucket, у комнаты — общий на все её
+# соединения в этом воркере. Флуд в одной комнате не отнимает у других цикл событий,
+# рассылку и запись в БД
+class RateLimiter:
+    def __init__(self):
+        self.action = settings.flood_action
+        self.max_delay = settings.rate_limit_max_delay
+        self.rooms: Dict[int, TokenBucket] = {}
+
+    def connection_bucket(self) -> Optional[TokenBucket]:
+        if settings.rate_limit_per_connection <= 0:
+            return None
+        return TokenBucket(settings.rate_limit_per_connection, settings.rate_limit_connection_burst)
+
+    def _room_bucket(self, room_id: int) -> Optional[TokenBucket]:
+        if settings.rate_limit_per_room <= 0:
+            return None
+        bucket = self.rooms.get(room_id)
+        if bucket is None:
+            bucket = self.rooms[room_id] = TokenBucket(settings.rate_limit_per_room, settings.rate_limit_room_burst)
+        return bucket
+
+    def forget_room(self, room_id: int):
+        # Последнее соединение комнаты закрыто
+        self.rooms.pop(room_id, None)
+
+    def admit(self, room_id: Optional[int], bucket: Optional[TokenBucket]) -> Optional[float]:
+        # None — кадр отклонён; иначе через сколько секунд его обработать (0 — сразу).
+        # room_id=None — кадр, который не рассылается комнате (ping, resync и т. п.), расходует только лимит соединения
+        buckets = [b for b in (bucket, self._room_bucket(room_id) if room_id is not None else None) if b is not None]
+        if not buckets:
+            return 0.0
+        now = time.monotonic()
+        wait = max(b.delay(now) for b in buckets)
+        if wait > 0:
+            if self.action != THROTTLE or wait > self.max_delay:
+                LIMITED_MESSAGES.labels("rate", DROP if self.action == THROTTLE else self.action).inc()
+                return None
+            LIMITED_MESSAGES.labels("rate", THROTTLE).inc()
+        for b in buckets:
+            b.take()
+        return wait
+
+    def refuse_size(self):
+        LIMITED_MESSAGES.labels("size", DISCONNECT if self.action == DISCONNECT else DROP).inc()
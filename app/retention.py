@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from app.archive import MessageArchive, message_archive
+from app.config import settings
+from app.database import (
+    delete_messages, engine, get_message_id_from_end, get_oldest_messages, get_retention_policies,
+    incremental_vacuum
+)
+from app.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Время одного прохода политик хранения по всем комнатам (включая паузы между пачками)
+RUN_SECONDS = Histogram(
+    "chat_retention_run_seconds", "Duration of one retention pass",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0)
+).labels()
+
+
+# Фоновое применение политик хранения: раз в retention_interval секунд для каждой комнаты
+# самые старые сообщения сверх лимита (по возрасту или количеству) пачками переносятся в архив.
+# Каждая пачка — отдельная короткая транзакция с паузой после неё, так что живые сообщения
+# пишутся между пачками; освободившиеся страницы SQLite возвращаются шагами incremental_vacuum.
+class RetentionJob:
+    def __init__(
+        self,
+        archive: Optional[MessageArchive] = None,
+        interval: Optional[float] = None,
+        chunk_size: Optional[int] = None,
+        chunk_pause: Optional[float] = None,
+    ):
+        self.archive = archive or message_archive
+        self.interval = interval if interval is not None else settings.retention_interval
+        self.chunk_size = chunk_size or settings.retention_chunk_size
+        self.chunk_pause = chunk_pause if chunk_pause is not None else settings.retention_chunk_pause
+        self._task: Optional[asyncio.Task] = None
+        self._vacuum_hint_logged = False
+
+        self.runs = 0
+        self.rows_archived = 0
+        self.segments_written = 0
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Retention pass failed")
+
+    async def run_once(self) -> int:
+        started = time.perf_counter()
+        archived = 0
+        for policy in await get_retention_policies():
+            max_age_days = policy["max_age_days"]
+            max_messages = policy["max_messages"]
+            archived += await self.apply(
+                policy["room_id"],
+                settings.retention_max_age_days if max_age_days is None else max_age_days,
+                settings.retention_max_messages if max_messages is None else max_messages
+            )
+        if archived:
+            await self.vacuum()
+        self.runs += 1
+        RUN_SECONDS.observe(time.perf_counter() - started)
+        return archived
+
+    async def apply(self, room_id: int, max_age_days: int, max_messages: int) -> int:
+        if not max_age_days and not max_messages:
+            return 0
+        # Граница по количеству: всё, что старше max_messages-го сообщения с конца
+        keep_from_id = await get_message_id_from_end(room_id, max_messages) if max_messages else None
+        cutoff = datetime.utcnow() - timedelta(days=max_age_days) if max_age_days else None
+
+        def expired(row: Dict) -> bool:
+            if keep_from_id is not None and row["id"] < keep_from_id:
+                return True
+            return cutoff is not None and row["created_at"] is not None and row["created_at"] < cutoff
+
+        archived = 0
+        while True:
+            rows = await get_oldest_messages(room_id, self.chunk_size)
+            fetched = len(rows)
+            # Сообщения идут по возрастанию id: берём устаревший префикс пачки
+            count = 0
+            while count < fetched and expired(rows[count]):
+                count += 1
+            if count == 0:
+                return archived
+            rows = rows[:count]
+            await asyncio.to_thread(self.archive.write_segment, room_id, rows)
+            await delete_messages(room_id, rows[0]["id"], rows[-1]["id"])
+            archived += count
+            self.rows_archived += count
+            self.segments_written += 1
+            await asyncio.sleep(self.chunk_pause)
+            if count < fetched or fetched < self.chunk_size:
+                return archived
+
+    async def vacuum(self):
+        while True:
+            remaining = await incremental_vacuum(settings.retention_vacuum_pages)
+            if remaining is None:
+                if not self._vacuum_hint_logged:
+                    self._vacuum_hint_logged = True
+                    logger.info("SQLite auto_vacuum is not INCREMENTAL; run `python -m app.retention --vacuum` once "
+                                "to reclaim space from archived messages")
+                return
+            if not remaining:
+                return
+            await asyncio.sleep(self.chunk_pause)
+
+
+retention_job = RetentionJob()
+
+
+async def _vacuum_full():
+    # Разовый перевод существующей БД SQLite в auto_vacuum=INCREMENTAL с полным VACUUM (блокирует запись)
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.commit()
+        # VACUUM нельзя выполнить внутри транзакции
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.exec_driver_sql("VACUUM")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Применить политики хранения сообщений")
+    parser.add_argument("--vacuum", action="store_true", help="перевести SQLite в auto_vacuum=INCREMENTAL (VACUUM)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.vacuum:
+        asyncio.run(_vacuum_full())
+        return
+    archived = asyncio.run(retention_job.run_once())
+    print(f"archived {archived} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.connection import ClientConnection
+
+
+# Соединения одной комнаты этого воркера и её собственное состояние рассылки.
+# Вход и выход — O(1) (dict сохраняет порядок подключения); рассылка идёт по неизменяемому снимку
+# (кортежу), который собирается при первой рассылке после изменения состава и переиспользуется
+# до следующего. Пока по снимку идёт рассылка, входы и выходы меняют только dict
+class RoomConnections:
+    __slots__ = ("room_id", "_connections", "_snapshot", "last_delivery", "pending", "flush_handle")
+
+    def __init__(self, room_id: int):
+        self.room_id = room_id
+        self._connections: Dict[ClientConnection, None] = {}
+        self._snapshot: Optional[Tuple[ClientConnection, ...]] = None
+        # Склейка кадров: время последней доставки и события, ждущие конца окна
+        self.last_delivery: Optional[float] = None
+        self.pending: Optional[List[Dict]] = None
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def __contains__(self, connection: ClientConnection) -> bool:
+        return connection in self._connections
+
+    def add(self, connection: ClientConnection):
+        self._connections[connection] = None
+        self._snapshot = None
+
+    def discard(self, connection: ClientConnection) -> bool:
+        if self._connections.pop(connection, False) is False:
+            return False
+        self._snapshot = None
+        return True
+
+    @property
+    def snapshot(self) -> Tuple[ClientConnection, ...]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._snapshot = tuple(self._connections)
+        return snapshot
+
+    def cancel_flush(self) -> Optional[List[Dict]]:
+        # Снимает отложенную доставку и возвращает накопленные события
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        events, self.pending = self.pending, None
+        return events
+
+
+# Комнаты воркера по room_id. Всё состояние комнаты (соединения, склейка) живёт в её RoomConnections
+# и удаляется вместе с ней, когда выходит последний участник
+class RoomRegistry:
+    def __init__(self):
+        self._rooms: Dict[int, RoomConnections] = {}
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def __contains__(self, room_id: int) -> bool:
+        return room_id in self._rooms
+
+    def get(self, room_id: int) -> Optional[RoomConnections]:
+        return self._rooms.get(room_id)
+
+    def join(self, connection: ClientConnection) -> RoomConnections:
+        room = self._rooms.get(connection.room_id)
+        if room is None:
+            room = self._rooms[connection.room_id] = RoomConnections(connection.room_id)
+        room.add(connection)
+        return room
+
+    def leave(self, connection: ClientConnection) -> Optional[RoomConnections]:
+        # Комната, из которой вышло соединение, или None, если его там не было.
+        # Пустая комната удаляется вместе с отложенной доставкой: получателей в этом воркере больше нет
+        room = self._rooms.get(connection.room_id)
+        if room is None or not room.discard(connection):
+            return None
+        if not room:
+            del self._rooms[connection.room_id]
+            room.cancel_flush()
+        return room
+
+    def snapshot(self, room_id: int) -> Tuple[ClientConnection, ...]:
+        room = self._rooms.get(room_id)
+        return room.snapshot if room is not None else ()
+
+    def rooms(self) -> List[RoomConnections]:
+        return list(self._rooms.values())
+
+    def connections(self) -> Iterator[ClientConnection]:
+        for room in self.rooms():
+            yield from room.snapshot
+
+    def sizes(self) -> List[Tuple[int, int]]:
+        return [(room.room_id, len(room)) for room in self.rooms()]
@@ -0,0 +1,80 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import time
+from typing import Dict, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.cache import TTLCache
+from app.config import settings
+from app.models import User
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "session"
+
+if settings.session_secret:
+    _secret = settings.session_secret.encode()
+else:
+    # Без CHAT_SESSION_SECRET сессии не переживут перезапуск и не будут общими для воркеров
+    logger.warning("CHAT_SESSION_SECRET is not set, using a random per-process secret")
+    _secret = secrets.token_bytes(32)
+
+# Пользователи по id: проверка сессии обходится без запроса к БД
+user_cache = TTLCache(settings.user_cache_ttl, settings.user_cache_size)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_secret, payload.encode(), hashlib.sha256).digest())
+
+
+# Токен сессии: payload (id, username, срок действия) и его HMAC-подпись
+def issue_token(user_id: int, username: str) -> str:
+    payload = _b64encode(json.dumps(
+        {"uid": user_id, "name": username, "exp": int(time.time()) + settings.session_ttl},
+        separators=(",", ":")
+    ).encode())
+    return f"{payload}.{_sign(payload)}"
+
+
+def read_token(token: Optional[str]) -> Optional[Dict]:
+    if not token or "." not in token:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        data = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if data.get("exp", 0) < time.time():
+        return None
+    return data
+
+
+async def get_session_user(token: Optional[str], session: AsyncSession) -> Optional[User]:
+    data = read_token(token)
+    if data is None:
+        return None
+    user_id = data["uid"]
+    user = user_cache.get(user_id)
+    if user is None:
+        generation = user_cache.generation
+        result = await session.get(User, user_id)
+        if result is None:
+            return None
+        # Кэшируем отсоединённый от сессии объект: его поля уже загружены
+        session.expunge(result)
+        user_cache.set(user_id, result, generation=generation)
+        user = result
+    return user
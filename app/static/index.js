@@ -4,14 +4,45 @@ const roomId = roomData.getAttribute("data-room-id");
 const username = roomData.getAttribute("data-username");
 const userId = roomData.getAttribute("data-user-id");
 
-// Создаем WebSocket соединение
-const ws = new WebSocket(`ws://127.0.0.1:8000/ws/chat/${roomId}/${userId}?username=${encodeURIComponent(username)}`);
+// WebSocket соединение (пользователь определяется по cookie сессии).
+// chat.v2.json присылает структурированные сообщения; chat.v1 — запасной вариант для старого сервера
+const wsProtocol = location.protocol === "https:" ? "wss" : "ws";
+let ws = null;
 
-// Обрабатываем входящие сообщения
-ws.onmessage = (event) => {
-    const messages = document.getElementById("messages");
-    const messageData = JSON.parse(event.data);
+// Курсор для подгрузки более старой истории
+let historyBeforeId = null;
+
+// id последнего показанного сообщения: после переподключения сервер пришлёт только пропущенные
+let lastMessageId = null;
+// Сообщения, разосланные до записи в БД (ref -> элемент): их id придёт кадром saved
+const pendingMessages = new Map();
+let reconnectDelay = 1000;
+
+// Кто онлайн в комнате (id -> имя); обновляется кадрами presence протокола chat.v2
+const onlineUsers = new Map();
+
+// Приводим сообщение chat.v2 к виду для отрисовки: свой / чужой, текст и время
+function normalizeMessage(messageData) {
+    if (ws.protocol !== "chat.v2.json") {
+        return messageData;
+    }
+    const time = messageData.ts
+        ? new Date(messageData.ts).toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" })
+        : "";
+    const text = messageData.type === "system"
+        ? messageData.body
+        : `${messageData.sender} (ID: ${messageData.sender_id}): ${messageData.body}`;
+    return {
+        text: text,
+        is_self: messageData.type !== "system" && String(messageData.sender_id) === String(userId),
+        timestamp: time
+    };
+}
+
+// Создаём элемент одного сообщения
+function buildMessage(rawMessage) {
     const message = document.createElement("div");
+    const messageData = normalizeMessage(rawMessage);
 
     // Определяем стили в зависимости от отправителя
     if (messageData.is_self) {
@@ -21,15 +52,141 @@ ws.onmessage = (event) => {
     }
 
     message.innerHTML = `<span>${messageData.text}</span><span class="text-xs ${messageData.is_self ? 'text-gray-300' : 'text-gray-500'} ml-auto">${messageData.timestamp || ''}</span>`;
-    messages.appendChild(message);
+    if (rawMessage.ref) {
+        pendingMessages.set(rawMessage.ref, message);
+    }
+    return message;
+}
+
+// Новые сообщения в конец чата: пропускаем уже показанные (после resync они могут прийти повторно)
+function appendMessages(batch) {
+    const fresh = batch.filter((messageData) => messageData.id == null || lastMessageId === null || messageData.id > lastMessageId);
+    fresh.forEach((messageData) => {
+        if (messageData.id != null) {
+            lastMessageId = messageData.id;
+        }
+    });
+    renderMessages(fresh);
+}
+
+// Отрисовываем пачку сообщений за одну вставку в DOM (в конец или, для старой истории, перед указанным элементом)
+function renderMessages(batch, beforeNode = null) {
+    const fragment = document.createDocumentFragment();
+    batch.forEach((messageData) => fragment.appendChild(buildMessage(messageData)));
+    document.getElementById("messages").insertBefore(fragment, beforeNode);
+}
+
+// Кадр saved: id из БД для уже показанных сообщений — по ним идёт resync после переподключения
+function handleSaved(data) {
+    Object.entries(data.ids).forEach(([ref, id]) => {
+        pendingMessages.delete(ref);
+        if (lastMessageId === null || id > lastMessageId) {
+            lastMessageId = id;
+        }
+    });
+}
+
+// Сообщения без подтверждённого id resync пришлёт заново (если они записаны), поэтому убираем их
+function dropPendingMessages() {
+    pendingMessages.forEach((element) => element.remove());
+    pendingMessages.clear();
+}
+
+// Запоминаем курсор и показываем кнопку, если есть более старые сообщения
+function updateHistoryCursor(page) {
+    historyBeforeId = page.before_id;
+    document.getElementById("loadOlder").classList.toggle("hidden", !page.has_more);
+}
+
+// Подгружаем предыдущую страницу истории
+async function loadOlderMessages() {
+    if (historyBeforeId === null) {
+        return;
+    }
+    const protocol = ws.protocol || "chat.v1";
+    const response = await fetch(`/room/${roomId}/history?before_id=${historyBeforeId}&protocol=${protocol}`);
+    const page = await response.json();
+    if (!page.success) {
+        return;
+    }
+    const messages = document.getElementById("messages");
+    const firstMessage = messages.firstChild;
+    const previousHeight = messages.scrollHeight;
+    renderMessages(page.messages, firstMessage);
+    messages.scrollTop += messages.scrollHeight - previousHeight;
+    updateHistoryCursor(page);
+}
+
+// Показываем список онлайн
+function renderOnline() {
+    const names = Array.from(onlineUsers.values()).sort();
+    document.getElementById("online").textContent = `Онлайн (${names.length}): ${names.join(", ")}`;
+}
+
+// Кадр presence: полный список при подключении или вошедшие и вышедшие за последнее окно
+function handlePresence(data) {
+    if (data.online) {
+        onlineUsers.clear();
+        data.online.forEach((user) => onlineUsers.set(user.id, user.name));
+    } else {
+        const notices = [];
+        data.joined.forEach((user) => {
+            onlineUsers.set(user.id, user.name);
+            notices.push({ type: "system", ts: data.ts, body: `${user.name} (ID: ${user.id}) присоединился к чату.` });
+        });
+        data.left.forEach((user) => {
+            onlineUsers.delete(user.id);
+            notices.push({ type: "system", ts: data.ts, body: `${user.name} (ID: ${user.id}) покинул чат.` });
+        });
+        renderMessages(notices);
+    }
+    renderOnline();
+}
+
+// Обрабатываем входящие сообщения (в оживлённой комнате сервер склеивает сообщения в массив)
+function handleFrame(event) {
+    const messages = document.getElementById("messages");
+    const data = JSON.parse(event.data);
+    if (data.type === "history") {
+        // История при подключении приходит одним кадром; после долгого разрыва — заново целиком
+        messages.innerHTML = "";
+        pendingMessages.clear();
+        lastMessageId = null;
+        appendMessages(data.messages);
+        updateHistoryCursor(data);
+    } else if (data.type === "resync") {
+        // Пропущенные за время разрыва сообщения; продолжение — следующим запросом
+        dropPendingMessages();
+        appendMessages(data.messages);
+        if (data.has_more && ws.protocol === "chat.v2.json") {
+            ws.send(JSON.stringify({ type: "resync", after_id: data.last_id }));
+        }
+    } else if (data.type === "saved") {
+        handleSaved(data);
+        return;
+    } else if (data.type === "presence") {
+        handlePresence(data);
+    } else if (data.type === "error") {
+        // Сервер отбросил наше сообщение (слишком часто или слишком длинное)
+        renderMessages([{ type: "system", ts: Date.now(), body: data.text }]);
+    } else if (data.type === "ping") {
+        // Heartbeat сервера: без ответа соединение закроют как молчащее
+        ws.send(JSON.stringify({ type: "pong" }));
+        return;
+    } else if (data.type === "pong") {
+        return;
+    } else {
+        appendMessages(Array.isArray(data) ? data : [data]);
+    }
     messages.scrollTop = messages.scrollHeight;
-};
+}
 
 // Отправка сообщений
 function sendMessage() {
     const input = document.getElementById("messageInput");
     if (input.value.trim()) {
-        ws.send(input.value);
+        // В chat.v2 запросы к серверу — JSON-объекты с полем type
+        ws.send(ws.protocol === "chat.v2.json" ? JSON.stringify({ type: "message", body: input.value }) : input.value);
         input.value = '';
     }
 }
@@ -41,19 +198,33 @@ document.getElementById("messageInput").addEventListener("keypress", (e) => {
     }
 });
 
-// Обработка состояния соединения
-ws.onopen = () => {
-    console.log("✅ Соединение установлено");
-};
-
-ws.onclose = (event) => {
-    console.log("❌ Соединение закрыто", event.code, event.reason);
-};
-
-ws.onerror = (error) => {
-    console.error("🔴 Ошибка WebSocket:", error);
-    console.log("Попробуйте:");
-    console.log("1. Перезапустить сервер");
-    console.log("2. Проверить антивирус/файрвол");
-    console.log("3. Открыть браузер от администратора");
-};
\ No newline at end of file
+// Подключение; после обрыва — повтор с растущей задержкой и запросом только пропущенного
+function connect() {
+    const query = lastMessageId !== null ? `?after_id=${lastMessageId}` : "";
+    ws = new WebSocket(`${wsProtocol}://${location.host}/ws/chat/${roomId}${query}`, ["chat.v2.json", "chat.v1"]);
+    ws.onmessage = handleFrame;
+
+    ws.onopen = () => {
+        console.log("✅ Соединение установлено");
+        reconnectDelay = 1000;
+    };
+
+    ws.onclose = (event) => {
+        console.log("❌ Соединение закрыто", event.code, event.reason);
+        // 1008 — нет доступа или сессии, 1002 — несовместимый протокол: повтор не поможет
+        if (event.code !== 1008 && event.code !== 1002) {
+            setTimeout(connect, reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+        }
+    };
+
+    ws.onerror = (error) => {
+        console.error("🔴 Ошибка WebSocket:", error);
+        console.log("Попробуйте:");
+        console.log("1. Перезапустить сервер");
+        console.log("2. Проверить антивирус/файрвол");
+        console.log("3. Открыть браузер от администратора");
+    };
+}
+
+connect();
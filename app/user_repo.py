@@ -1,13 +1,37 @@
 import hashlib
-from sqlalchemy import select
+from sqlalchemy import literal, literal_column, select, union_all
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import User, Room, RoomMember
 from typing import Optional, List, Dict
-from app.database import AsyncSessionLocal
+from app.database import DB_QUERY_SECONDS, AsyncSessionLocal
+from app.metrics import timed
+from app.cache import TTLCache
+from app.config import settings
+from app.encoding import encode_json
+from app.passwords import PasswordHasherBusy, password_hasher
 
+# Кэш результатов check_user_access_to_room; сбрасывается при приглашении, удалении и создании комнаты
+room_access_cache = TTLCache(settings.access_cache_ttl, settings.access_cache_size)
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+
+# Списки комнат для главной страницы по user_id: готовый JSON и его ETag.
+# Сбрасываются при создании комнаты, приглашении и удалении участника (в остальных воркерах — через брокер)
+user_rooms_cache = TTLCache(settings.room_list_cache_ttl, settings.room_list_cache_size)
+
+
+def invalidate_room_access(room_id: int, user_id: Optional[int] = None):
+    if user_id is None:
+        room_access_cache.invalidate_where(lambda key: key[0] == room_id)
+    else:
+        room_access_cache.pop((room_id, user_id))
+
+
+def invalidate_user_rooms(user_id: Optional[int] = None):
+    # None — сбросить списки всех пользователей (массовый импорт участников)
+    if user_id is None:
+        user_rooms_cache.clear()
+    else:
+        user_rooms_cache.pop(user_id)
 
 
 async def create_user(first_name: str, last_name: str, username: str, password: str, session: AsyncSession) -> Optional[User]:
@@ -19,7 +43,7 @@ async def create_user(first_name: str, last_name: str, username: str, password:
         first_name=first_name,
         last_name=last_name,
         username=username,
-        password_hash=hash_password(password)
+        password_hash=await password_hasher.hash(password)
     )
     session.add(new_user)
     await session.commit()
@@ -33,12 +57,22 @@ async def authenticate_user(username: str, password: str, session: AsyncSession)
     if user is None:
         return None
     
-    if str(user.password_hash) == hash_password(password):
-        return user
+    ok, needs_rehash = await password_hasher.verify(password, str(user.password_hash))
+    if not ok:
+        return None
     
-    return None
+    if needs_rehash:
+        # Прозрачно переводим старые SHA-256 хэши (и устаревшие параметры scrypt) на текущие
+        try:
+            user.password_hash = await password_hasher.hash(password)
+            await session.commit()
+        except PasswordHasherBusy:
+            # Обновим при следующем входе
+            pass
+    return user
 
 
+@timed(DB_QUERY_SECONDS, "get_user_by_username")
 async def get_user_by_username(username: str, session: AsyncSession) -> Optional[User]:
     task = select(User).where(User.username == username)
     result = await session.execute(task)
@@ -53,10 +87,10 @@ async def get_user_by_id(user_id: int, session: AsyncSession) -> Optional[User]:
     return user
     
 async def create_room(name: str, owner_id: int, session: AsyncSession) -> Optional[Room]:
-    task = select(Room).where(Room.name == name)
+    # Название занято, если есть хотя бы одна комната с ним (в старых данных их может быть несколько)
+    task = select(Room.id).where(Room.name == name).limit(1)
     result = await session.execute(task)
-    room = result.scalar_one_or_none()
-    if room:
+    if result.scalar_one_or_none() is not None:
         return None
     
     new_room = Room(
@@ -66,6 +100,8 @@ async def create_room(name: str, owner_id: int, session: AsyncSession) -> Option
     session.add(new_room)
     await session.commit()
     await session.refresh(new_room)
+    invalidate_room_access(new_room.id)
+    invalidate_user_rooms(owner_id)
     return new_room
 
 
@@ -102,7 +138,9 @@ async def invite_user_to_room(room_id: int, username: str, inviter_id: int, sess
     new_member = RoomMember(room_id=room_id, user_id=user.id)
     session.add(new_member)
     await session.commit()
-    return {"success": True, "message": f"Пользователь {username} приглашен"}
+    invalidate_room_access(room_id, user.id)
+    invalidate_user_rooms(user.id)
+    return {"success": True, "message": f"Пользователь {username} приглашен", "user_id": user.id}
 
 
 async def remove_user_from_room(room_id: int, user_id: int, remover_id: int, session: AsyncSession) -> Optional[Dict]:
@@ -128,44 +166,98 @@ async def remove_user_from_room(room_id: int, user_id: int, remover_id: int, ses
     
     await session.delete(member)
     await session.commit()
+    invalidate_room_access(room_id, user_id)
+    invalidate_user_rooms(user_id)
     return {"success": True, "message": "Участник удален"}
 
 
-async def get_room_members(room_id: int, session: AsyncSession) -> List[Dict]:
+async def set_room_retention(
+    room_id: int,
+    owner_id: int,
+    max_age_days: Optional[int],
+    max_messages: Optional[int],
+    session: AsyncSession
+) -> Optional[Dict]:
     room = await get_room_by_id(room_id, session)
     if not room:
-        return []
-    
-    members_list = [
-        {
-            "id": room.owner.id,
-            "username": room.owner.username,
-            "first_name": room.owner.first_name,
-            "last_name": room.owner.last_name,
-            "is_owner": True
-        }
-    ]
-    
-    result = await session.execute(
-        select(RoomMember).where(RoomMember.room_id == room_id)
+        return {"success": False, "error": "Комната не найдена"}
+
+    if room.owner_id != owner_id:
+        return {"success": False, "error": "Только владелец может менять срок хранения"}
+
+    if (max_age_days is not None and max_age_days < 0) or (max_messages is not None and max_messages < 0):
+        return {"success": False, "error": "Лимиты хранения не могут быть отрицательными"}
+
+    # None — настройки по умолчанию, 0 — без ограничения
+    room.retention_days = max_age_days
+    room.retention_messages = max_messages
+    await session.commit()
+    return {"success": True, "message": "Срок хранения обновлен"}
+
+
+def _room_members_query(room_id: int, after_id: Optional[int] = None):
+    # Владелец и участники одним запросом; position — порядок вывода и курсор пагинации
+    member_columns = (User.id, User.username, User.first_name, User.last_name)
+    members = (
+        select(*member_columns, literal(False).label("is_owner"), RoomMember.id.label("position"))
+        .join(RoomMember, RoomMember.user_id == User.id)
+        .where(RoomMember.room_id == room_id)
     )
-    memberships = result.scalars().all()
-    
-    for membership in memberships:
-        user = await get_user_by_id(membership.user_id, session)
-        if user:
-            members_list.append({
-                "id": user.id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "is_owner": False
-            })
+    if after_id is not None:
+        members = members.where(RoomMember.id > after_id)
+        return members.order_by(RoomMember.id)
     
-    return members_list
+    owner = (
+        select(*member_columns, literal(True).label("is_owner"), literal(0).label("position"))
+        .join(Room, Room.owner_id == User.id)
+        .where(Room.id == room_id)
+    )
+    return union_all(owner, members).order_by(literal_column("position"))
+
+
+def _member_dict(row) -> Dict:
+    return {
+        "id": row.id,
+        "username": row.username,
+        "first_name": row.first_name,
+        "last_name": row.last_name,
+        "is_owner": bool(row.is_owner)
+    }
+
+
+@timed(DB_QUERY_SECONDS, "get_room_members")
+async def get_room_members(room_id: int, session: AsyncSession) -> List[Dict]:
+    result = await session.execute(_room_members_query(room_id))
+    return [_member_dict(row) for row in result]
+
+
+@timed(DB_QUERY_SECONDS, "get_room_members_page")
+async def get_room_members_page(room_id: int, session: AsyncSession, after_id: Optional[int] = None, limit: int = 100) -> Dict:
+    # Постраничный список для больших комнат: владелец — на первой странице, курсор — id членства
+    result = await session.execute(_room_members_query(room_id, after_id).limit(limit + 1))
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "members": [_member_dict(row) for row in rows],
+        "has_more": has_more,
+        "next_after_id": rows[-1].position if has_more else None
+    }
 
 
 async def check_user_access_to_room(room_id: int, user_id: int, session: AsyncSession) -> bool:
+    cached = room_access_cache.get((room_id, user_id))
+    if cached is not None:
+        return cached
+    
+    generation = room_access_cache.generation
+    has_access = await _query_user_access_to_room(room_id, user_id, session)
+    room_access_cache.set((room_id, user_id), has_access, generation=generation)
+    return has_access
+
+
+@timed(DB_QUERY_SECONDS, "query_user_access_to_room")
+async def _query_user_access_to_room(room_id: int, user_id: int, session: AsyncSession) -> bool:
     room = await get_room_by_id(room_id, session)
     if not room:
         return False
@@ -182,38 +274,46 @@ async def check_user_access_to_room(room_id: int, user_id: int, session: AsyncSe
     return result.scalar_one_or_none() is not None
 
 
-async def get_user_rooms(user_id: int) -> Dict[str, List[Dict]]:
+@timed(DB_QUERY_SECONDS, "get_user_rooms")
+async def _query_user_rooms(user_id: int) -> Dict[str, List[Dict]]:
+    # Свои и приглашённые комнаты одним запросом по индексам idx_room_owner и idx_room_member_user
+    room_columns = (Room.id, Room.name, Room.created_at)
+    owned = select(*room_columns, literal(True).label("is_owner")).where(Room.owner_id == user_id)
+    invited = (
+        select(*room_columns, literal(False).label("is_owner"))
+        .join(RoomMember, Room.id == RoomMember.room_id)
+        .where(RoomMember.user_id == user_id)
+    )
     async with AsyncSessionLocal() as session:
-        owned_stmt = select(Room).where(Room.owner_id == user_id).order_by(Room.created_at.desc())
-        owned_result = await session.execute(owned_stmt)
-        owned_rooms = owned_result.scalars().all()
-        
-        invited_stmt = (
-            select(Room)
-            .join(RoomMember, Room.id == RoomMember.room_id)
-            .where(RoomMember.user_id == user_id)
-            .order_by(Room.created_at.desc())
+        result = await session.execute(
+            union_all(owned, invited).order_by(literal_column("created_at").desc(), literal_column("id").desc())
         )
-        invited_result = await session.execute(invited_stmt)
-        invited_rooms = invited_result.scalars().all()
-        
-        return {
-            "owned": [
-                {
-                    "id": room.id,
-                    "name": room.name,
-                    "created_at": room.created_at.strftime("%Y-%m-%d %H:%M"),
-                    "is_owner": True
-                }
-                for room in owned_rooms
-            ],
-            "invited": [
-                {
-                    "id": room.id,
-                    "name": room.name,
-                    "created_at": room.created_at.strftime("%Y-%m-%d %H:%M"),
-                    "is_owner": False
-                }
-                for room in invited_rooms
-            ]
-        }
\ No newline at end of file
+        rooms = {"owned": [], "invited": []}
+        for row in result:
+            is_owner = bool(row.is_owner)
+            rooms["owned" if is_owner else "invited"].append({
+                "id": row.id,
+                "name": row.name,
+                "created_at": row.created_at.strftime("%Y-%m-%d %H:%M"),
+                "is_owner": is_owner
+            })
+        return rooms
+
+
+async def get_user_room_list(user_id: int) -> Dict:
+    # {"rooms", "body": JSON для /rooms, "version": хэш body, "etag"}; повторные запросы не ходят в БД и не кодируют JSON
+    cached = user_rooms_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    generation = user_rooms_cache.generation
+    rooms = await _query_user_rooms(user_id)
+    body = encode_json({"success": True, **rooms})
+    version = hashlib.blake2b(body.encode(), digest_size=12).hexdigest()
+    room_list = {"rooms": rooms, "body": body, "version": version, "etag": f'"{version}"'}
+    user_rooms_cache.set(user_id, room_list, generation=generation)
+    return room_list
+
+
+async def get_user_rooms(user_id: int) -> Dict[str, List[Dict]]:
+    return (await get_user_room_list(user_id))["rooms"]
@@ -0,0 +1,127 @@
+"""Задержка доставки broadcast в комнате из 1000 участников, 5% из которых медленные.
+
+Сравнивает последовательную отправку (как было раньше) с очередями на соединение,
+а очереди — без склейки кадров и со склейкой в окне --coalesce-window (число отправок
+на получателя и задержка). Для оживлённой комнаты уменьшите --interval.
+
+    python -m benchmarks.bench_broadcast --members 1000 --slow-ratio 0.05 --messages 50
+    python -m benchmarks.bench_broadcast --members 1000 --messages 500 --interval 0.001 --coalesce-window 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from app.api.router_socket import ConnectionManager
+
+
+SENT_AT = {}
+SENDS = [0]
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float, latencies: list):
+        self.delay = delay
+        self.latencies = latencies
+        self.scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code: int = 1000, reason=None):
+        pass
+
+    async def send_json(self, data):
+        SENDS[0] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        frames = data if isinstance(data, list) else [data]
+        now = time.perf_counter()
+        for frame in frames:
+            # В chat.v1 текст приходит с префиксом "{username} (ID: {id}): "
+            self.latencies.append(now - SENT_AT[frame["text"].rsplit(": ", 1)[-1]])
+
+    async def send_text(self, data):
+        await self.send_json(json.loads(data))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def report(name, latencies):
+    ms = [v * 1000 for v in latencies]
+    print(f"{name:>16}: n={len(ms):>7} sends={SENDS[0]:>7} p50={percentile(ms, 0.5):8.2f}ms "
+          f"p99={percentile(ms, 0.99):8.2f}ms max={max(ms, default=0):8.2f}ms mean={statistics.fmean(ms) if ms else 0:8.2f}ms")
+
+
+def make_sockets(members, slow_ratio, slow_delay):
+    fast_latencies = []
+    slow_latencies = []
+    slow = set(random.sample(range(members), int(members * slow_ratio)))
+    sockets = []
+    for i in range(members):
+        if i in slow:
+            sockets.append(FakeWebSocket(slow_delay, slow_latencies))
+        else:
+            sockets.append(FakeWebSocket(0, fast_latencies))
+    return sockets, fast_latencies, slow_latencies
+
+
+async def run_sequential(args):
+    SENDS[0] = 0
+    sockets, fast, _ = make_sockets(args.members, args.slow_ratio, args.slow_delay)
+    for n in range(args.messages):
+        frame = {"text": f"msg {n}"}
+        SENT_AT[frame["text"]] = time.perf_counter()
+        for ws in sockets:
+            await ws.send_json(frame)
+        await asyncio.sleep(args.interval)
+    report("sequential", fast)
+
+
+async def run_queued(args, coalesce_window):
+    SENDS[0] = 0
+    sockets, fast, _ = make_sockets(args.members, args.slow_ratio, args.slow_delay)
+    manager = ConnectionManager()
+    manager.coalesce_window = coalesce_window
+    room_id = 1
+    connections = []
+    for user_id, ws in enumerate(sockets):
+        connection = await manager.connect(ws, room_id, user_id, f"user{user_id}")
+        connection.start()
+        connections.append(connection)
+    for n in range(args.messages):
+        text = f"msg {n}"
+        SENT_AT[text] = time.perf_counter()
+        await manager.broadcast(text, room_id, 0, "bench", save_to_db=False)
+        await asyncio.sleep(args.interval)
+    # Даём быстрым клиентам дочитать очередь
+    await asyncio.sleep(0.1)
+    report(f"queued w={coalesce_window * 1000:g}ms", fast)
+    for connection in connections:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--slow-ratio", type=float, default=0.05)
+    parser.add_argument("--slow-delay", type=float, default=0.02)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--coalesce-window", type=float, default=0.01)
+    args = parser.parse_args()
+    random.seed(0)
+    asyncio.run(run_sequential(args))
+    asyncio.run(run_queued(args, 0))
+    asyncio.run(run_queued(args, args.coalesce_window))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Смешанная нагрузка чата на SQLite: писатели сохраняют сообщения, читатели запрашивают историю.
+
+Каждый профиль (CHAT_DB_PROFILE) запускается в отдельном процессе на свежей БД.
+
+    python -m benchmarks.bench_database --seconds 5 --writers 2 --readers 4
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+async def workload(args):
+    from app.database import get_room_history, init_db, save_messages
+
+    await init_db()
+    await save_messages([
+        {"room_id": n % 10 + 1, "user_id": 1, "username": "bench", "message": f"seed {n}", "ts": 1_700_000_000_000}
+        for n in range(5000)
+    ])
+
+    counts = {"writes": 0, "reads": 0}
+    deadline = time.monotonic() + args.seconds
+
+    async def writer(n):
+        while time.monotonic() < deadline:
+            await save_messages([{"room_id": n % 10 + 1, "user_id": n, "username": "bench",
+                                  "message": "hello", "ts": 1_700_000_000_000}] * args.batch)
+            counts["writes"] += args.batch
+
+    async def reader(n):
+        while time.monotonic() < deadline:
+            await get_room_history(n % 10 + 1, limit=50)
+            counts["reads"] += 1
+
+    await asyncio.gather(*(writer(n) for n in range(args.writers)), *(reader(n) for n in range(args.readers)))
+    print(f"{os.environ['CHAT_DB_PROFILE']:>12}: {counts['writes'] / args.seconds:9.0f} msg writes/s "
+          f"{counts['reads'] / args.seconds:9.0f} history reads/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--profiles", default="default,performance")
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(workload(args))
+        return
+
+    for profile in args.profiles.split(","):
+        env = dict(os.environ, CHAT_DB_PROFILE=profile,
+                   CHAT_DATABASE_URL=f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+        subprocess.run([sys.executable, "-m", "benchmarks.bench_database", "--child", *sys.argv[1:]], env=env, check=True)
+
+
+if __name__ == "__main__":
+    main()
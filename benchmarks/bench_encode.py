@@ -0,0 +1,40 @@
+"""CPU на сериализацию одного broadcast: json.dumps на каждого получателя против одного кодирования на вариант.
+
+    python -m benchmarks.bench_encode --members 1000 --messages 200
+"""
+import argparse
+import json
+import time
+
+from app.encoding import encode_json
+
+
+def per_recipient(members, messages):
+    for n in range(messages):
+        for user_id in range(members):
+            json.dumps({"text": f"user (ID: 1): message {n}", "is_self": user_id == 1, "timestamp": "12:00"},
+                       separators=(",", ":"), ensure_ascii=False)
+
+
+def once_per_variant(members, messages):
+    for n in range(messages):
+        self_frame = encode_json({"text": f"user (ID: 1): message {n}", "is_self": True, "timestamp": "12:00"})
+        other_frame = encode_json({"text": f"user (ID: 1): message {n}", "is_self": False, "timestamp": "12:00"})
+        for user_id in range(members):
+            frame = self_frame if user_id == 1 else other_frame
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+    for name, fn in (("per_recipient", per_recipient), ("once_per_variant", once_per_variant)):
+        started = time.perf_counter()
+        fn(args.members, args.messages)
+        elapsed = time.perf_counter() - started
+        print(f"{name:>16}: {elapsed * 1e6 / args.messages:10.1f} us/broadcast")
+
+
+if __name__ == "__main__":
+    main()
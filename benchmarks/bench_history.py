@@ -0,0 +1,82 @@
+"""Шторм переподключений: выдача истории при подключении из кольцевого буфера и напрямую из БД,
+и resync — клиент присылает последний увиденный id и получает только пропущенные сообщения.
+
+    python -m benchmarks.bench_history --rooms 20 --messages 2000 --clients 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("CHAT_DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench_history.db")
+
+from app.database import get_room_history, init_db, save_messages
+from app.history import get_history_frame, get_resync_page, history_buffer
+from app.protocol import LEGACY
+
+
+async def populate(rooms, messages):
+    rows = [
+        {"room_id": n % rooms + 1, "user_id": n % 50, "username": f"user{n % 50}",
+         "message": f"message {n}", "ts": 1_700_000_000_000}
+        for n in range(rooms * messages)
+    ]
+    for start in range(0, len(rows), 5000):
+        await save_messages(rows[start:start + 5000])
+
+
+async def full_history(room_id, user_id, gaps):
+    return len(await get_history_frame(room_id, user_id))
+
+
+async def resync(room_id, user_id, gaps):
+    # Клиент пропустил несколько последних сообщений комнаты
+    page = await get_resync_page(room_id, user_id, gaps[room_id])
+    return len(LEGACY.encode(page))
+
+
+async def storm(fetch, rooms, clients, concurrency, gaps):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    sizes = []
+
+    async def reconnect(user_id):
+        async with semaphore:
+            started = time.perf_counter()
+            sizes.append(await fetch(random.randint(1, rooms), user_id, gaps))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(reconnect(n % 50) for n in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], sum(sizes) / len(sizes)
+
+
+async def main(args):
+    await init_db()
+    await populate(args.rooms, args.messages)
+    gaps = {}
+    for room_id in range(1, args.rooms + 1):
+        gaps[room_id] = (await get_room_history(room_id, limit=args.gap + 1))[0]["id"]
+    for name, fetch, max_rooms in (
+        ("db", full_history, 0), ("ring_buffer", full_history, 1000), ("resync", resync, 1000)
+    ):
+        history_buffer.max_rooms = max_rooms
+        history_buffer.rooms.clear()
+        elapsed, p50, p99, size = await storm(fetch, args.rooms, args.clients, args.concurrency, gaps)
+        print(f"{name:>12}: {args.clients / elapsed:9.0f} joins/s p50={p50 * 1000:7.2f}ms p99={p99 * 1000:7.2f}ms "
+              f"frame={size:8.0f}B (hits={history_buffer.hits} misses={history_buffer.misses})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--gap", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=200)
+    random.seed(0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,104 @@
+"""Накладные расходы инструментирования: стоимость обновления метрик и рассылки в комнату
+с выключенными метриками, включёнными метриками и включённым семплирующим профилировщиком.
+
+Для сквозного сравнения под нагрузкой — два прогона benchmarks.loadtest:
+
+    python -m benchmarks.bench_metrics --members 1000 --events 2000
+    CHAT_METRICS_ENABLED=false python -m benchmarks.loadtest --output metrics-off.json
+    python -m benchmarks.loadtest --compare metrics-off.json
+"""
+import argparse
+import asyncio
+import time
+
+from app.api.router_socket import ConnectionManager
+from app.metrics import REGISTRY, Counter, Histogram, Registry, timed
+from app.profiler import profiler
+
+
+class FakeWebSocket:
+    scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code: int = 1000, reason=None):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+
+def micro(repeat):
+    registry = Registry()
+    counter = Counter("bench_counter", "", registry=registry).labels()
+    histogram = Histogram("bench_histogram", "", registry=registry).labels()
+    for name, call in (("counter.inc", counter.inc), ("histogram.observe", lambda: histogram.observe(0.003))):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            call()
+        print(f"{name:>20}: {(time.perf_counter() - started) / repeat * 1e9:7.1f} ns")
+
+
+async def timed_overhead(repeat):
+    async def noop():
+        pass
+
+    wrapped = timed(Histogram("bench_timed_seconds", "", registry=Registry()))(noop)
+    for name, func in (("plain coroutine", noop), ("@timed coroutine", wrapped)):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            await func()
+        print(f"{name:>20}: {(time.perf_counter() - started) / repeat * 1e9:7.1f} ns")
+
+
+async def fanout(args):
+    manager = ConnectionManager()
+    manager.coalesce_window = 0
+    connections = []
+    for user_id in range(args.members):
+        connection = await manager.connect(FakeWebSocket(), 1, user_id, f"user{user_id}")
+        connection.start()
+        connections.append(connection)
+    event = {"type": "message", "room_id": 1, "id": 1, "sender_id": 0, "sender": "bench", "body": "hello",
+             "system": False, "timestamp": "12:00", "ts": 1_700_000_000_000, "saved": True}
+
+    async def run(label):
+        elapsed = 0.0
+        for n in range(args.events):
+            event["id"] = n
+            started = time.perf_counter()
+            manager.deliver(event)
+            elapsed += time.perf_counter() - started
+            # Даём писателям соединений разобрать очереди
+            await asyncio.sleep(0)
+        print(f"{label:>20}: {elapsed / args.events * 1e6:8.1f} us per event to {args.members} members")
+        return elapsed
+
+    REGISTRY.enabled = False
+    baseline = await run("metrics off")
+    REGISTRY.enabled = True
+    enabled = await run("metrics on")
+    profiler.start(args.profiler_interval)
+    profiled = await run("metrics + profiler")
+    profiler.stop()
+    print(f"overhead: metrics {enabled / baseline - 1:+.1%}, metrics + profiler {profiled / baseline - 1:+.1%} "
+          f"({profiler.samples} samples)")
+    for connection in connections:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=1_000_000)
+    parser.add_argument("--profiler-interval", type=float, default=0.005)
+    args = parser.parse_args()
+    micro(args.repeat)
+    asyncio.run(timed_overhead(args.repeat))
+    asyncio.run(fanout(args))
+
+
+if __name__ == "__main__":
+    main()
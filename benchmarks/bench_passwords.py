@@ -0,0 +1,57 @@
+"""Задержка event loop (а значит, и WebSocket-кадров) во время всплеска логинов.
+
+Сравнивает scrypt прямо в event loop с хэшированием в пуле потоков PasswordHasher.
+
+    python -m benchmarks.bench_passwords --logins 64
+"""
+import argparse
+import asyncio
+import time
+
+from app.config import settings
+from app.passwords import PasswordHasher, PasswordHasherBusy, _hash_sync
+
+
+async def measure_lag(stop: asyncio.Event, lags: list, interval: float = 0.001):
+    # Так же часто просыпается задача-писатель соединения; опоздание пробуждения — задержка кадра
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def burst(name, login):
+    stop = asyncio.Event()
+    lags = []
+    probe = asyncio.create_task(measure_lag(stop, lags))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    results = await asyncio.gather(*login(), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    lags.sort()
+    rejected = sum(isinstance(result, PasswordHasherBusy) for result in results)
+    print(f"{name:>8}: burst={elapsed * 1000:8.1f}ms loop lag p50={lags[len(lags) // 2] * 1000:7.2f}ms "
+          f"p99={lags[int(len(lags) * 0.99)] * 1000:7.2f}ms max={lags[-1] * 1000:7.2f}ms rejected={rejected}")
+
+
+async def main(args):
+    n, r, p = settings.password_scrypt_n, settings.password_scrypt_r, settings.password_scrypt_p
+
+    async def inline_login():
+        _hash_sync("password", n, r, p)
+
+    await burst("inline", lambda: [inline_login() for _ in range(args.logins)])
+
+    hasher = PasswordHasher(workers=args.workers, max_pending=args.max_pending)
+    await burst("pool", lambda: [hasher.hash("password") for _ in range(args.logins)])
+    hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=settings.password_hash_workers)
+    parser.add_argument("--max-pending", type=int, default=settings.password_hash_max_pending)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,77 @@
+"""Шторм переподключений: N клиентов одной комнаты отключаются и сразу подключаются снова.
+
+Считает кадры, отправленные клиентам. Раньше каждый вход и выход рассылался всей комнате
+(~2·N² кадров на шторм); с трекером присутствия переподключение в пределах presence_grace
+не порождает уведомлений, а новые входы за presence_window уходят одним кадром.
+
+    python -m benchmarks.bench_presence --clients 2000
+"""
+import argparse
+import asyncio
+import time
+
+from app.api.router_socket import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self, counter: list):
+        self.counter = counter
+        self.scope = {}
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code: int = 1000, reason=None):
+        pass
+
+    async def send_text(self, data):
+        self.counter[0] += 1
+
+
+async def connect_all(manager, clients, counter):
+    connections = []
+    for user_id in range(clients):
+        connection = await manager.connect(FakeWebSocket(counter), 1, user_id, f"user{user_id}")
+        connection.start()
+        connections.append(connection)
+    return connections
+
+
+async def run(args):
+    manager = ConnectionManager()
+    manager.presence.grace = args.grace
+    manager.presence.window = args.window
+    await manager.start()
+    counter = [0]
+
+    started = time.perf_counter()
+    connections = await connect_all(manager, args.clients, counter)
+    await asyncio.sleep(args.window * 2)
+    print(f"{'initial join':>14}: frames={counter[0]:>9} time={time.perf_counter() - started:6.2f}s")
+
+    counter[0] = 0
+    started = time.perf_counter()
+    for connection in connections:
+        manager.disconnect(connection)
+    connections = await connect_all(manager, args.clients, counter)
+    await asyncio.sleep(args.window * 2)
+    print(f"{'reconnect':>14}: frames={counter[0]:>9} time={time.perf_counter() - started:6.2f}s "
+          f"online={manager.presence.online_count(1)}")
+    print(f"{'old estimate':>14}: frames={2 * args.clients * args.clients:>9}")
+
+    for connection in connections:
+        manager.disconnect(connection)
+    await manager.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--grace", type=float, default=5.0)
+    parser.add_argument("--window", type=float, default=0.2)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Байты на проводе и CPU на кодирование/декодирование для версий протокола chat.v1, chat.v2.json и chat.v2.msgpack.
+
+Сжатие permessage-deflate моделируется так же, как в websockets: общий zlib-контекст на соединение
+(context takeover) и Z_SYNC_FLUSH после каждого кадра.
+
+    python -m benchmarks.bench_protocol --messages 5000
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+
+from app.protocol import PROTOCOLS
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+WORDS = "привет как дела сегодня встреча в три часа ok thanks see you завтра отчёт готов".split()
+
+
+def make_events(count):
+    random.seed(0)
+    events = []
+    ts = 1_700_000_000_000
+    for n in range(count):
+        sender_id = random.randint(1, 20)
+        ts += random.randint(100, 5000)
+        events.append({
+            "id": n + 1,
+            "sender_id": sender_id,
+            "sender": f"user{sender_id}",
+            "body": " ".join(random.choices(WORDS, k=random.randint(1, 12))),
+            "timestamp": "12:00",
+            "ts": ts
+        })
+    return events
+
+
+def deflated_size(frames):
+    # Один компрессор на соединение; хвост 00 00 ff ff не передаётся (RFC 7692)
+    compressor = zlib.compressobj(wbits=-15)
+    total = 0
+    for frame in frames:
+        data = frame if isinstance(frame, bytes) else frame.encode()
+        total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def decode(protocol, frame):
+    if protocol.binary:
+        return msgpack.unpackb(frame)
+    return json.loads(frame)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+    events = make_events(args.messages)
+    recipient_id = 0
+
+    print(f"{'protocol':>16} {'raw B/msg':>10} {'deflate B/msg':>14} {'encode us':>10} {'decode us':>10}")
+    for protocol in PROTOCOLS:
+        started = time.perf_counter()
+        frames = [protocol.encode_message(event, recipient_id) for event in events]
+        encode_us = (time.perf_counter() - started) * 1e6 / len(events)
+
+        started = time.perf_counter()
+        for frame in frames:
+            decode(protocol, frame)
+        decode_us = (time.perf_counter() - started) * 1e6 / len(events)
+
+        raw = sum(len(frame if isinstance(frame, bytes) else frame.encode()) for frame in frames)
+        print(f"{protocol.name:>16} {raw / len(frames):10.1f} {deflated_size(frames) / len(frames):14.1f} "
+              f"{encode_us:10.2f} {decode_us:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Поиск по сообщениям комнаты: LIKE-скан против индекса FTS5 на таблице из миллионов строк.
+
+Таблица заполняется напрямую через sqlite3 (триггеры миграции 0003 обновляют FTS при вставке),
+затем для нескольких слов сравнивается время первой страницы результатов.
+LIKE возвращает последние совпадения без ранжирования и быстр только для частых слов;
+FTS ранжирует search_rank_window последних совпадений и одинаково быстр для редких.
+
+    python -m benchmarks.bench_search --rows 2000000 --rooms 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_search.db")
+os.environ.setdefault("CHAT_DATABASE_URL", f"sqlite+aiosqlite:///{DB_PATH}")
+
+from sqlalchemy import select
+
+from app.database import ReadSessionLocal, init_db, search_messages
+from app.models import Message
+
+WORDS = ("привет как дела сегодня встреча в три часа отчёт готов завтра созвон релиз "
+         "hello thanks deploy review merge ticket bug fix ok see you").split()
+RARE = ["zebra", "квазар", "antimony"]
+
+
+def populate(rows, rooms, batch=50000):
+    random.seed(0)
+    db = sqlite3.connect(DB_PATH)
+    started = time.perf_counter()
+    for start in range(0, rows, batch):
+        chunk = []
+        for n in range(start, min(rows, start + batch)):
+            words = random.choices(WORDS, k=random.randint(3, 15))
+            if n % 50000 == 0:
+                words.append(random.choice(RARE))
+            chunk.append((n % rooms + 1, n % 500, f"user{n % 500}", " ".join(words), 1_700_000_000_000 + n))
+        db.executemany(
+            "INSERT INTO messages (room_id, user_id, username, message, ts, created_at) "
+            "VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)", chunk
+        )
+        db.commit()
+    db.close()
+    return time.perf_counter() - started
+
+
+async def like_search(room_id, term, limit):
+    async with ReadSessionLocal() as session:
+        stmt = (
+            select(Message)
+            .where(Message.room_id == room_id, Message.message.like(f"%{term}%"))
+            .order_by(Message.id.desc())
+            .limit(limit)
+        )
+        return (await session.execute(stmt)).scalars().all()
+
+
+async def fts_search(room_id, term, limit):
+    return await search_messages(room_id, term, limit)
+
+
+async def measure(fn, room_id, term, limit, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn(room_id, term, limit)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def main(args):
+    await init_db()
+    elapsed = populate(args.rows, args.rooms)
+    print(f"inserted {args.rows} rows into {args.rooms} rooms in {elapsed:.1f}s "
+          f"({args.rows / elapsed:.0f} rows/s with FTS triggers)")
+
+    print(f"{'term':>12} {'like ms':>10} {'fts ms':>10}")
+    for term in ["встреча", "deploy", "встре*", RARE[0], RARE[1]]:
+        like_ms = await measure(like_search, 1, term.rstrip("*"), args.limit, args.repeat)
+        fts_ms = await measure(fts_search, 1, term, args.limit, args.repeat)
+        print(f"{term:>12} {like_ms:10.2f} {fts_ms:10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,133 @@
+"""Проверка рассылки между воркерами: uvicorn --workers N с брокером на Unix-сокетах.
+
+Клиенты одной комнаты распределяются ядром по разным воркерам; сообщение одного
+клиента должно дойти до всех, а список онлайн в любом воркере — включать всех клиентов.
+Сервер стартует на пустой БД: миграции при запуске применяет один воркер, остальные должны
+дождаться его и подняться с первой попытки (упавший воркер uvicorn перезапускает, поэтому
+проверяется и журнал сервера).
+
+    python -m benchmarks.check_multiworker --workers 4 --clients 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+TMP = tempfile.mkdtemp()
+os.environ.setdefault("CHAT_DATABASE_URL", f"sqlite+aiosqlite:///{TMP}/multiworker.db")
+os.environ.setdefault("CHAT_BROKER", "unix")
+os.environ.setdefault("CHAT_BROKER_SOCKET_DIR", os.path.join(TMP, "broker"))
+os.environ.setdefault("CHAT_SESSION_SECRET", "multiworker-check")
+
+from app.database import AsyncSessionLocal, engine
+from app.models import RoomMember
+from app.sessions import issue_token
+from app.user_repo import create_room, create_user
+
+
+async def prepare(clients):
+    # Схему к этому моменту создали сами воркеры
+    async with AsyncSessionLocal() as session:
+        users = [await create_user("Bench", "User", f"user{n}", "password", session) for n in range(clients)]
+        room = await create_room("multiworker", users[0].id, session)
+        session.add_all([RoomMember(room_id=room.id, user_id=user.id) for user in users[1:]])
+        await session.commit()
+    await engine.dispose()
+    return room.id, [issue_token(user.id, user.username) for user in users]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_workers(server, workers, timeout=30):
+    # Порт слушает главный процесс uvicorn ещё до старта воркеров; воркер открывает сокет брокера
+    # после миграций, поэтому готовность — по числу сокетов
+    socket_dir = os.environ["CHAT_BROKER_SOCKET_DIR"]
+    deadline = time.time() + timeout
+    started = 0
+    while time.time() < deadline and server.poll() is None:
+        started = len([name for name in os.listdir(socket_dir) if name.endswith(".sock")]) \
+            if os.path.isdir(socket_dir) else 0
+        if started == workers:
+            return started
+        time.sleep(0.2)
+    return started
+
+
+async def wait_for(ws, text, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        frame = json.loads(await asyncio.wait_for(ws.recv(), deadline - time.monotonic()))
+        frames = frame if isinstance(frame, list) else [frame]
+        if any(text in item.get("text", "") for item in frames):
+            return True
+
+
+async def online_count(port, room_id, token):
+    # Новое соединение chat.v2.json получает историю, а затем список онлайн
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws/chat/{room_id}?token={token}",
+                                  subprotocols=["chat.v2.json"]) as ws:
+        while True:
+            frame = json.loads(await asyncio.wait_for(ws.recv(), 5))
+            if isinstance(frame, dict) and "online" in frame:
+                return len(frame["online"])
+
+
+async def run(port, room_id, tokens):
+    sockets = [
+        await websockets.connect(f"ws://127.0.0.1:{port}/ws/chat/{room_id}?token={token}")
+        for token in tokens
+    ]
+    # Даём всем воркерам зарегистрировать соединения
+    await asyncio.sleep(0.5)
+    marker = f"marker-{time.time_ns()}"
+    await sockets[0].send(marker)
+    results = await asyncio.gather(*(wait_for(ws, marker) for ws in sockets), return_exceptions=True)
+    online = [await online_count(port, room_id, tokens[0]) for _ in range(len(tokens))]
+    for ws in sockets:
+        await ws.close()
+    return sum(result is True for result in results), min(online)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    port = free_port()
+    log = tempfile.TemporaryFile(mode="w+")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--workers", str(args.workers), "--ws", "websockets", "--log-level", "warning"],
+        env=os.environ.copy(), stderr=log
+    )
+    delivered = online = 0
+    try:
+        started = wait_for_workers(server, args.workers)
+        if started == args.workers:
+            room_id, tokens = asyncio.run(prepare(args.clients))
+            delivered, online = asyncio.run(run(port, room_id, tokens))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    log.seek(0)
+    failures = log.read().count("Application startup failed")
+
+    print(f"workers={args.workers} started={started} startup_failures={failures} clients={args.clients} "
+          f"delivered={delivered}/{args.clients} online={online}/{args.clients}")
+    sys.exit(0 if started == args.workers and failures == 0 and delivered == online == args.clients else 1)
+
+
+if __name__ == "__main__":
+    main()
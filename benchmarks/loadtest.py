@@ -0,0 +1,438 @@
+"""Нагрузочный тест сервера чата целиком: uvicorn с app.main:app в отдельном процессе и тысячи клиентов на asyncio.
+
+Перед запуском сервера в свежую БД добавляются --clients пользователей, разложенных по комнатам
+из --room-size участников. Затем идут фазы:
+  http — /login, /join_room и /room/{id}/members (запросов в секунду, p50/p99, статусы ответов);
+  websocket — все клиенты подключаются к своим комнатам, --senders-per-room из них пишут с частотой
+  --rate сообщений в секунду, остальные читают (доставок в секунду, p50/p99 задержки доставки).
+С --flooders N в первой комнате N клиентов пишут без пауз: задержка и доставка остальных комнат
+считаются отдельно от неё, так видно, защищает ли их ограничение частоты (CHAT_FLOOD_ACTION, CHAT_RATE_LIMIT_*).
+Для каждой операции считаются SQL-запросы сервера (счётчик на движках SQLAlchemy, маршрут
+/_loadtest/stats есть только у сервера под нагрузкой) и RSS процесса сервера.
+Итог сохраняется в JSON; --compare печатает разницу с прошлым прогоном. Нужен ulimit -n больше --clients.
+
+    python -m benchmarks.loadtest --clients 2000 --room-size 50 --duration 20
+    python -m benchmarks.loadtest --clients 500 --output before.json
+    python -m benchmarks.loadtest --clients 500 --compare before.json
+    CHAT_RATE_LIMIT_PER_CONNECTION=0 CHAT_RATE_LIMIT_PER_ROOM=0 python -m benchmarks.loadtest --flooders 5 --output nolimit.json
+    python -m benchmarks.loadtest --flooders 5 --compare nolimit.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+import websockets
+
+PASSWORD = "loadtest-password"
+
+
+def instrumented_app():
+    # Точка входа сервера под нагрузкой (uvicorn --factory): приложение как есть плюс счётчик SQL-запросов
+    from sqlalchemy import event
+    from app.database import engine, read_engine
+    from app.lifecycle import current_rss_mb
+    from app.main import app
+
+    counters = {"queries": 0}
+
+    def count_query(*_):
+        counters["queries"] += 1
+
+    for target in {engine.sync_engine, read_engine.sync_engine}:
+        event.listen(target, "before_cursor_execute", count_query)
+
+    @app.get("/_loadtest/stats")
+    async def loadtest_stats():
+        return {"queries": counters["queries"], "rss_mb": current_rss_mb()}
+
+    return app
+
+
+async def prepare(args):
+    # Пользователи и комнаты пишутся прямо в БД: один хэш пароля на всех, иначе подготовка упрётся в scrypt
+    from app.database import AsyncSessionLocal, engine, init_db
+    from app.models import Room, RoomMember, User
+    from app.passwords import password_hasher
+    from app.sessions import issue_token
+
+    await init_db()
+    password_hash = await password_hasher.hash(PASSWORD)
+    password_hasher.shutdown()
+    async with AsyncSessionLocal() as session:
+        users = [
+            User(first_name="Load", last_name=str(n), username=f"load{n}", password_hash=password_hash)
+            for n in range(args.clients)
+        ]
+        session.add_all(users)
+        await session.flush()
+        rooms = [
+            Room(name=f"load{n}", owner_id=users[start].id)
+            for n, start in enumerate(range(0, args.clients, args.room_size))
+        ]
+        session.add_all(rooms)
+        await session.flush()
+        session.add_all(
+            RoomMember(room_id=rooms[n // args.room_size].id, user_id=user.id)
+            for n, user in enumerate(users) if n % args.room_size
+        )
+        await session.commit()
+        clients = [
+            {"user_id": user.id, "username": user.username, "room_id": rooms[n // args.room_size].id,
+             "token": issue_token(user.id, user.username)}
+            for n, user in enumerate(users)
+        ]
+    await engine.dispose()
+    return clients
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def latency_summary(seconds):
+    ms = [value * 1000 for value in seconds]
+    return {
+        "p50_ms": round(percentile(ms, 0.5), 3),
+        "p99_ms": round(percentile(ms, 0.99), 3),
+        "max_ms": round(max(ms, default=0.0), 3),
+    }
+
+
+async def server_stats(http):
+    return (await http.get("/_loadtest/stats")).json()
+
+
+async def http_phase(http, name, requests, concurrency, call):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def one(n):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status = str((await call(n)).status_code)
+            except httpx.HTTPError as exc:
+                status = type(exc).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    before = await server_stats(http)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(requests)))
+    elapsed = time.perf_counter() - started
+    after = await server_stats(http)
+    result = {
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        **latency_summary(latencies),
+        "queries_per_op": round((after["queries"] - before["queries"]) / requests, 2),
+        "statuses": statuses,
+    }
+    print(f"{name:>10}: {result['rps']:8.1f} req/s p50={result['p50_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms "
+          f"queries/op={result['queries_per_op']:5.2f} statuses={statuses}")
+    return result
+
+
+async def run_http(args, http, clients):
+    from app.sessions import SESSION_COOKIE
+
+    def pick(n):
+        return clients[(n * 7919) % len(clients)]
+
+    def cookie(client):
+        return {"Cookie": f"{SESSION_COOKIE}={client['token']}"}
+
+    async def login(n):
+        return await http.post("/login", data={"username": pick(n)["username"], "password": PASSWORD})
+
+    async def join_room(n):
+        client = pick(n)
+        return await http.post("/join_room", data={"room_id": client["room_id"]}, headers=cookie(client))
+
+    async def members(n):
+        client = pick(n)
+        return await http.get(f"/room/{client['room_id']}/members", headers=cookie(client))
+
+    return {
+        name: await http_phase(http, name, args.http_requests, args.http_concurrency, call)
+        for name, call in (("login", login), ("join_room", join_room), ("members", members))
+    }
+
+
+def message_bodies(frame, protocol):
+    # Тексты сообщений из кадра (в оживлённой комнате сервер склеивает их в массив)
+    data = json.loads(frame)
+    items = data if isinstance(data, list) else [data]
+    for item in items:
+        if protocol == "chat.v1":
+            if "text" in item:
+                yield item["text"].rsplit(": ", 1)[-1]
+        elif item.get("type") == "message":
+            yield item["body"]
+
+
+async def read_frames(ws, protocol, latencies):
+    try:
+        async for frame in ws:
+            if '"ping"' in frame:
+                await ws.send('{"type":"pong"}')
+                continue
+            now = time.perf_counter_ns()
+            for body in message_bodies(frame, protocol):
+                # Тело сообщения — "lt:<отправитель>:<время отправки в нс>"
+                if body.startswith("lt:"):
+                    latencies.append((now - int(body.rsplit(":", 1)[1])) / 1e9)
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def send_messages(ws, protocol, sender, interval, deadline):
+    sent = 0
+    # Случайный сдвиг, чтобы отправители не писали все в один момент
+    await asyncio.sleep(random.random() * interval)
+    while time.perf_counter() < deadline:
+        body = f"lt:{sender}:{time.perf_counter_ns()}"
+        try:
+            await ws.send(json.dumps({"type": "message", "body": body}) if protocol != "chat.v1" else body)
+        except websockets.ConnectionClosed:
+            break
+        sent += 1
+        await asyncio.sleep(interval)
+    return sent
+
+
+async def flood(ws, protocol, sender, deadline):
+    # Без пауз: темп задаёт только сервер (throttle придерживает чтение, и send ждёт TCP-окна)
+    sent = 0
+    while time.perf_counter() < deadline:
+        body = f"lt:flood{sender}:{time.perf_counter_ns()}"
+        try:
+            await ws.send(json.dumps({"type": "message", "body": body}) if protocol != "chat.v1" else body)
+        except websockets.ConnectionClosed:
+            break
+        sent += 1
+        # send не уступает цикл, пока буфер сокета не заполнен, — иначе остальные отправители стоят
+        await asyncio.sleep(0)
+    return sent
+
+
+async def run_websocket(args, port, http, clients):
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    subprotocols = [args.protocol] if args.protocol != "chat.v1" else None
+    latencies = []
+    flood_latencies = []
+    readers = []
+    failures = []
+    flood_room = clients[0]["room_id"] if args.flooders else None
+
+    async def open_one(client):
+        url = f"ws://127.0.0.1:{port}/ws/chat/{client['room_id']}?token={client['token']}"
+        async with semaphore:
+            try:
+                ws = await websockets.connect(url, subprotocols=subprotocols, max_queue=None, open_timeout=60)
+            except Exception as exc:
+                failures.append(type(exc).__name__)
+                return None
+        target = flood_latencies if client["room_id"] == flood_room else latencies
+        readers.append(asyncio.create_task(read_frames(ws, args.protocol, target)))
+        return ws
+
+    rss_before = (await server_stats(http))["rss_mb"]
+    started = time.perf_counter()
+    sockets = await asyncio.gather(*(open_one(client) for client in clients))
+    connect_elapsed = time.perf_counter() - started
+    await asyncio.sleep(1)
+    rss_connected = (await server_stats(http))["rss_mb"]
+    # Кадры истории и присутствия при подключении — не доставка сообщений
+    latencies.clear()
+    flood_latencies.clear()
+
+    by_room = {}
+    for client, ws in zip(clients, sockets):
+        if ws is not None:
+            by_room.setdefault(client["room_id"], []).append(ws)
+    senders = [
+        (len(room), ws) for room_id, room in by_room.items() if room_id != flood_room
+        for ws in room[:args.senders_per_room]
+    ]
+    flooders = by_room.get(flood_room, [])[:args.flooders]
+
+    before = await server_stats(http)
+    deadline = time.perf_counter() + args.duration
+    flood_tasks = [asyncio.create_task(flood(ws, args.protocol, n, deadline)) for n, ws in enumerate(flooders)]
+    counts = await asyncio.gather(*(
+        send_messages(ws, args.protocol, n, 1 / args.rate, deadline) for n, (_, ws) in enumerate(senders)
+    ))
+    flood_sent = sum(await asyncio.gather(*flood_tasks))
+    sent = sum(counts)
+    # Сообщение получают все участники комнаты, включая отправителя
+    expected = sum(count * room_size for count, (room_size, _) in zip(counts, senders))
+    # Даём серверу дописать пакеты и доставить хвост
+    await asyncio.sleep(args.drain)
+    after = await server_stats(http)
+
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*(ws.close() for ws in sockets if ws is not None), return_exceptions=True)
+
+    opened = sum(ws is not None for ws in sockets)
+    result = {
+        "connections": opened,
+        "connect_failures": len(failures),
+        "connects_per_s": round(opened / connect_elapsed, 1),
+        "rooms": len(by_room),
+        "senders": len(senders),
+        "messages_sent": sent,
+        "deliveries": len(latencies),
+        "delivery_ratio": round(len(latencies) / expected, 4) if expected else 0.0,
+        "deliveries_per_s": round(len(latencies) / args.duration, 1),
+        **latency_summary(latencies),
+        "queries_per_message": round((after["queries"] - before["queries"]) / max(sent, 1), 3),
+        "rss_mb_before": round(rss_before, 1),
+        "rss_mb_connected": round(rss_connected, 1),
+        "rss_mb_after": round(after["rss_mb"], 1),
+        "rss_kb_per_connection": round((rss_connected - rss_before) * 1024 / max(opened, 1), 1),
+    }
+    if flooders:
+        result["flood"] = {
+            "flooders": len(flooders),
+            "messages_sent": flood_sent,
+            "deliveries": len(flood_latencies),
+            **latency_summary(flood_latencies),
+        }
+    print(f"websocket: {opened}/{len(clients)} connected ({result['connects_per_s']:.0f}/s, failed={len(failures)}) "
+          f"in {len(by_room)} rooms")
+    print(f"           sent={sent} delivered={len(latencies)} ({result['delivery_ratio']:.1%}) "
+          f"{result['deliveries_per_s']:.0f} deliveries/s p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms "
+          f"queries/msg={result['queries_per_message']:.3f}")
+    print(f"           server rss {result['rss_mb_before']}MB -> {result['rss_mb_connected']}MB connected "
+          f"({result['rss_kb_per_connection']}KB/connection) -> {result['rss_mb_after']}MB after run")
+    if flooders:
+        print(f"    flood: {len(flooders)} clients in room {flood_room} sent={flood_sent} "
+              f"delivered={len(flood_latencies)} p99={result['flood']['p99_ms']:.2f}ms "
+              f"(other rooms above)")
+    return result
+
+
+async def run(args, port, clients):
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as http:
+        results = {}
+        if args.http_requests:
+            results["http"] = await run_http(args, http, clients)
+        results["websocket"] = await run_websocket(args, port, http, clients)
+        return results
+
+
+def flatten(data, prefix=""):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(current, previous_path):
+    with open(previous_path) as previous_file:
+        previous = dict(flatten(json.load(previous_file)["results"]))
+    print(f"\n{'metric':>36} {'previous':>12} {'current':>12} {'change':>8}")
+    for key, value in flatten(current):
+        old = previous.get(key)
+        if old is None:
+            continue
+        change = f"{(value - old) / old:+.1%}" if old else ""
+        print(f"{key:>36} {old:12g} {value:12g} {change:>8}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=50)
+    parser.add_argument("--senders-per-room", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=2.0, help="сообщений в секунду от одного отправителя")
+    parser.add_argument("--flooders", type=int, default=0, help="клиентов первой комнаты, пишущих без пауз")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--drain", type=float, default=1.0)
+    parser.add_argument("--protocol", default="chat.v2.json", choices=["chat.v1", "chat.v2.json"])
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--http-requests", type=int, default=500)
+    parser.add_argument("--http-concurrency", type=int, default=50)
+    parser.add_argument("--output", help="файл JSON с результатами (по умолчанию benchmarks/results/<время>.json)")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+    random.seed(0)
+
+    tmp = tempfile.mkdtemp()
+    os.environ.setdefault("CHAT_DATABASE_URL", f"sqlite+aiosqlite:///{tmp}/loadtest.db")
+    os.environ.setdefault("CHAT_SESSION_SECRET", "loadtest")
+    os.environ.setdefault("CHAT_MAX_CONNECTIONS", "0")
+    os.environ.setdefault("CHAT_ARCHIVE_DIR", f"{tmp}/archive")
+
+    started_at = datetime.now(timezone.utc)
+    clients = asyncio.run(prepare(args))
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.loadtest:instrumented_app", "--factory",
+         "--port", str(port), "--ws", "websockets", "--log-level", "warning", "--backlog", "4096"],
+        env=os.environ.copy()
+    )
+    try:
+        wait_for_port(port)
+        results = asyncio.run(run(args, port, clients))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    output = args.output or os.path.join("benchmarks", "results", f"loadtest-{started_at:%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump({
+            "started_at": started_at.isoformat(),
+            "revision": git_revision(),
+            "config": vars(args),
+            "results": results,
+        }, output_file, indent=2, ensure_ascii=False)
+    print(f"results saved to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
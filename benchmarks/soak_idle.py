@@ -0,0 +1,149 @@
+"""Soak-тест: держит N простаивающих WebSocket-соединений и считает память сервера на соединение.
+
+Запускает uvicorn (один воркер), открывает соединения одного пользователя в одной комнате,
+держит их --hold секунд (за это время проходят ping/pong и heartbeat-проходы) и сравнивает
+RSS сервера до и после. Нужен ulimit -n больше --connections.
+Основная часть памяти — буферы и контекст zlib permessage-deflate на соединение; сравните с --no-deflate.
+
+    python -m benchmarks.soak_idle --connections 10000 --hold 30
+    python -m benchmarks.soak_idle --connections 10000 --hold 30 --no-deflate
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+TMP = tempfile.mkdtemp()
+os.environ.setdefault("CHAT_DATABASE_URL", f"sqlite+aiosqlite:///{TMP}/soak.db")
+os.environ.setdefault("CHAT_SESSION_SECRET", "soak-test")
+os.environ.setdefault("CHAT_MAX_CONNECTIONS_PER_USER", "0")
+os.environ.setdefault("CHAT_MAX_CONNECTIONS", "0")
+
+from app.config import settings
+from app.database import AsyncSessionLocal, engine, init_db
+from app.sessions import issue_token
+from app.user_repo import create_room, create_user
+
+
+async def prepare():
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        user = await create_user("Soak", "User", "soak", "password", session)
+        room = await create_room("soak", user.id, session)
+    await engine.dispose()
+    return room.id, issue_token(user.id, user.username)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+async def open_connections(url, count, subprotocols, concurrency, readers):
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+
+    async def open_one():
+        async with semaphore:
+            try:
+                ws = await websockets.connect(url, subprotocols=subprotocols, max_queue=None)
+            except Exception as exc:
+                failures.append(exc)
+                return None
+        if subprotocols:
+            readers.append(asyncio.create_task(answer_heartbeats(ws)))
+        return ws
+
+    sockets = await asyncio.gather(*(open_one() for _ in range(count)))
+    return [ws for ws in sockets if ws is not None], failures
+
+
+async def answer_heartbeats(ws):
+    # Клиент chat.v2 отвечает на heartbeat, иначе сервер закроет его как молчащий
+    try:
+        async for frame in ws:
+            if '"ping"' in frame:
+                await ws.send('{"type":"pong"}')
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def run(args, port, room_id, token, pid):
+    url = f"ws://127.0.0.1:{port}/ws/chat/{room_id}?token={token}"
+    subprotocols = [args.protocol] if args.protocol != "chat.v1" else None
+
+    readers = []
+    baseline, _ = await open_connections(url, 1, subprotocols, 1, readers)
+    await asyncio.sleep(1)
+    before = rss_mb(pid)
+
+    started = time.perf_counter()
+    sockets, failures = await open_connections(url, args.connections, subprotocols, args.concurrency, readers)
+    opened_in = time.perf_counter() - started
+
+    await asyncio.sleep(args.hold)
+    after = rss_mb(pid)
+    alive = sum(ws.close_code is None for ws in sockets)
+
+    for task in readers:
+        task.cancel()
+    for ws in sockets + baseline:
+        await ws.close()
+
+    print(f"protocol={args.protocol} deflate={args.deflate} opened={len(sockets)}/{args.connections} in {opened_in:.1f}s "
+          f"failed={len(failures)} alive_after_hold={alive}")
+    print(f"server rss: before={before:.1f}MB after={after:.1f}MB "
+          f"per_connection={(after - before) * 1024 / max(len(sockets), 1):.1f}KB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--hold", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--protocol", default="chat.v1", choices=["chat.v1", "chat.v2.json"])
+    parser.add_argument("--deflate", action=argparse.BooleanOptionalAction, default=settings.ws_per_message_deflate)
+    args = parser.parse_args()
+
+    room_id, token = asyncio.run(prepare())
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--ws", "websockets", "--log-level", "warning", "--backlog", "4096",
+         "--ws-per-message-deflate", str(args.deflate),
+         "--ws-ping-interval", str(settings.ws_ping_interval), "--ws-ping-timeout", str(settings.ws_ping_timeout)],
+        env=os.environ.copy()
+    )
+    try:
+        wait_for_port(port)
+        asyncio.run(run(args, port, room_id, token, server.pid))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Нагрузочная проверка реестра комнат: тысячи одновременных подключений и отключений во время рассылки.
+
+В каждой из --rooms комнат сидит один постоянный участник. --churners задач непрерывно подключаются
+к случайным комнатам и отключаются (сами, закрытием сокета или ошибкой отправки), пока --broadcasters задач
+рассылают сообщения. Проверяется, что:
+  - ни одна задача не упала (в том числе "changed size during iteration");
+  - постоянные участники получили все сообщения своих комнат;
+  - после ухода всех временных участников в реестре остались только постоянные, а счётчики соединений сошлись.
+Код возврата 0 — все проверки прошли.
+
+    python -m benchmarks.stress_rooms --rooms 50 --churners 2000 --duration 5
+    python -m benchmarks.stress_rooms --coalesce-window 0 --broadcasters 50
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from app.api.router_socket import ConnectionManager
+
+PREFIX = "stress:"
+
+
+class FakeWebSocket:
+    # Отправка уступает цикл событий, чтобы входы и выходы вклинивались между кадрами рассылки
+    def __init__(self, fail_after=None):
+        self.scope = {}
+        self.received = 0
+        self.fail_after = fail_after
+
+    async def accept(self, subprotocol=None):
+        await asyncio.sleep(0)
+
+    async def close(self, code: int = 1000, reason=None):
+        pass
+
+    async def send_text(self, data):
+        await asyncio.sleep(0)
+        if self.fail_after is not None:
+            self.fail_after -= 1
+            if self.fail_after < 0:
+                raise ConnectionResetError("client went away")
+        frame = json.loads(data)
+        # В оживлённой комнате сообщения приходят массивом
+        for item in frame if isinstance(frame, list) else [frame]:
+            if PREFIX in item.get("text", ""):
+                self.received += 1
+
+
+async def churn(manager, args, deadline, stats):
+    user_id = random.randrange(10 ** 6, 10 ** 7)
+    while time.perf_counter() < deadline:
+        room_id = random.randrange(args.rooms)
+        mode = random.random()
+        websocket = FakeWebSocket(fail_after=random.randrange(3) if mode < 0.2 else None)
+        connection = await manager.connect(websocket, room_id, user_id, f"churn{user_id}")
+        connection.start()
+        stats["joins"] += 1
+        await asyncio.sleep(random.random() * args.max_stay)
+        if mode < 0.5:
+            manager.disconnect(connection)
+        else:
+            # Как при разрыве со стороны клиента или сервера (медленный клиент, отзыв доступа)
+            connection.close(code=1000)
+        stats["leaves"] += 1
+
+
+async def broadcast(manager, args, deadline, sent):
+    n = 0
+    while time.perf_counter() < deadline:
+        room_id = random.randrange(args.rooms)
+        await manager.broadcast(f"{PREFIX}{n}", room_id, 0, "stress", save_to_db=False)
+        sent[room_id] += 1
+        n += 1
+        await asyncio.sleep(args.interval)
+
+
+async def run(args):
+    manager = ConnectionManager()
+    manager.coalesce_window = args.coalesce_window
+    resident = []
+    for room_id in range(args.rooms):
+        websocket = FakeWebSocket()
+        connection = await manager.connect(websocket, room_id, room_id, f"resident{room_id}")
+        connection.start()
+        resident.append(websocket)
+
+    stats = {"joins": 0, "leaves": 0}
+    sent = [0] * args.rooms
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(
+        *(churn(manager, args, deadline, stats) for _ in range(args.churners)),
+        *(broadcast(manager, args, deadline, sent) for _ in range(args.broadcasters)),
+    )
+    elapsed = time.perf_counter() - started
+    # Доставляем хвост: окно склейки и очереди писателей
+    await asyncio.sleep(max(args.coalesce_window, 0) + 0.5)
+
+    missing = sum(max(0, count - websocket.received) for count, websocket in zip(sent, resident))
+    extra = sum(max(0, websocket.received - count) for count, websocket in zip(sent, resident))
+    leftover = sum(size for _, size in manager.rooms.sizes()) - args.rooms
+    ops = stats["joins"] + stats["leaves"]
+    print(f"{stats['joins']} joins, {stats['leaves']} leaves ({ops / elapsed:.0f}/s) and {sum(sent)} broadcasts "
+          f"({sum(sent) / elapsed:.0f}/s) by {args.churners} churners over {args.rooms} rooms")
+    print(f"resident members: {sum(ws.received for ws in resident)}/{sum(sent)} delivered, "
+          f"missing={missing} extra={extra}")
+    print(f"registry after churn: {len(manager.rooms)} rooms, leftover connections={leftover}, "
+          f"lifecycle total={manager.lifecycle.total}")
+    ok = missing == 0 and extra == 0 and leftover == 0 and manager.lifecycle.total == args.rooms
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--churners", type=int, default=2000)
+    parser.add_argument("--broadcasters", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--interval", type=float, default=0.001, help="пауза между рассылками одной задачи")
+    parser.add_argument("--max-stay", type=float, default=0.05, help="максимум секунд в комнате у временного участника")
+    parser.add_argument("--coalesce-window", type=float, default=0.01)
+    args = parser.parse_args()
+    random.seed(0)
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
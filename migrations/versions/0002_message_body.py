@@ -0,0 +1,33 @@
+"""store raw message body instead of pre-formatted text
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 21:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Раньше в messages.message хранилась строка "{username} (ID: {user_id}): {текст}";
+# отправитель и так есть в отдельных колонках, оставляем только текст
+PREFIX = "username || ' (ID: ' || CAST(user_id AS VARCHAR) || '): '"
+
+
+def upgrade() -> None:
+    op.execute(sa.text(
+        f"UPDATE messages SET message = substr(message, length({PREFIX}) + 1) "
+        f"WHERE substr(message, 1, length({PREFIX})) = {PREFIX}"
+    ))
+
+
+def downgrade() -> None:
+    op.execute(sa.text(f"UPDATE messages SET message = {PREFIX} || message"))
@@ -0,0 +1,57 @@
+"""full-text search index over message bodies
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# SQLite: внешнее содержимое FTS5 (текст хранится только в messages), синхронизация триггерами.
+# PostgreSQL: GIN-индекс по to_tsvector — запрос поиска использует то же выражение
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5("
+    "message, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message); END",
+    "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message); END",
+    "CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message); "
+    "INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message); END",
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS messages_fts_update",
+    "DROP TRIGGER IF EXISTS messages_fts_delete",
+    "DROP TRIGGER IF EXISTS messages_fts_insert",
+    "DROP TABLE IF EXISTS messages_fts",
+]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        for statement in SQLITE_UPGRADE:
+            op.execute(sa.text(statement))
+    else:
+        op.execute(sa.text(
+            "CREATE INDEX idx_message_search ON messages USING gin (to_tsvector('simple', message))"
+        ))
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        for statement in SQLITE_DOWNGRADE:
+            op.execute(sa.text(statement))
+    else:
+        op.drop_index('idx_message_search', table_name='messages')
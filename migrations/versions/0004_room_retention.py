@@ -0,0 +1,29 @@
+"""per-room message retention policy
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 22:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('rooms', sa.Column('retention_days', sa.Integer(), nullable=True))
+    op.add_column('rooms', sa.Column('retention_messages', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('rooms') as batch_op:
+        batch_op.drop_column('retention_messages')
+        batch_op.drop_column('retention_days')
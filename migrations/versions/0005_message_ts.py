@@ -0,0 +1,45 @@
+"""epoch-millisecond message timestamps instead of "HH:MM" strings
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 23:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# created_at хранится без часового пояса, в UTC
+TS_FROM_CREATED_AT = {
+    "sqlite": "CAST(ROUND((julianday(created_at) - 2440587.5) * 86400000) AS INTEGER)",
+    "postgresql": "CAST(EXTRACT(EPOCH FROM created_at) * 1000 AS BIGINT)",
+}
+CLOCK_FROM_CREATED_AT = {
+    "sqlite": "strftime('%H:%M', created_at)",
+    "postgresql": "to_char(created_at, 'HH24:MI')",
+}
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    op.add_column('messages', sa.Column('ts', sa.BigInteger(), nullable=False, server_default='0'))
+    op.execute(sa.text(f"UPDATE messages SET ts = {TS_FROM_CREATED_AT[dialect]} WHERE created_at IS NOT NULL"))
+    # Без пересоздания таблицы (ALTER TABLE ... DROP COLUMN, SQLite 3.35+): триггеры FTS из 0003 остаются на месте
+    op.drop_column('messages', 'timestamp')
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    op.add_column('messages', sa.Column('timestamp', sa.String(), nullable=False, server_default=''))
+    op.execute(sa.text(
+        f"UPDATE messages SET timestamp = {CLOCK_FROM_CREATED_AT[dialect]} WHERE created_at IS NOT NULL"
+    ))
+    op.drop_column('messages', 'ts')
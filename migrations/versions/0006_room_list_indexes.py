@@ -0,0 +1,30 @@
+"""indexes for per-user room lists
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # if_not_exists: базы, созданные до миграций, получают все индексы моделей ещё перед stamp 0001
+    # Свои комнаты: WHERE owner_id = ? ORDER BY created_at DESC — без полного скана rooms и сортировки
+    op.create_index('idx_room_owner', 'rooms', ['owner_id', 'created_at'], if_not_exists=True)
+    # Приглашённые: idx_room_member начинается с room_id и для поиска по user_id не подходит
+    op.create_index('idx_room_member_user', 'room_members', ['user_id', 'room_id'], if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_room_member_user', table_name='room_members')
+    op.drop_index('idx_room_owner', table_name='rooms')
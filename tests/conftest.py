@@ -0,0 +1,141 @@
+import glob
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+# Настройки читаются при импорте app.*: тесты не должны трогать chat_history.db и archive/ в корне репозитория
+os.environ.setdefault("CHAT_DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/import.db")
+os.environ.setdefault("CHAT_ARCHIVE_DIR", tempfile.mkdtemp())
+os.environ.setdefault("CHAT_SESSION_SECRET", "tests")
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from app import database
+from app.database import AsyncSessionLocal, ReadSessionLocal
+from app.history import history_buffer
+from app.user_repo import room_access_cache, user_rooms_cache
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def _postgres_bin_dir():
+    initdb = shutil.which("initdb")
+    if initdb is not None:
+        return os.path.dirname(initdb)
+    # Debian и Ubuntu не кладут initdb в PATH
+    candidates = sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"))
+    return os.path.dirname(candidates[-1]) if candidates else None
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def postgres_url(tmp_path_factory):
+    # Postgres из CHAT_TEST_POSTGRES_URL (схема public очищается перед каждым тестом) или временный кластер,
+    # если на машине есть initdb и pg_ctl; иначе тесты на Postgres пропускаются
+    pytest.importorskip("asyncpg")
+    url = os.environ.get("CHAT_TEST_POSTGRES_URL")
+    if url:
+        yield url
+        return
+    bin_dir = _postgres_bin_dir()
+    if bin_dir is None:
+        pytest.skip("PostgreSQL is not available: set CHAT_TEST_POSTGRES_URL or install initdb/pg_ctl")
+    data_dir = tmp_path_factory.mktemp("postgres")
+    initdb = subprocess.run(
+        [os.path.join(bin_dir, "initdb"), "-D", str(data_dir), "-U", "chat", "-A", "trust"],
+        capture_output=True, text=True
+    )
+    if initdb.returncode != 0:
+        pytest.skip(f"initdb failed: {initdb.stderr.strip()[-200:]}")
+    port = _free_port()
+    pg_ctl = os.path.join(bin_dir, "pg_ctl")
+    started = subprocess.run(
+        [pg_ctl, "-D", str(data_dir), "-l", str(data_dir / "server.log"), "-w",
+         "-o", f"-p {port} -k {data_dir} -c listen_addresses=127.0.0.1", "start"],
+        capture_output=True, text=True
+    )
+    if started.returncode != 0:
+        pytest.skip(f"pg_ctl start failed: {started.stderr.strip()[-200:]}")
+    try:
+        yield f"postgresql+asyncpg://chat@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([pg_ctl, "-D", str(data_dir), "-m", "fast", "-w", "stop"], capture_output=True)
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_url(request, tmp_path):
+    if request.param == "sqlite":
+        return f"sqlite+aiosqlite:///{tmp_path}/chat.db"
+    return request.getfixturevalue("postgres_url")
+
+
+async def _reset_postgres(url: str):
+    reset = create_async_engine(url, poolclass=NullPool)
+    async with reset.begin() as conn:
+        await conn.exec_driver_sql("DROP SCHEMA public CASCADE")
+        await conn.exec_driver_sql("CREATE SCHEMA public")
+    await reset.dispose()
+
+
+@pytest.fixture
+async def db(database_url, monkeypatch):
+    # Свежая БД на каждый тест: движки приложения пересоздаются на database_url, схема — миграциями (init_db)
+    if make_url(database_url).get_backend_name() == "postgresql":
+        await _reset_postgres(database_url)
+    monkeypatch.setattr(database, "DATABASE_URL", database_url)
+    engine, read_engine = database._create_engines()
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "read_engine", read_engine)
+    binds = AsyncSessionLocal.kw["bind"], ReadSessionLocal.kw["bind"]
+    AsyncSessionLocal.configure(bind=engine)
+    ReadSessionLocal.configure(bind=read_engine)
+    # Кэши модулей переживают тест, а id в новой БД начинаются заново
+    room_access_cache.clear()
+    user_rooms_cache.clear()
+    history_buffer.rooms.clear()
+    await database.init_db()
+    yield engine
+    AsyncSessionLocal.configure(bind=binds[0])
+    ReadSessionLocal.configure(bind=binds[1])
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+
+
+# SQL-запросы, которые движок отправил в БД внутри блока with
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine.sync_engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._record)
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+@pytest.fixture
+def count_queries(db):
+    return lambda: QueryCounter(db)
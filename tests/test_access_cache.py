@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete
+from app import user_repo
+from app.api.router_socket import ConnectionManager
+from app.broker import MemoryBroker
+from app.connection import ClientConnection
+from app.database import AsyncSessionLocal
+from app.models import Room, RoomMember, User
+from app.user_repo import (
+    check_user_access_to_room, get_user_room_list, invalidate_room_access, invalidate_user_rooms,
+    remove_user_from_room, room_access_cache, user_rooms_cache
+)
+
+pytestmark = pytest.mark.anyio
+
+
+async def _room_with_member():
+    async with AsyncSessionLocal() as session:
+        owner = User(username="owner", first_name="Room", last_name="Owner", password_hash="-")
+        member = User(username="member", first_name="Room", last_name="Member", password_hash="-")
+        session.add_all([owner, member])
+        await session.flush()
+        room = Room(name="room", owner_id=owner.id)
+        session.add(room)
+        await session.flush()
+        session.add(RoomMember(room_id=room.id, user_id=member.id))
+        await session.commit()
+        return room.id, owner.id, member.id
+
+
+async def _has_access(room_id: int, user_id: int) -> bool:
+    async with AsyncSessionLocal() as session:
+        return await check_user_access_to_room(room_id, user_id, session)
+
+
+class ClosableWebSocket:
+    def __init__(self):
+        self.closed_with = None
+
+    async def close(self, code=None, reason=None):
+        self.closed_with = code
+
+
+async def test_removed_member_loses_cached_access(db, count_queries):
+    room_id, owner_id, member_id = await _room_with_member()
+    assert await _has_access(room_id, member_id)
+    with count_queries() as queries:
+        assert await _has_access(room_id, member_id)
+    assert queries.count == 0
+
+    async with AsyncSessionLocal() as session:
+        result = await remove_user_from_room(room_id, member_id, owner_id, session)
+    assert result["success"]
+
+    assert not await _has_access(room_id, member_id)
+    # Владельцу доступ по-прежнему отвечается из кэша
+    assert await _has_access(room_id, owner_id)
+
+
+async def test_kick_from_other_worker_revokes_access_and_closes_sockets(db):
+    room_id, owner_id, member_id = await _room_with_member()
+    assert await _has_access(room_id, member_id)
+    assert (await get_user_room_list(member_id))["rooms"]["invited"]
+
+    # Участника удалил другой воркер: его кэш сброшен там, здесь об этом сообщает событие брокера
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(RoomMember).where(RoomMember.user_id == member_id))
+        await session.commit()
+    manager = ConnectionManager(MemoryBroker())
+    websocket = ClosableWebSocket()
+    connection = ClientConnection(websocket, room_id, member_id)
+    manager.rooms.join(connection)
+
+    assert await _has_access(room_id, member_id)
+    manager._on_event({"type": "access", "room_id": room_id, "user_id": member_id, "revoked": True,
+                       "origin": "other"})
+
+    assert not await _has_access(room_id, member_id)
+    assert (await get_user_room_list(member_id))["rooms"]["invited"] == []
+    assert connection.closed
+    await asyncio.sleep(0.01)
+    assert websocket.closed_with == 1008
+
+
+async def test_stale_access_check_does_not_repopulate_cache(db, monkeypatch):
+    room_id, owner_id, member_id = await _room_with_member()
+    query = user_repo._query_user_access_to_room
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_query(*args):
+        # Запрос успел прочитать «доступ есть» до удаления участника
+        result = await query(*args)
+        started.set()
+        await release.wait()
+        return result
+
+    monkeypatch.setattr(user_repo, "_query_user_access_to_room", slow_query)
+    check = asyncio.create_task(_has_access(room_id, member_id))
+    await started.wait()
+    invalidate_room_access(room_id, member_id)
+    release.set()
+
+    assert await check
+    assert room_access_cache.get((room_id, member_id)) is None
+
+
+async def test_stale_room_list_does_not_repopulate_cache(db, monkeypatch):
+    room_id, owner_id, member_id = await _room_with_member()
+    query = user_repo._query_user_rooms
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def slow_query(user_id):
+        result = await query(user_id)
+        started.set()
+        await release.wait()
+        return result
+
+    monkeypatch.setattr(user_repo, "_query_user_rooms", slow_query)
+    room_list = asyncio.create_task(get_user_room_list(member_id))
+    await started.wait()
+    invalidate_user_rooms(member_id)
+    release.set()
+
+    assert (await room_list)["rooms"]["invited"]
+    assert user_rooms_cache.get(member_id) is None
@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+import pytest
+from app import broker as broker_module
+from app.broker import UnixSocketBroker
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def socket_dir():
+    # Путь к Unix-сокету ограничен ~100 байтами: tmp_path pytest для него бывает слишком длинным
+    path = f"/tmp/chat-broker-test-{os.getpid()}"
+    os.makedirs(path, exist_ok=True)
+    yield path
+    for name in os.listdir(path):
+        os.unlink(os.path.join(path, name))
+    os.rmdir(path)
+
+
+async def _started(socket_dir: str) -> UnixSocketBroker:
+    broker = UnixSocketBroker(socket_dir)
+    broker.received = []
+    broker.handler = broker.received.append
+    await broker.start()
+    return broker
+
+
+async def _eventually(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+async def _connected(first: UnixSocketBroker, second: UnixSocketBroker):
+    # Новый воркер при старте подключается к остальным, и те сразу перечитывают каталог
+    await _eventually(lambda: second.socket_path in first._peers and first.socket_path in second._peers)
+
+
+async def test_events_reach_other_workers(socket_dir):
+    first = await _started(socket_dir)
+    second = await _started(socket_dir)
+    await _connected(first, second)
+    try:
+        await first.publish({"type": "message", "room_id": 1, "n": 1})
+        await second.publish({"type": "message", "room_id": 1, "n": 2})
+
+        await _eventually(lambda: len(first.received) == 2 and len(second.received) == 2)
+        assert [event["n"] for event in first.received] == [1, 2]
+        assert [event["n"] for event in second.received] == [2, 1]
+        assert second.is_local(second.received[0]) and not second.is_local(second.received[1])
+    finally:
+        await first.stop()
+        await second.stop()
+
+
+async def test_publish_does_not_rescan_socket_dir(socket_dir, monkeypatch):
+    first = await _started(socket_dir)
+    second = await _started(socket_dir)
+    await _connected(first, second)
+    try:
+        listdir = os.listdir
+        calls = []
+        monkeypatch.setattr(broker_module.os, "listdir", lambda path: calls.append(path) or listdir(path))
+        for n in range(50):
+            await first.publish({"type": "message", "room_id": 1, "n": n})
+
+        await _eventually(lambda: len(second.received) == 50)
+        assert calls == []
+    finally:
+        await first.stop()
+        await second.stop()
+
+
+async def test_stalled_worker_does_not_block_publish(socket_dir, monkeypatch):
+    # «Зависший» воркер принимает соединение, но ничего не читает
+    stalled_path = os.path.join(socket_dir, "stalled.sock")
+    connections = []
+
+    async def stall(reader, writer):
+        connections.append(writer)
+        await asyncio.Event().wait()
+
+    stalled = await asyncio.start_unix_server(stall, path=stalled_path)
+    monkeypatch.setattr(broker_module.settings, "broker_peer_queue_size", 10)
+    first = await _started(socket_dir)
+    second = await _started(socket_dir)
+    await _connected(first, second)
+    try:
+        payload = "x" * 100_000
+        for n in range(200):
+            # Ни одна публикация не ждёт зависшего воркера
+            await asyncio.wait_for(first.publish({"type": "message", "room_id": 1, "n": n, "body": payload}), 0.1)
+
+        await _eventually(lambda: len(second.received) == 200)
+        assert [event["n"] for event in second.received] == list(range(200))
+        # Очередь к зависшему воркеру ограничена, старые события из неё вытесняются
+        assert len(first._peers[stalled_path]._queue) <= 10
+    finally:
+        await first.stop()
+        await second.stop()
+        for writer in connections:
+            writer.close()
+        stalled.close()
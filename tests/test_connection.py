@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from app.connection import COALESCE, DROP_OLDEST, ClientConnection
+from app.protocol import SUPPORTED
+
+pytestmark = pytest.mark.anyio
+
+PROTOCOL = SUPPORTED["chat.v2.json"]
+
+
+# Клиент, который перестал читать: первая же отправка не завершается
+class StalledWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self._release = asyncio.Event()
+
+    async def send_text(self, frame):
+        self.sent.append(frame)
+        await self._release.wait()
+
+    async def close(self, code=None, reason=None):
+        self.closed_with = code
+
+
+async def _stalled_connection(queue_size: int, policy: str):
+    websocket = StalledWebSocket()
+    connection = ClientConnection(websocket, room_id=1, user_id=1, protocol=PROTOCOL,
+                                  queue_size=queue_size, policy=policy)
+    connection.start()
+    connection.enqueue('"in flight"', message=True)
+    # Писатель взял кадр и стоит на отправке
+    await asyncio.sleep(0)
+    assert websocket.sent == ['"in flight"']
+    return websocket, connection
+
+
+async def test_coalesce_keeps_control_frames_separate():
+    websocket, connection = await _stalled_connection(queue_size=4, policy=COALESCE)
+    connection.enqueue('"m1"', message=True)
+    connection.enqueue('{"type":"pong"}')
+    connection.enqueue('"m2"', message=True)
+    connection.enqueue('"m3"', message=True)
+    connection.enqueue('"m4"', message=True)
+
+    assert not connection.closed
+    assert list(connection._queue) == [(['"m1"', '"m2"', '"m3"'], True), ('{"type":"pong"}', False), ('"m4"', True)]
+    connection.close()
+
+
+async def test_coalesce_batch_is_bounded():
+    websocket, connection = await _stalled_connection(queue_size=4, policy=COALESCE)
+    sent = 0
+    while connection.enqueue(f'"m{sent}"', message=True):
+        sent += 1
+        assert sent < 100
+
+    # Склеенный массив не растёт дальше queue_size сообщений: медленный клиент отключается
+    assert sent <= 2 * 4
+    assert connection.closed
+    await asyncio.sleep(0.01)
+    assert websocket.closed_with == 1013
+
+
+async def test_drop_oldest_keeps_newest_frames():
+    websocket, connection = await _stalled_connection(queue_size=3, policy=DROP_OLDEST)
+    for n in range(10):
+        assert connection.enqueue(f'"m{n}"', message=True)
+
+    assert [frame for frame, _ in connection._queue] == ['"m7"', '"m8"', '"m9"']
+    assert connection.dropped == 7
+    connection.close()
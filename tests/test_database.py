@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+
+import pytest
+from alembic import command
+from alembic.config import Config as AlembicConfig
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, text
+from app import database
+from app.database import (
+    MIGRATIONS_DIR, get_messages_after, get_room_history, init_db, save_messages, search_messages
+)
+
+pytestmark = pytest.mark.anyio
+
+
+def _row(room_id: int, n: int, created_at: datetime) -> dict:
+    return {
+        "room_id": room_id,
+        "user_id": 1,
+        "username": "alice",
+        "message": f"message {n}",
+        "ts": int(created_at.replace(tzinfo=timezone.utc).timestamp() * 1000),
+        "created_at": created_at,
+    }
+
+
+def _alembic_config(conn) -> AlembicConfig:
+    config = AlembicConfig()
+    config.set_main_option("script_location", str(MIGRATIONS_DIR))
+    config.attributes["connection"] = conn
+    return config
+
+
+async def _alembic(action: str, revision: str):
+    def run(conn):
+        getattr(command, action)(_alembic_config(conn), revision)
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(run)
+
+
+async def _current_revision() -> str:
+    async with database.engine.connect() as conn:
+        return (await conn.execute(text("SELECT version_num FROM alembic_version"))).scalar_one()
+
+
+async def test_save_messages_returns_ids_in_order(db):
+    created_at = datetime(2024, 5, 1, 12, 0, 0)
+    rows = [_row(7, n, created_at) for n in range(5)]
+    ids = await save_messages(rows)
+
+    assert len(ids) == 5
+    assert ids == sorted(ids)
+    history = await get_room_history(7)
+    assert [message["id"] for message in history] == ids
+    assert [message["message"] for message in history] == [f"message {n}" for n in range(5)]
+    assert history[0]["ts"] == rows[0]["ts"]
+    assert [message["id"] for message in await get_messages_after(7, ids[1], limit=2)] == ids[2:4]
+
+
+async def test_save_messages_is_one_multi_row_insert(db, count_queries):
+    # Пакет писателя уходит одним многострочным INSERT ... RETURNING, а не строкой на сообщение
+    rows = [_row(1, n, datetime(2024, 5, 1)) for n in range(200)]
+    with count_queries() as queries:
+        ids = await save_messages(rows)
+    assert len(set(ids)) == 200
+    assert queries.count == 1
+    assert queries.statements[0].lstrip().upper().startswith("INSERT INTO MESSAGES")
+
+
+async def test_save_messages_empty_batch(db, count_queries):
+    with count_queries() as queries:
+        assert await save_messages([]) == []
+    assert queries.count == 0
+
+
+async def test_migrations_reach_head(db):
+    head = ScriptDirectory.from_config(_alembic_config(None)).get_current_head()
+    assert await _current_revision() == head
+
+    async with database.engine.connect() as conn:
+        tables, indexes = await conn.run_sync(
+            lambda sync_conn: (
+                set(inspect(sync_conn).get_table_names()),
+                {index["name"] for table in ("rooms", "room_members", "messages")
+                 for index in inspect(sync_conn).get_indexes(table)},
+            )
+        )
+    assert {"users", "rooms", "room_members", "messages", "alembic_version"} <= tables
+    assert {"idx_room_owner", "idx_room_member_user", "idx_room_message"} <= indexes
+
+    # Повторный запуск (следующий воркер, перезапуск) ничего не меняет
+    await init_db()
+    assert await _current_revision() == head
+
+
+async def test_migrations_downgrade_and_upgrade_keep_messages(db):
+    created_at = datetime(2024, 5, 1, 12, 30, 15)
+    [message_id] = await save_messages([_row(3, 0, created_at)])
+
+    # 0005 убирает ts при откате и заново вычисляет его из created_at при обновлении
+    await _alembic("downgrade", "0004")
+    assert await _current_revision() == "0004"
+    await _alembic("upgrade", "head")
+
+    [message] = await get_room_history(3)
+    assert message["id"] == message_id
+    assert message["ts"] == _row(3, 0, created_at)["ts"]
+    # Поиск по сообщениям (индексы и триггеры 0003) работает и после отката 0005
+    assert [found["id"] for found in await search_messages(3, "message", limit=10)] == [message_id]
@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from app.api import router_socket
+from app.api.router_socket import ConnectionManager
+from app.broker import MemoryBroker
+from app.config import settings
+from app.database import save_messages
+from app.history import get_history_page, history_buffer
+from app.persistence import MessageWriter
+from app.protocol import SUPPORTED
+
+pytestmark = pytest.mark.anyio
+
+ROOM_ID = 1
+
+
+@pytest.fixture
+async def writer(db, monkeypatch):
+    message_writer = MessageWriter()
+    monkeypatch.setattr(router_socket, "message_writer", message_writer)
+    message_writer.start()
+    yield message_writer
+    await message_writer.stop()
+
+
+@pytest.fixture
+def failing_db(monkeypatch):
+    async def save_messages(rows):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr("app.persistence.save_messages", save_messages)
+
+
+async def _history():
+    page = await get_history_page(ROOM_ID, user_id=2, protocol=SUPPORTED["chat.v2.json"])
+    return page["messages"]
+
+
+def _buffered():
+    return [entry.event for entry in history_buffer.rooms[ROOM_ID].entries]
+
+
+async def test_write_behind_failure_drops_message_from_history(writer, failing_db):
+    manager = ConnectionManager(MemoryBroker())
+    # Буфер прогрет: дальше история отдаётся из памяти
+    assert await _history() == []
+
+    await manager.broadcast("lost", ROOM_ID, 1, "alice")
+    await writer.stop()
+
+    assert _buffered() == []
+    assert await _history() == []
+
+
+async def test_durable_appends_only_after_commit(writer, failing_db, monkeypatch):
+    monkeypatch.setattr(settings, "persist_mode", "durable")
+    manager = ConnectionManager(MemoryBroker())
+    assert await _history() == []
+
+    with pytest.raises(RuntimeError):
+        await manager.broadcast("lost", ROOM_ID, 1, "alice")
+
+    assert _buffered() == []
+    assert await _history() == []
+
+
+async def test_durable_history_entry_has_id(writer, monkeypatch):
+    monkeypatch.setattr(settings, "persist_mode", "durable")
+    manager = ConnectionManager(MemoryBroker())
+    assert await _history() == []
+
+    pending = asyncio.create_task(manager.broadcast("hello", ROOM_ID, 1, "alice"))
+    await asyncio.sleep(0)
+    # Пока пакет не записан, сообщения нет ни в буфере, ни в истории для подключившихся
+    assert _buffered() == []
+    await pending
+
+    [message] = await _history()
+    assert message["body"] == "hello"
+    assert message["id"] is not None
+
+
+async def test_recent_waits_for_pending_writes(writer):
+    manager = ConnectionManager(MemoryBroker())
+    assert await _history() == []
+
+    await manager.broadcast("first", ROOM_ID, 1, "alice")
+    await manager.broadcast("second", ROOM_ID, 1, "alice")
+    assert [event["id"] for event in _buffered()] == [None, None]
+
+    # История не отдаёт сообщения без id: ждёт пакета писателя
+    messages = await _history()
+    assert [message["body"] for message in messages] == ["first", "second"]
+    assert all(message["id"] is not None for message in messages)
+    assert messages[0]["id"] < messages[1]["id"]
+
+
+def _remote_message(ref: str, body: str) -> dict:
+    # Сообщение, разосланное другим воркером до записи в БД (write_behind)
+    return {
+        "type": "message", "room_id": ROOM_ID, "id": None, "ref": ref, "sender_id": 1, "sender": "alice",
+        "body": body, "system": False, "timestamp": "12:00", "ts": 1714564800000, "saved": True, "origin": "other"
+    }
+
+
+async def test_remote_message_survives_warm_before_commit(db):
+    manager = ConnectionManager(MemoryBroker())
+    manager._on_event(_remote_message("other.1", "hello"))
+
+    # Подключение прогревает буфер из БД, где сообщения ещё нет, и ждёт подтверждения записи
+    joiner = asyncio.create_task(_history())
+    await asyncio.sleep(0.05)
+    assert not joiner.done()
+    [message_id] = await save_messages([{
+        "room_id": ROOM_ID, "user_id": 1, "username": "alice", "message": "hello", "ts": 1714564800000,
+        "created_at": datetime(2024, 5, 1, 12)
+    }])
+    manager._on_event({"type": "saved", "room_id": ROOM_ID, "ids": {"other.1": message_id}, "failed": [],
+                       "origin": "other"})
+
+    assert [message["id"] for message in await joiner] == [message_id]
+    # Буфер прогрет и по-прежнему содержит сообщение для следующих подключений
+    assert history_buffer.rooms[ROOM_ID].warm
+    assert [message["id"] for message in await _history()] == [message_id]
+
+
+async def test_remote_failed_write_leaves_history(db):
+    manager = ConnectionManager(MemoryBroker())
+    assert await _history() == []
+    manager._on_event(_remote_message("other.1", "lost"))
+    manager._on_event({"type": "saved", "room_id": ROOM_ID, "ids": {}, "failed": ["other.1"], "origin": "other"})
+
+    assert _buffered() == []
+    assert await _history() == []
+
+
+async def test_lost_confirmation_falls_back_to_database(db, monkeypatch):
+    monkeypatch.setattr(settings, "history_pending_timeout", 0.05)
+    manager = ConnectionManager(MemoryBroker())
+    assert await _history() == []
+    manager._on_event(_remote_message("other.1", "unconfirmed"))
+
+    assert await _history() == []
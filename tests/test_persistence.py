@@ -0,0 +1,44 @@
+import pytest
+from app.metrics import REGISTRY
+from app.persistence import FLUSH_SECONDS, MessageWriter
+
+pytestmark = pytest.mark.anyio
+
+
+async def _save(writer: MessageWriter, n: int):
+    await writer.save(1, 1, "alice", f"message {n}", 1714564800000 + n, wait=True)
+
+
+async def test_flush_latency_is_exported(db):
+    writer = MessageWriter(batch_size=10, flush_interval=0)
+    writer.start()
+    flushes = FLUSH_SECONDS.count
+    try:
+        await _save(writer, 0)
+        await _save(writer, 1)
+    finally:
+        await writer.stop()
+
+    assert writer.rows_written == 2
+    assert FLUSH_SECONDS.count - flushes == writer.batches
+    exposed = REGISTRY.expose()
+    assert "# TYPE chat_persist_flush_seconds histogram" in exposed
+    assert f"chat_persist_flush_seconds_count {FLUSH_SECONDS.count}" in exposed
+
+
+async def test_failed_flush_is_not_observed(db, monkeypatch):
+    async def save_messages(rows):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr("app.persistence.save_messages", save_messages)
+    writer = MessageWriter(flush_interval=0)
+    writer.start()
+    flushes = FLUSH_SECONDS.count
+    try:
+        with pytest.raises(RuntimeError):
+            await _save(writer, 0)
+    finally:
+        await writer.stop()
+
+    assert writer.rows_failed == 1
+    assert FLUSH_SECONDS.count == flushes
@@ -0,0 +1,127 @@
+import json
+
+import pytest
+from app import ratelimit
+from app.api.router_socket import _read_frame
+from app.config import settings
+from app.protocol import LEGACY, SUPPORTED
+from app.ratelimit import DROP, THROTTLE, RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    def configure(action=DROP, per_connection=5.0, connection_burst=3, per_room=0.0, room_burst=1, max_delay=2.0):
+        monkeypatch.setattr(settings, "flood_action", action)
+        monkeypatch.setattr(settings, "rate_limit_per_connection", per_connection)
+        monkeypatch.setattr(settings, "rate_limit_connection_burst", connection_burst)
+        monkeypatch.setattr(settings, "rate_limit_per_room", per_room)
+        monkeypatch.setattr(settings, "rate_limit_room_burst", room_burst)
+        monkeypatch.setattr(settings, "rate_limit_max_delay", max_delay)
+        return RateLimiter()
+    return configure
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    bucket = TokenBucket(rate=2.0, burst=3)
+    for _ in range(3):
+        assert bucket.delay(clock.now) == 0
+        bucket.take()
+    assert bucket.delay(clock.now) == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.delay(clock.now) == 0
+    # Пополнение не превышает burst даже после долгой паузы
+    clock.now += 60
+    bucket.delay(clock.now)
+    assert bucket.tokens == 3
+
+
+def test_drop_rejects_frames_over_the_limit(clock, limits):
+    limiter = limits(action=DROP, per_connection=5.0, connection_burst=3)
+    bucket = limiter.connection_bucket()
+    assert [limiter.admit(None, bucket) for _ in range(4)] == [0, 0, 0, None]
+
+    clock.now += 0.2
+    assert limiter.admit(None, bucket) == 0
+    assert limiter.admit(None, bucket) is None
+
+
+def test_throttle_delays_up_to_max_delay(clock, limits):
+    limiter = limits(action=THROTTLE, per_connection=1.0, connection_burst=1, max_delay=2.0)
+    bucket = limiter.connection_bucket()
+    assert limiter.admit(None, bucket) == 0
+    # Токены берутся в долг: каждый следующий кадр ждёт дольше
+    assert limiter.admit(None, bucket) == pytest.approx(1.0)
+    assert limiter.admit(None, bucket) == pytest.approx(2.0)
+    assert limiter.admit(None, bucket) is None
+
+
+def test_room_limit_is_shared_and_skips_control_frames(clock, limits):
+    limiter = limits(per_connection=100.0, connection_burst=100, per_room=1.0, room_burst=2)
+    first, second = limiter.connection_bucket(), limiter.connection_bucket()
+    # ping, resync и т. п. не расходуют лимит комнаты
+    for _ in range(10):
+        assert limiter.admit(None, first) == 0
+    assert limiter.admit(7, first) == 0
+    assert limiter.admit(7, second) == 0
+    assert limiter.admit(7, second) is None
+    # У другой комнаты свой лимит
+    assert limiter.admit(8, second) == 0
+
+    limiter.forget_room(7)
+    assert limiter.admit(7, first) == 0
+
+
+def test_disabled_limits_admit_everything(clock, limits):
+    limiter = limits(per_connection=0, per_room=0)
+    assert limiter.connection_bucket() is None
+    assert all(limiter.admit(7, None) == 0 for _ in range(1000))
+
+
+def _v2(body: str) -> str:
+    return json.dumps({"type": "message", "body": body}, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("protocol, encode", [
+    (LEGACY, lambda body: body),
+    (SUPPORTED["chat.v2.json"], _v2),
+])
+def test_message_size_limit_counts_only_the_body(protocol, encode, monkeypatch):
+    monkeypatch.setattr(settings, "max_message_size", 100)
+    request, is_message, oversized = _read_frame(protocol, encode("я" * 100))
+    assert is_message and not oversized
+    assert request["body"] == "я" * 100
+
+    _, is_message, oversized = _read_frame(protocol, encode("я" * 101))
+    assert is_message and oversized
+
+
+def test_control_frames_are_not_limited_by_message_size(monkeypatch):
+    monkeypatch.setattr(settings, "max_message_size", 20)
+    protocol = SUPPORTED["chat.v2.json"]
+    frame = json.dumps({"type": "resync", "after_id": 123456789, "limit": 500})
+    assert len(frame) > settings.max_message_size
+    request, is_message, oversized = _read_frame(protocol, frame)
+    assert request["type"] == "resync" and not is_message and not oversized
+
+
+def test_frames_over_ws_max_size_are_not_decoded(monkeypatch):
+    monkeypatch.setattr(settings, "max_message_size", 10)
+    protocol = SUPPORTED["chat.v2.json"]
+    monkeypatch.setattr(protocol, "decode", lambda data: pytest.fail("decoded an oversized frame"))
+    assert _read_frame(protocol, "x" * (settings.ws_max_size + 1)) == (None, False, True)
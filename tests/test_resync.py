@@ -0,0 +1,104 @@
+import json
+from datetime import datetime
+
+import pytest
+from app.api.router_socket import ConnectionManager
+from app.broker import MemoryBroker
+from app.config import settings
+from app.connection import ClientConnection
+from app.database import save_messages
+from app.history import HistoryEntry, get_resync_page, history_buffer
+from app.protocol import SUPPORTED
+
+pytestmark = pytest.mark.anyio
+
+ROOM_ID = 1
+PROTOCOL = SUPPORTED["chat.v2.json"]
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, frame):
+        self.frames.append(json.loads(frame))
+
+
+@pytest.fixture
+async def room(db, monkeypatch):
+    # 150 сообщений в БД, буфер прогрет последними 100 (ids[50:]), ещё 20 пришли после прогрева
+    monkeypatch.setattr(history_buffer, "size", 100)
+    rows = [{"room_id": ROOM_ID, "user_id": 1, "username": "alice", "message": f"old {n}",
+             "ts": 1714564800000 + n, "created_at": datetime(2024, 5, 1)} for n in range(150)]
+    ids = await save_messages(rows)
+    assert await history_buffer.recent(ROOM_ID, 50) is not None
+    manager = ConnectionManager(MemoryBroker())
+    for n in range(20):
+        # Писатель не запущен: сообщение записывается сразу и попадает в буфер с id
+        await manager.broadcast(f"new {n}", ROOM_ID, 1, "alice")
+    ids += [entry.id for entry in list(history_buffer.rooms[ROOM_ID].entries)[-20:]]
+    assert history_buffer.rooms[ROOM_ID].entries[0].id == ids[70]
+    return manager, ids
+
+
+async def _reconnect(manager: ConnectionManager, after_id: int) -> dict:
+    websocket = RecordingWebSocket()
+    connection = ClientConnection(websocket, ROOM_ID, user_id=2, protocol=PROTOCOL)
+    await manager.send_history(connection, after_id)
+    [frame] = websocket.frames
+    return frame
+
+
+@pytest.mark.parametrize("seen", [
+    0,    # почти вся комната, из БД
+    69,   # разрыв начинается за одно сообщение до буфера: из БД
+    70,   # последнее увиденное — первое в буфере: из буфера
+    150,  # только сообщения, пришедшие после прогрева
+    169,  # клиент видел всё
+])
+async def test_reconnect_returns_exactly_the_missed_messages(room, seen):
+    manager, ids = room
+    frame = await _reconnect(manager, ids[seen])
+
+    assert frame["type"] == "resync"
+    assert not frame["has_more"]
+    assert [message["id"] for message in frame["messages"]] == ids[seen + 1:]
+    assert frame["last_id"] == ids[-1]
+
+
+async def test_resync_pages_cover_the_gap_without_duplicates(room, monkeypatch):
+    monkeypatch.setattr(settings, "resync_max_messages", 40)
+    manager, ids = room
+    received = []
+    after_id = ids[10]
+    while True:
+        page = await get_resync_page(ROOM_ID, 2, after_id, protocol=PROTOCOL)
+        received += [message["id"] for message in page["messages"]]
+        if not page["has_more"]:
+            break
+        after_id = page["last_id"]
+
+    # Страницы из БД переходят в страницы из буфера без пропусков и повторов
+    assert received == ids[11:]
+
+
+async def test_long_gap_falls_back_to_full_history(room, monkeypatch):
+    monkeypatch.setattr(settings, "resync_max_messages", 40)
+    manager, ids = room
+    frame = await _reconnect(manager, ids[10])
+
+    # Разрыв больше resync_max_messages: клиент получает обычную первую страницу истории
+    assert frame["type"] == "history"
+    assert [message["id"] for message in frame["messages"]] == ids[-settings.history_page_size:]
+
+
+async def test_resync_skips_messages_still_being_written(room):
+    manager, ids = room
+    # write_behind: сообщение разослано, но ещё не записано — клиент получит его живым кадром и id кадром saved
+    history_buffer.append(ROOM_ID, HistoryEntry({
+        "id": None, "sender_id": 1, "sender": "alice", "body": "pending", "timestamp": "12:00", "ts": 1
+    }))
+    frame = await _reconnect(manager, ids[160])
+
+    assert [message["id"] for message in frame["messages"]] == ids[161:]
+    assert "pending" not in [message["body"] for message in frame["messages"]]
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+from app import retention
+from app.config import settings
+from app.database import delete_messages, incremental_vacuum, save_messages
+
+pytestmark = pytest.mark.anyio
+
+
+async def _pragma(db, name: str) -> int:
+    async with db.connect() as conn:
+        return (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+
+
+@pytest.fixture
+def default_profile(monkeypatch):
+    # Файл БД, созданный до профиля performance: без auto_vacuum
+    monkeypatch.setattr(settings, "db_profile", "default")
+
+
+@pytest.mark.parametrize("database_url", ["sqlite"], indirect=True)
+async def test_vacuum_full_switches_sqlite_to_incremental(default_profile, db, monkeypatch):
+    monkeypatch.setattr(retention, "engine", db)
+    rows = [
+        {"room_id": 1, "user_id": 1, "username": "alice", "message": "x" * 500, "ts": n,
+         "created_at": datetime(2024, 5, 1)}
+        for n in range(200)
+    ]
+    ids = await save_messages(rows)
+    await delete_messages(1, ids[0], ids[-1])
+    # Профиль default: файл создан без auto_vacuum, шагам incremental_vacuum возвращать нечего
+    assert await _pragma(db, "auto_vacuum") == 0
+    assert await incremental_vacuum(100) is None
+
+    await retention._vacuum_full()
+
+    assert await _pragma(db, "auto_vacuum") == 2
+    # Полный VACUUM вернул страницы удалённых сообщений
+    assert await _pragma(db, "freelist_count") == 0
+    assert await incremental_vacuum(100) == 0
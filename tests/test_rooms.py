@@ -0,0 +1,128 @@
+import asyncio
+import json
+import random
+
+import pytest
+from app.api.router_socket import ConnectionManager
+from app.broker import MemoryBroker
+from app.connection import ClientConnection
+from app.rooms import RoomRegistry
+
+pytestmark = pytest.mark.anyio
+
+PREFIX = "stress:"
+
+
+class FakeWebSocket:
+    # Отправка уступает цикл событий, чтобы входы и выходы вклинивались между кадрами рассылки
+    def __init__(self, fail_after=None):
+        self.scope = {}
+        self.received = 0
+        self.fail_after = fail_after
+
+    async def accept(self, subprotocol=None):
+        await asyncio.sleep(0)
+
+    async def close(self, code: int = 1000, reason=None):
+        pass
+
+    async def send_text(self, data):
+        await asyncio.sleep(0)
+        if self.fail_after is not None:
+            self.fail_after -= 1
+            if self.fail_after < 0:
+                raise ConnectionResetError("client went away")
+        frame = json.loads(data)
+        for item in frame if isinstance(frame, list) else [frame]:
+            if PREFIX in item.get("text", ""):
+                self.received += 1
+
+
+async def test_snapshot_is_stable_and_rebuilt_after_changes():
+    registry = RoomRegistry()
+    first, second = ClientConnection(None, 1, 1), ClientConnection(None, 1, 2)
+    registry.join(first)
+    snapshot = registry.snapshot(1)
+    assert snapshot == (first,)
+    # Без изменений состава снимок переиспользуется
+    assert registry.snapshot(1) is snapshot
+
+    registry.join(second)
+    # Уже взятый снимок не меняется, следующий видит нового участника
+    assert snapshot == (first,)
+    assert registry.snapshot(1) == (first, second)
+
+    assert registry.leave(first) is not None
+    assert registry.leave(first) is None
+    assert registry.snapshot(1) == (second,)
+    registry.leave(second)
+    # Пустая комната удаляется из реестра
+    assert 1 not in registry
+    assert registry.snapshot(1) == ()
+
+
+async def test_concurrent_join_leave_keeps_membership_consistent():
+    rng = random.Random(0)
+    rooms, churners, broadcasters = 5, 200, 5
+    manager = ConnectionManager(MemoryBroker())
+    manager.coalesce_window = 0.005
+    resident = []
+    for room_id in range(rooms):
+        websocket = FakeWebSocket()
+        connection = await manager.connect(websocket, room_id, room_id, f"resident{room_id}")
+        connection.start()
+        resident.append(websocket)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + 0.5
+    sent = [0] * rooms
+    joins = []
+
+    async def churn(user_id):
+        while loop.time() < deadline:
+            room_id = rng.randrange(rooms)
+            mode = rng.random()
+            websocket = FakeWebSocket(fail_after=rng.randrange(3) if mode < 0.2 else None)
+            connection = await manager.connect(websocket, room_id, user_id, f"churn{user_id}")
+            connection.start()
+            joins.append(connection)
+            await asyncio.sleep(rng.random() * 0.02)
+            if mode < 0.5:
+                manager.disconnect(connection)
+            else:
+                # Как при разрыве со стороны клиента или сервера
+                connection.close(code=1000)
+
+    async def broadcast():
+        n = 0
+        while loop.time() < deadline:
+            room_id = rng.randrange(rooms)
+            await manager.broadcast(f"{PREFIX}{n}", room_id, 0, "stress", save_to_db=False)
+            sent[room_id] += 1
+            n += 1
+            await asyncio.sleep(0.001)
+
+    async def check():
+        # Снимок каждой комнаты совпадает с её составом, закрытых соединений в реестре нет
+        while loop.time() < deadline:
+            for room in manager.rooms.rooms():
+                assert set(room.snapshot) == set(room._connections)
+                assert len(room) > 0
+            assert not any(connection.closed for connection in manager.rooms.connections())
+            assert manager.lifecycle.total == sum(size for _, size in manager.rooms.sizes())
+            await asyncio.sleep(0.001)
+
+    await asyncio.gather(
+        *(churn(10 ** 6 + n) for n in range(churners)),
+        *(broadcast() for _ in range(broadcasters)),
+        check(),
+    )
+    # Доставляем хвост: окно склейки и очереди писателей
+    await asyncio.sleep(0.1)
+
+    assert len(joins) > churners
+    assert all(connection.closed for connection in joins)
+    assert sorted(manager.rooms.sizes()) == [(room_id, 1) for room_id in range(rooms)]
+    assert manager.lifecycle.total == rooms
+    assert [websocket.received for websocket in resident] == sent
+    await manager.stop()
@@ -0,0 +1,66 @@
+import pytest
+from app.database import AsyncSessionLocal
+from app.models import Room, RoomMember, User
+from app.user_repo import get_room_members, get_room_members_page
+
+pytestmark = pytest.mark.anyio
+
+
+async def _room_with_members(count: int) -> int:
+    # Пользователи создаются напрямую, без scrypt: для запросов к списку участников хэш не важен
+    async with AsyncSessionLocal() as session:
+        owner = User(username="owner", first_name="Room", last_name="Owner", password_hash="-")
+        members = [User(username=f"member{n}", first_name="Member", last_name=str(n), password_hash="-")
+                   for n in range(count)]
+        session.add_all([owner, *members])
+        await session.flush()
+        room = Room(name="members", owner_id=owner.id)
+        session.add(room)
+        await session.flush()
+        session.add_all([RoomMember(room_id=room.id, user_id=member.id) for member in members])
+        await session.commit()
+        return room.id
+
+
+@pytest.mark.parametrize("count", [0, 1, 30])
+async def test_room_members_single_query(db, count_queries, count):
+    room_id = await _room_with_members(count)
+    async with AsyncSessionLocal() as session:
+        with count_queries() as queries:
+            members = await get_room_members(room_id, session)
+
+    # Один запрос при любом числе участников: ни N+1 по пользователям, ни ленивой загрузки room.owner
+    assert queries.count == 1
+    assert len(members) == count + 1
+    assert members[0] == {"id": members[0]["id"], "username": "owner", "first_name": "Room",
+                          "last_name": "Owner", "is_owner": True}
+    assert [member["username"] for member in members[1:]] == [f"member{n}" for n in range(count)]
+    assert not any(member["is_owner"] for member in members[1:])
+
+
+async def test_room_members_unknown_room(db, count_queries):
+    async with AsyncSessionLocal() as session:
+        with count_queries() as queries:
+            assert await get_room_members(12345, session) == []
+    assert queries.count == 1
+
+
+async def test_room_members_page_one_query_per_page(db, count_queries):
+    room_id = await _room_with_members(25)
+    usernames = []
+    pages = 0
+    after_id = None
+    async with AsyncSessionLocal() as session:
+        with count_queries() as queries:
+            while True:
+                page = await get_room_members_page(room_id, session, after_id=after_id, limit=10)
+                pages += 1
+                usernames.extend(member["username"] for member in page["members"])
+                if not page["has_more"]:
+                    break
+                after_id = page["next_after_id"]
+
+    # Владелец и 25 участников — три страницы по 10, по запросу на страницу
+    assert pages == 3
+    assert queries.count == pages
+    assert usernames == ["owner"] + [f"member{n}" for n in range(25)]